@@ -0,0 +1,305 @@
+"""
+Offline benchmark of SpeechLoop itself: every engine is pointed at a local stand-in (see mock_servers.py) that answers
+after a set latency, so the run measures the time SpeechLoop adds on top of the engines per file, per engine and per
+stage.
+
+The same requests are also made by a bare aiohttp client (the reference run) on the same machine, and the run's time
+relative to it is compared with baseline.json. The exit code is 1 when it has grown by more than the tolerance, so it can
+gate CI: both times scale with the machine, their ratio is SpeechLoop's cost and is comparable across machines.
+
+    python benchmarks/harness.py                      # compare with the baseline
+    python benchmarks/harness.py --update_baseline    # store this machine's result as the baseline
+    python benchmarks/harness.py --latency 0.2 --jitter 0.1 --failure_rate 0.05 --runner async --max_in_flight 16
+
+The engines' own time is taken out using the delay each stand-in reports it added: overhead per call is an engine's mean
+latency minus the stand-in's mean delay. Stage times come from the trace of the run.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import urllib.request
+import wave
+from collections import defaultdict
+
+import aiohttp
+import numpy as np
+
+# runnable as a script from anywhere in the checkout
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from speechloop.model_runner import RUNNERS
+from benchmarks.mock_servers import MODEL_SERVER_PORTS, VOSK_PORT, Behaviour, MockAwsClient, MockDockerClient, MockGoogleClient, serve
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_ENGINES = "vs,sp,cq,aw,az,gg"
+# allowed growth of the run's time relative to the reference run before the check fails
+DEFAULT_TOLERANCE = 0.3
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark SpeechLoop against local stand-ins of the engines")
+    parser.add_argument("--engines", default=DEFAULT_ENGINES, help="comma separated ASR shortcodes, gg is skipped if google isn't installed")
+    parser.add_argument("--files", type=int, default=300, help="number of synthetic wavs")
+    parser.add_argument("--seconds", type=float, default=2.0, help="length of each wav")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each stand-in takes per request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many seconds more, uniformly random")
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3, help="runs to make, the cheapest is kept as it is the least disturbed by the rest of the machine")
+    parser.add_argument("--runner", default="async", choices=RUNNERS)
+    parser.add_argument("--max_in_flight", type=int, default=8)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--server_streaming", default="off")
+    parser.add_argument("--trace_memory", action="store_true", help="record memory per stage (slows the run, don't compare with the baseline)")
+    parser.add_argument("--azure_port", type=int, default=3400)
+    parser.add_argument("--output_dir", default="", help="where the run's files are kept, a temporary directory by default")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=None, help=f"overrides the baseline's tolerance (default {DEFAULT_TOLERANCE})")
+    parser.add_argument("--update_baseline", action="store_true")
+    return parser.parse_args(args)
+
+
+def make_dataset(folder: str, files: int, seconds: float, seed: int = 0, sr: int = 16000) -> str:
+    """Write files of 16 bit mono noise and a CSV of them, returns the CSV path"""
+    rng = np.random.default_rng(seed)
+    wav_folder = os.path.join(folder, "wavs")
+    os.makedirs(wav_folder, exist_ok=True)
+    rows = ["filename,transcript"]
+    for i in range(files):
+        path = os.path.join(wav_folder, f"{i:06d}.wav")
+        with wave.open(path, "wb") as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(sr)
+            wf.writeframes(rng.integers(-3000, 3000, int(seconds * sr), dtype=np.int16).tobytes())
+        rows.append(f"{path},the quick brown fox")
+    csv_path = os.path.join(folder, "harness.csv")
+    with open(csv_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(rows) + "\n")
+    return csv_path
+
+
+def available_engines(engines: list) -> list:
+    if "gg" in engines:
+        try:
+            import google.cloud.speech  # noqa: F401
+        except ImportError:
+            print("google is not installed, skipping gg")
+            engines = [e for e in engines if e != "gg"]
+    return engines
+
+
+def server_stats(port: int) -> dict:
+    with urllib.request.urlopen(f"http://localhost:{port}/mock_stats", timeout=10) as r:
+        return json.loads(r.read())
+
+
+def stage_times(trace_path: str) -> dict:
+    """Total seconds of each stage of the main process"""
+    with open(trace_path, encoding="utf-8") as f:
+        events = json.load(f)["traceEvents"]
+    main_pid = min(e["pid"] for e in events if e.get("ph") == "X") if any(e.get("ph") == "X" for e in events) else None
+    totals = defaultdict(float)
+    for event in events:
+        if event.get("ph") == "X" and event["pid"] == main_pid:
+            totals[event["name"]] += event["dur"] / 1e6
+    return dict(totals)
+
+
+def behaviour_settings(args) -> dict:
+    return {"latency": args.latency, "jitter": args.jitter, "failure_rate": args.failure_rate, "seed": args.seed}
+
+
+@contextlib.contextmanager
+def mock_servers(args):
+    """The stand-in servers in their own process, so they don't share the GIL with the run being measured"""
+    context = multiprocessing.get_context("spawn")
+    ready, stop = context.Event(), context.Event()
+    servers = context.Process(target=serve, args=(behaviour_settings(args), args.azure_port, ready, stop), daemon=True)
+    servers.start()
+    try:
+        assert ready.wait(30), "mock servers did not start"
+        yield dict(MODEL_SERVER_PORTS, vs=VOSK_PORT, az=args.azure_port)
+    finally:
+        stop.set()
+        # the engines' keepalive connections are only closed at exit, don't wait on them
+        servers.join(2)
+        if servers.is_alive():
+            servers.terminate()
+
+
+def reference_seconds(csv_path: str, port: int, engines: int, concurrency: int) -> float:
+    """
+    Seconds a bare client takes to send each file of the CSV engines times to the model server stand-in on port, with
+    concurrency requests in flight. The least the run could take on this machine, nothing is scored or written.
+    """
+    with open(csv_path, encoding="utf-8") as f:
+        paths = [line.split(",")[0] for line in f.read().splitlines()[1:]]
+    audios = []
+    for path in paths:
+        with open(path, "rb") as f:
+            audios.append(f.read())
+    requests = audios * engines
+
+    async def send_all():
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+
+            async def sender():
+                while requests:
+                    audio = requests.pop()
+                    async with session.post(f"http://localhost:{port}/transcribe_raw", data=audio) as r:
+                        await r.read()
+
+            start = time.monotonic()
+            await asyncio.gather(*[sender() for _ in range(concurrency)])
+            return time.monotonic() - start
+
+    return asyncio.run(send_all())
+
+
+def run(args, output_dir: str, ports: dict) -> dict:
+    from speechloop.asr import container_utils
+    from speechloop.core import benchmark
+
+    engines = available_engines(args.engines.split(","))
+    csv_path = make_dataset(output_dir, args.files, args.seconds, args.seed)
+    settings = behaviour_settings(args)
+
+    container_utils.set_docker_client(MockDockerClient())
+    behaviour = Behaviour(**settings)
+    aws_behaviour, google_behaviour = behaviour.copy(), behaviour.copy()
+    engine_options = {
+        "aw": {"client_factory": MockAwsClient.factory(aws_behaviour)},
+        "gg": {"client": MockGoogleClient(google_behaviour)},
+        "az": {
+            "apikey": "mock",
+            "url": f"http://localhost:{ports['az']}/speech/recognition/conversation/cognitiveservices/v1",
+            "credential_url": f"http://localhost:{ports['az']}/sts/v1.0/issueToken",
+        },
+    }
+    # the servers count from when they started, keep only this run's requests
+    before = {code: server_stats(port) for code, port in ports.items()}
+    trace_path = os.path.join(output_dir, "trace.json")
+    benchmark(
+        engines,
+        csv_path,
+        shell_script_mode=True,
+        home_dir=output_dir,
+        runner=args.runner,
+        max_in_flight=args.max_in_flight,
+        batch_size=args.batch_size,
+        server_streaming=args.server_streaming,
+        trace=trace_path,
+        trace_memory=args.trace_memory,
+        engine_options=engine_options,
+    )
+
+    service = {"aw": aws_behaviour.stats(), "gg": google_behaviour.stats()}
+    for code, port in ports.items():
+        after = server_stats(port)
+        service[code] = {key: after[key] - before[code][key] for key in after}
+
+    stats_paths = [os.path.join(output_dir, "output", name) for name in os.listdir(os.path.join(output_dir, "output")) if name.endswith("_stats.json")]
+    with open(max(stats_paths, key=os.path.getmtime), encoding="utf-8") as f:
+        run_stats = json.load(f)
+
+    wall_seconds = run_stats["wall_seconds"]
+    reference = reference_seconds(csv_path, ports["cq"], len(engines), args.max_in_flight * len(engines))
+    result = {
+        "settings": dict(settings, files=args.files, seconds=args.seconds, engines=engines, runner=args.runner, max_in_flight=args.max_in_flight, batch_size=args.batch_size),
+        "wall_seconds": wall_seconds,
+        "files_per_second": args.files / wall_seconds,
+        "ms_per_file": 1000 * wall_seconds / args.files,
+        "reference_ms_per_file": 1000 * reference / args.files,
+        "relative_cost": wall_seconds / reference,
+        "stages_ms_per_file": {name: 1000 * seconds / args.files for name, seconds in stage_times(trace_path).items()},
+        "engines": {},
+        "output_dir": output_dir,
+    }
+    for code in engines:
+        engine = run_stats["engines"][code]
+        served = service[code]
+        delay_mean = served["service_seconds"] / served["requests"] if served["requests"] else 0.0
+        result["engines"][code] = {
+            "calls": engine["calls"],
+            "latency_mean_ms": 1000 * engine.get("latency_mean", 0.0),
+            "latency_p99_ms": 1000 * engine.get("latency_p99", 0.0),
+            "service_mean_ms": 1000 * delay_mean,
+            # a batch's time is shared out between its files, so per call overhead only means something without batching
+            "overhead_mean_ms": 1000 * (engine.get("latency_mean", 0.0) - delay_mean) if args.batch_size == 1 else None,
+            "retried_calls": engine["retried_calls"],
+            "service_failures": served["failures"],
+        }
+    return result
+
+
+def print_result(result: dict):
+    print("=" * 30)
+    print(f"{result['files_per_second']:.2f} files/s, {result['ms_per_file']:.2f} ms per file over {result['wall_seconds']:.2f}s")
+    print(f"{result['relative_cost']:.2f}x the {result['reference_ms_per_file']:.2f} ms per file of the reference run")
+    for name, ms in sorted(result["stages_ms_per_file"].items(), key=lambda kv: -kv[1]):
+        print(f"  stage {name:<20} {ms:8.3f} ms per file")
+    for code, engine in result["engines"].items():
+        overhead = f"{engine['overhead_mean_ms']:.2f} ms" if engine["overhead_mean_ms"] is not None else "n/a"
+        print(
+            f"  engine {code}: latency mean {engine['latency_mean_ms']:.2f} ms (p99 {engine['latency_p99_ms']:.2f}), stand-in {engine['service_mean_ms']:.2f} ms, "
+            f"overhead {overhead} per call, {engine['retried_calls']} retried of {engine['calls']}"
+        )
+    print("=" * 30)
+
+
+def check_baseline(result: dict, baseline: dict, tolerance: float = None) -> bool:
+    """
+    True when the run's time relative to the reference run hasn't grown more than the tolerance above the baseline's.
+    Files/s depends on the machine so it is only printed.
+    """
+    tolerance = baseline.get("tolerance", DEFAULT_TOLERANCE) if tolerance is None else tolerance
+    if baseline.get("settings") != result["settings"]:
+        print("Warning: the run's settings differ from the baseline's, the comparison may not mean much")
+    ceiling = baseline["relative_cost"] * (1 + tolerance)
+    ok = result["relative_cost"] <= ceiling
+    print(
+        f"{'OK' if ok else 'REGRESSION'}: {result['relative_cost']:.2f}x the reference run against a baseline of {baseline['relative_cost']:.2f}x "
+        f"(fails above {ceiling:.2f}x, tolerance {tolerance:.0%}). {result['files_per_second']:.2f} files/s here, "
+        f"{baseline['files_per_second']:.2f} where the baseline was made"
+    )
+    return ok
+
+
+def main(args=None) -> int:
+    args = parse_args(args)
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix="speechloop_harness_")
+    with mock_servers(args) as ports:
+        results = [run(args, os.path.join(output_dir, f"run{i}"), ports) for i in range(args.repeats)]
+    rates = ", ".join(f"{r['files_per_second']:.2f}" for r in results)
+    print(f"files/s of each run: {rates}")
+    result = min(results, key=lambda r: r["relative_cost"])
+    print_result(result)
+
+    if args.update_baseline:
+        baseline = {k: result[k] for k in ["settings", "relative_cost", "files_per_second", "ms_per_file", "reference_ms_per_file", "stages_ms_per_file", "engines"]}
+        baseline["tolerance"] = args.tolerance if args.tolerance is not None else DEFAULT_TOLERANCE
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --update_baseline to make one")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    return 0 if check_baseline(result, baseline, args.tolerance) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,270 @@
+"""
+Local stand-ins for every engine SpeechLoop talks to, so that runs can be benchmarked offline and without models:
+
+- vosk: the vosk server websocket protocol on port 2800
+- sphinx/coqui: the model server endpoints (/transcribe, /transcribe_raw, /transcribe_batch, /stream) on 3000/3200
+- azure: the token and recognition endpoints
+- aws/google: client objects passed to the engines in place of amazon_transcribe's and google's
+- docker: a client that reports the engine images as running, so no containers are started or stopped
+
+Every reply is the same transcript after a delay of latency plus up to jitter seconds, and a failure_rate of the requests
+fail: HTTP endpoints answer 500, websockets are closed after the final result (the client reconnects on its next file),
+google returns no results and aws a stream with no results. Each server counts its requests and the delay it added at
+/mock_stats so the harness can tell the engines' time apart from SpeechLoop's own.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from aiohttp import WSMsgType, web
+
+TRANSCRIPT = "the quick brown fox"
+PARTIAL = "the quick"
+VOSK_PORT = 2800
+MODEL_SERVER_PORTS = {"sp": 3000, "cq": 3200}
+DOCKER_IMAGES = [f"ghcr.io/robmsmt/speechloop/sl-{name}-en-16k:latest" for name in ["vosk", "sphinx", "coqui"]]
+
+
+class Behaviour:
+    """How a stand-in answers, shared by the servers and the client objects. Counts are kept per server/client"""
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.failures = 0
+        self.service_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        with self._lock:
+            seconds = self.latency + (self.random.uniform(0, self.jitter) if self.jitter > 0 else 0.0)
+            self.requests += 1
+            self.service_seconds += seconds
+            return seconds
+
+    def fails(self) -> bool:
+        with self._lock:
+            failed = self.failure_rate > 0 and self.random.random() < self.failure_rate
+            self.failures += failed
+            return failed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "failures": self.failures, "service_seconds": self.service_seconds}
+
+    def copy(self) -> "Behaviour":
+        """Same settings with counts of its own, each stand-in gets one"""
+        return Behaviour(self.latency, self.jitter, self.failure_rate, self.random.random())
+
+
+# SERVERS
+
+
+async def healthcheck(request):
+    return web.json_response({"ok": "true"})
+
+
+async def mock_stats(request):
+    return web.json_response(request.app["behaviour"].stats())
+
+
+async def websocket_stream(request):
+    """
+    The vosk protocol: each binary message is answered with a partial, {"reset" : 1} or {"eof" : 1} with the final result
+    after the delay. Failures close the socket after the final result.
+    """
+    behaviour = request.app["behaviour"]
+    websocket = web.WebSocketResponse()
+    await websocket.prepare(request)
+    async for message in websocket:
+        if message.type == WSMsgType.BINARY:
+            await websocket.send_json({"partial": PARTIAL})
+        elif message.type == WSMsgType.TEXT:
+            await asyncio.sleep(behaviour.delay())
+            await websocket.send_json({"text": TRANSCRIPT})
+            if "eof" in json.loads(message.data) or behaviour.fails():
+                break
+    await websocket.close()
+    return websocket
+
+
+async def transcribe(request):
+    behaviour = request.app["behaviour"]
+    await request.read()
+    await asyncio.sleep(behaviour.delay())
+    if behaviour.fails():
+        return web.json_response({"detail": "mock failure"}, status=500)
+    return web.json_response({"transcript": TRANSCRIPT})
+
+
+async def transcribe_batch(request):
+    behaviour = request.app["behaviour"]
+    await request.read()
+    items = request.headers.get("X-Item-Lengths", "").count(",") + 1
+    # the items of a batch are shared out between models, they take as long as the slowest one
+    delays = [behaviour.delay() for _ in range(items)]
+    await asyncio.sleep(max(delays))
+    if behaviour.fails():
+        return web.json_response({"detail": "mock failure"}, status=500)
+    return web.json_response({"transcripts": [TRANSCRIPT] * items, "inf_times": delays})
+
+
+async def azure_token(request):
+    return web.Response(text="mock-token")
+
+
+async def azure_recognize(request):
+    behaviour = request.app["behaviour"]
+    await request.read()
+    await asyncio.sleep(behaviour.delay())
+    if behaviour.fails():
+        return web.Response(status=500)
+    return web.json_response({"RecognitionStatus": "Success", "DisplayText": TRANSCRIPT.capitalize() + "."})
+
+
+def vosk_app(behaviour: Behaviour) -> web.Application:
+    app = web.Application()
+    app["behaviour"] = behaviour
+    app.router.add_get("/", websocket_stream)
+    app.router.add_get("/mock_stats", mock_stats)
+    return app
+
+
+def model_server_app(behaviour: Behaviour) -> web.Application:
+    app = web.Application(client_max_size=1024**3)
+    app["behaviour"] = behaviour
+    app.router.add_get("/healthcheck", healthcheck)
+    app.router.add_post("/transcribe", transcribe)
+    app.router.add_post("/transcribe_raw", transcribe)
+    app.router.add_post("/transcribe_batch", transcribe_batch)
+    app.router.add_get("/stream", websocket_stream)
+    app.router.add_get("/mock_stats", mock_stats)
+    return app
+
+
+def azure_app(behaviour: Behaviour) -> web.Application:
+    app = web.Application(client_max_size=1024**3)
+    app["behaviour"] = behaviour
+    app.router.add_post("/sts/v1.0/issueToken", azure_token)
+    app.router.add_post("/speech/recognition/conversation/cognitiveservices/v1", azure_recognize)
+    app.router.add_get("/mock_stats", mock_stats)
+    return app
+
+
+def server_apps(behaviour: Behaviour, azure_port: int) -> dict:
+    """The apps to serve by engine shortcode, with their ports"""
+    apps = {"vs": (vosk_app(behaviour.copy()), VOSK_PORT), "az": (azure_app(behaviour.copy()), azure_port)}
+    for code, port in MODEL_SERVER_PORTS.items():
+        apps[code] = (model_server_app(behaviour.copy()), port)
+    return apps
+
+
+def serve(settings: dict, azure_port: int, ready=None, stop=None):
+    """
+    Run the servers until stop (a multiprocessing Event) is set. Meant to be the target of its own process so that the
+    servers don't compete with the benchmark for the GIL.
+
+    :param settings: keyword arguments of Behaviour
+    """
+
+    async def main():
+        runners = []
+        for app, port in server_apps(Behaviour(**settings), azure_port).values():
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, "localhost", port).start()
+            runners.append(runner)
+        if ready is not None:
+            ready.set()
+        try:
+            while stop is None or not stop.is_set():
+                await asyncio.sleep(0.1)
+        finally:
+            for runner in runners:
+                await runner.cleanup()
+
+    asyncio.run(main())
+
+
+# CLIENTS
+
+
+class MockAwsStream:
+    """A transcribe stream, a partial is sent straight away and the final result once the audio has ended"""
+
+    def __init__(self, behaviour: Behaviour):
+        from amazon_transcribe.model import Alternative, Result, Transcript, TranscriptEvent
+
+        def event(text, is_partial):
+            return TranscriptEvent(Transcript([Result(is_partial=is_partial, alternatives=[Alternative(text, [], [])])]))
+
+        self.behaviour = behaviour
+        self.event = event
+        self.input_stream = self
+        self.output_stream = self.events()
+        self.ended = asyncio.Event()
+
+    async def send_audio_event(self, audio_chunk):
+        pass
+
+    async def end_stream(self):
+        self.ended.set()
+
+    async def events(self):
+        yield self.event(PARTIAL, True)
+        await self.ended.wait()
+        await asyncio.sleep(self.behaviour.delay())
+        if not self.behaviour.fails():
+            yield self.event(TRANSCRIPT.capitalize() + ".", False)
+
+
+class MockAwsClient:
+    """Takes the place of amazon_transcribe's TranscribeStreamingClient, use client_factory=MockAwsClient.factory(behaviour)"""
+
+    def __init__(self, behaviour: Behaviour, region=None):
+        self.behaviour = behaviour
+
+    @classmethod
+    def factory(cls, behaviour: Behaviour):
+        return lambda region: cls(behaviour, region)
+
+    async def start_stream_transcription(self, **kwargs):
+        return MockAwsStream(self.behaviour)
+
+
+class MockGoogleClient:
+    """Takes the place of google's SpeechClient, recognize blocks for the delay like the real one"""
+
+    def __init__(self, behaviour: Behaviour):
+        self.behaviour = behaviour
+
+    def recognize(self, config, audio):
+        time.sleep(self.behaviour.delay())
+        if self.behaviour.fails():
+            return SimpleNamespace(results=[])
+        return SimpleNamespace(results=[SimpleNamespace(alternatives=[SimpleNamespace(transcript=TRANSCRIPT)])])
+
+
+class MockDockerClient:
+    """Docker client stand-in for container_utils.set_docker_client, the engine images are always running and stopping them does nothing"""
+
+    def __init__(self, images=None):
+        images = DOCKER_IMAGES if images is None else images
+        self.containers = SimpleNamespace(list=lambda: [MockContainer(image) for image in images], run=self.run)
+
+    def run(self, image, **kwargs):
+        raise RuntimeError(f"{image} has no local stand-in")
+
+
+class MockContainer:
+    def __init__(self, image):
+        self.image = SimpleNamespace(tags=[image])
+
+    def stop(self):
+        pass
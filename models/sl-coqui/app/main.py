@@ -1,23 +1,29 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
-import tempfile
 from io import BytesIO
+import asyncio
+import time
+import contextlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
 from base64 import b64decode
 from stt import Model
+import numpy
 import soundfile
 
 app = FastAPI()
 
 
-def disk_in_memory(wav_bytes):
-    """
-    this spooled wav was chosen because it's much more efficient than writing to disk,
-    it effectively is writing to memory only and can still be read (by some applications) as a file
-    """
-    with tempfile.SpooledTemporaryFile() as spooled_wav:
-        spooled_wav.write(wav_bytes)
-        spooled_wav.seek(0)
-        return BytesIO(spooled_wav.read())
+# number of model instances, each in its own worker process running one file (or one /stream utterance) at a time
+MODELS = int(os.environ.get("COQUI_MODELS", os.cpu_count() or 1))
+# requests allowed to wait for a free model, beyond that the server answers 503 so clients back off rather than time out
+MAX_QUEUE = int(os.environ.get("COQUI_MAX_QUEUE", 2 * MODELS))
+# seconds sent in the Retry-After header of a 503
+RETRY_AFTER = int(os.environ.get("COQUI_RETRY_AFTER", 1))
+
+# content types accepted by /transcribe_raw, the body is the wav file itself
+RAW_CONTENT_TYPES = ("application/octet-stream", "audio/wav", "audio/x-wav", "audio/wave")
 
 
 class Audio(BaseModel):
@@ -31,7 +37,7 @@ async def healthcheck():
 
 
 class ASREngine(object):
-    def transcribe(self, bytes):
+    def transcribe(self, wav_bytes):
         raise NotImplementedError()
 
     def __str__(self):
@@ -47,10 +53,9 @@ class Coqui(ASREngine):
         # https://stt.readthedocs.io/en/latest/_downloads/67bac4343abf2261d69231fdaead59fb/client.py
         self.asr = Model("coqui-stt-0.9.3-models.pbmm")
 
-    def transcribe(self, bytes):
-
-        wav_bytes = b64decode(bytes.encode("utf-8"))
-        dm = disk_in_memory(wav_bytes)
+    def transcribe(self, wav_bytes):
+        # BytesIO shares the buffer of the bytes it is given rather than copying it
+        dm = BytesIO(wav_bytes)
 
         pcm, sample_rate = soundfile.read(dm, dtype="int16")
         assert sample_rate == 16000
@@ -59,23 +64,275 @@ class Coqui(ASREngine):
 
         return words
 
+    def start_stream(self):
+        self.stream = self.asr.createStream()
+
+    def feed_stream(self, pcm_bytes):
+        """Add the next piece of 16 bit pcm and return the transcript so far"""
+        self.stream.feedAudioContent(numpy.frombuffer(pcm_bytes, dtype=numpy.int16))
+        return self.stream.intermediateDecode()
+
+    def finish_stream(self):
+        stream, self.stream = self.stream, None
+        return stream.finishStream()
+
     def __str__(self):
         return "Coqui"
 
 
-engine = ASREngine.create()
+# the model of a worker process
+engine = None
+
+
+def init_worker():
+    global engine
+    engine = ASREngine.create()
+
+
+def transcribe_in_worker(wav_bytes):
+    return engine.transcribe(wav_bytes)
+
+
+def transcribe_timed_in_worker(wav_bytes):
+    start = time.perf_counter()
+    transcript = engine.transcribe(wav_bytes)
+    return transcript, time.perf_counter() - start
+
+
+def start_stream_in_worker():
+    engine.start_stream()
+
+
+def feed_stream_in_worker(pcm_bytes):
+    return engine.feed_stream(pcm_bytes)
+
+
+def finish_stream_in_worker():
+    return engine.finish_stream()
+
+
+# a single process executor per model rather than one pool, so that each /stream utterance keeps using the same model
+models = [ProcessPoolExecutor(max_workers=1, initializer=init_worker) for _ in range(MODELS)]
+# models not in use, made on startup as it belongs to the event loop
+free_models = None
+
+# requests being transcribed or waiting for a model, only changed on the event loop
+in_flight = 0
+
+
+@app.on_event("startup")
+async def start_models():
+    global free_models
+    free_models = asyncio.Queue()
+    # start the workers and load their models now rather than on the first requests
+    await asyncio.gather(*[asyncio.get_event_loop().run_in_executor(model, os.getpid) for model in models])
+    for model in models:
+        free_models.put_nowait(model)
+
+
+@app.on_event("shutdown")
+def stop_models():
+    for model in models:
+        model.shutdown()
+
+
+@contextlib.contextmanager
+def admitted(items=1):
+    """
+    Count the request's items as in flight, or reject it with a 503 if they don't fit in the free models and the queue.
+    A batch bigger than that is still taken by an idle server, otherwise it could never run.
+    """
+    global in_flight
+    if in_flight > 0 and in_flight + items > MODELS + MAX_QUEUE:
+        raise HTTPException(status_code=503, detail="All models are busy", headers={"Retry-After": str(RETRY_AFTER)})
+    in_flight += items
+    try:
+        yield
+    finally:
+        in_flight -= items
+
+
+@contextlib.asynccontextmanager
+async def checked_out_model():
+    """Wait for a free model and have it to ourselves until the block ends"""
+    model = await free_models.get()
+    try:
+        yield model
+    finally:
+        free_models.put_nowait(model)
+
+
+async def run_on(model, fn, *args):
+    """Run in the model's worker, the event loop stays free for other requests and /healthcheck"""
+    return await asyncio.get_event_loop().run_in_executor(model, fn, *args)
+
+
+async def run_transcribe(wav_bytes):
+    async with checked_out_model() as model:
+        return await run_on(model, transcribe_in_worker, wav_bytes)
+
+
+async def run_transcribe_timed(wav_bytes):
+    """run_transcribe but also returns the seconds the worker spent on it"""
+    async with checked_out_model() as model:
+        return await run_on(model, transcribe_timed_in_worker, wav_bytes)
 
 
 @app.post("/transcribe")
 async def transcribe(audio: Audio):
 
     try:
-        transcript = engine.transcribe(audio.b64_wav)
+        with admitted():
+            transcript = await run_transcribe(b64decode(audio.b64_wav))
         return {"transcript": transcript}
     except:
         raise
 
 
+@app.post("/transcribe_raw")
+async def transcribe_raw(request: Request):
+    """Same as /transcribe but the body is the raw wav, which avoids the base64/JSON encoding and decoding"""
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type not in RAW_CONTENT_TYPES:
+        raise HTTPException(status_code=415, detail=f"Content-Type must be one of {', '.join(RAW_CONTENT_TYPES)}")
+
+    with admitted():
+        transcript = await run_transcribe(await request.body())
+    return {"transcript": transcript}
+
+
+def split_batch(body: bytes, item_lengths: str) -> list:
+    """Cut the body of a /transcribe_batch request into its wavs"""
+    try:
+        lengths = [int(x) for x in item_lengths.split(",") if x.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="X-Item-Lengths must be a comma separated list of byte counts")
+    if not lengths or any(n <= 0 for n in lengths) or sum(lengths) != len(body):
+        raise HTTPException(status_code=400, detail=f"X-Item-Lengths add up to {sum(lengths)} but the body is {len(body)} bytes")
+    view = memoryview(body)
+    items, start = [], 0
+    for n in lengths:
+        items.append(view[start : start + n].tobytes())
+        start += n
+    return items
+
+
+@app.post("/transcribe_batch")
+async def transcribe_batch(request: Request):
+    """
+    Several wavs in one request, the body is the wavs one after another and the X-Item-Lengths header has the byte length
+    of each e.g. "32044,16044". The items are shared out between the models and the transcripts come back in the same
+    order with the seconds spent on each.
+    """
+    item_lengths = request.headers.get("x-item-lengths", "")
+    with admitted(items=item_lengths.count(",") + 1):
+        items = split_batch(await request.body(), item_lengths)
+        results = await asyncio.gather(*[run_transcribe_timed(wav_bytes) for wav_bytes in items])
+    return {"transcripts": [transcript for transcript, _ in results], "inf_times": [seconds for _, seconds in results]}
+
+
+class Utterance:
+    """
+    One utterance of a /stream connection. It has a model to itself from its first audio until the final result, so idle
+    sockets don't hold on to models.
+
+    Clients may send a wav file as is, so a wav header at the start is skipped (its sample rate is checked).
+    """
+
+    def __init__(self):
+        self.resources = contextlib.AsyncExitStack()
+        self.model = None
+        self.header_checked = False
+        self.leftover = b""
+
+    async def start(self):
+        try:
+            self.resources.enter_context(admitted())
+            self.model = await self.resources.enter_async_context(checked_out_model())
+            await run_on(self.model, start_stream_in_worker)
+        except BaseException:
+            await self.resources.aclose()
+            raise
+
+    async def feed(self, data: bytes) -> str:
+        if not self.header_checked:
+            self.header_checked = True
+            data = skip_wav_header(data)
+        # only whole 16 bit samples are decoded, an odd byte waits for the next message
+        data = self.leftover + data
+        cut = len(data) - len(data) % 2
+        self.leftover = data[cut:]
+        return await run_on(self.model, feed_stream_in_worker, data[:cut])
+
+    async def finish(self) -> str:
+        try:
+            return await run_on(self.model, finish_stream_in_worker)
+        finally:
+            await self.resources.aclose()
+
+
+def skip_wav_header(data: bytes) -> bytes:
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return data
+    position = 12
+    while position + 8 <= len(data):
+        chunk_id, chunk_size = data[position : position + 4], int.from_bytes(data[position + 4 : position + 8], "little")
+        if chunk_id == b"fmt ":
+            sample_rate = int.from_bytes(data[position + 12 : position + 16], "little")
+            if sample_rate != 16000:
+                raise ValueError(f"sample rate must be 16000 not {sample_rate}")
+        elif chunk_id == b"data":
+            return data[position + 8 :]
+        position += 8 + chunk_size + chunk_size % 2
+    raise ValueError("wav header must be in the first message")
+
+
+@app.websocket("/stream")
+async def stream(websocket: WebSocket):
+    """
+    Streaming recognition using the protocol of the vosk server: binary messages are 16kHz 16 bit mono audio and each
+    one is answered with {"partial": ...}. {"reset" : 1} is answered with the final {"text": ...} and the socket can be
+    used for the next utterance, {"eof" : 1} is answered the same way and the socket is closed.
+
+    Each utterance counts as one request in flight, when the queue is full the socket is closed with code 1013 (try again
+    later)
+    """
+    await websocket.accept()
+    utterance = None
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                if utterance is None:
+                    starting = Utterance()
+                    await starting.start()
+                    utterance = starting
+                try:
+                    partial = await utterance.feed(message["bytes"])
+                except ValueError as e:
+                    await websocket.close(code=1003, reason=str(e))
+                    break
+                await websocket.send_json({"partial": partial})
+            else:
+                command = json.loads(message.get("text") or "{}")
+                finishing, utterance = utterance, None
+                final = await finishing.finish() if finishing is not None else ""
+                await websocket.send_json({"text": final})
+                if "eof" in command:
+                    await websocket.close()
+                    break
+    except WebSocketDisconnect:
+        pass
+    except HTTPException:
+        await websocket.close(code=1013, reason="All models are busy")
+    finally:
+        if utterance is not None:
+            # the client went away part way through an utterance, end it so the model is ready for the next one
+            await utterance.finish()
+
+
 if __name__ == "__main__":
     import uvicorn
 
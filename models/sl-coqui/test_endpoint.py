@@ -8,12 +8,17 @@ import pprint as pp
 
 def main(endpoint, wav_location):
 
-    b64audio = base64.b64encode(open(wav_location, "rb").read()).decode("utf-8")
-    print(f"Length of b64 data is:{len(b64audio)}")
+    if endpoint.endswith("/transcribe_raw"):
+        wav_bytes = open(wav_location, "rb").read()
+        print(f"Length of wav data is:{len(wav_bytes)}")
+        r = requests.post(endpoint, data=wav_bytes, headers={"Content-Type": "audio/wav"})
+    else:
+        b64audio = base64.b64encode(open(wav_location, "rb").read()).decode("utf-8")
+        print(f"Length of b64 data is:{len(b64audio)}")
 
-    json_message = {"b64_wav": b64audio, "sr": 16000}
+        json_message = {"b64_wav": b64audio, "sr": 16000}
 
-    r = requests.post(endpoint, json=json_message)
+        r = requests.post(endpoint, json=json_message)
     print(f"Status code: {r.status_code}")
     try:
         response = r.json()
@@ -26,7 +31,7 @@ if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="This file reads in a wav file and prints a CURL best to be piped to a file")
-    parser.add_argument("--endpoint", default="/transcribe", type=str)
+    parser.add_argument("--endpoint", default="/transcribe", type=str, help="/transcribe (base64 JSON) or /transcribe_raw (wav body)")
     parser.add_argument("--host", default="http://localhost:3200", type=str)
     parser.add_argument("--wav", default="../../data/simple_test/wavs/109938_zebra_ch0_16k.wav", type=str)
     args = parser.parse_args()
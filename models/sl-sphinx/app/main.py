@@ -1,8 +1,7 @@
 from typing import Optional
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
-import tempfile
 from io import BytesIO
 from base64 import b64decode
 import soundfile
@@ -10,23 +9,24 @@ import soundfile
 # from pocketsphinx import get_model_path
 # from pocketsphinx.pocketsphinx import Decoder
 # from pocketsphinx import AudioFile
+import asyncio
+import contextlib
+import json
+import time
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pocketsphinx import get_model_path
 from pocketsphinx.pocketsphinx import Decoder
-import numpy as np
 
 app = FastAPI()
 
 
-def disk_in_memory(wav_bytes):
-    """
-    this spooled wav was chosen because it's much more efficient than writing to disk,
-    it effectively is writing to memory only and can still be read (by some applications) as a file
-    """
-    with tempfile.SpooledTemporaryFile() as spooled_wav:
-        spooled_wav.write(wav_bytes)
-        spooled_wav.seek(0)
-        return BytesIO(spooled_wav.read())
+# number of decoders. Each one lives in its own worker process (pocketsphinx holds the GIL while decoding) and a worker only
+# decodes one file (or one /stream utterance) at a time, so requests never share a decoder's utterance state
+DECODERS = int(os.environ.get("SPHINX_DECODERS", os.cpu_count() or 1))
+
+# content types accepted by /transcribe_raw, the body is the wav file itself
+RAW_CONTENT_TYPES = ("application/octet-stream", "audio/wav", "audio/x-wav", "audio/wave")
 
 
 class Audio(BaseModel):
@@ -40,7 +40,7 @@ async def healthcheck():
 
 
 class ASREngine(object):
-    def transcribe(self, bytes):
+    def transcribe(self, wav_bytes):
         raise NotImplementedError()
 
     def __str__(self):
@@ -62,19 +62,22 @@ class CMUPocketSphinxASREngine(ASREngine):
 
         self._decoder = Decoder(config)
 
-    def transcribe(self, bytes):
-
-        wav_bytes = b64decode(bytes.encode("utf-8"))
-        dm = disk_in_memory(wav_bytes)
+    def transcribe(self, wav_bytes):
+        # BytesIO shares the buffer of the bytes it is given rather than copying it
+        dm = BytesIO(wav_bytes)
 
-        pcm, sample_rate = soundfile.read(dm)
+        # read the samples as int16 straight away, going via float64 made two more full size copies
+        pcm, sample_rate = soundfile.read(dm, dtype="int16")
         assert sample_rate == 16000
-        pcm2 = (np.iinfo(np.int16).max * pcm).astype(np.int16).tobytes()
+        pcm2 = pcm.tobytes()
 
         self._decoder.start_utt()
         self._decoder.process_raw(pcm2, no_search=False, full_utt=True)
         self._decoder.end_utt()
 
+        return self.words()
+
+    def words(self):
         words = []
         for seg in self._decoder.seg():
             word = seg.word
@@ -89,23 +92,249 @@ class CMUPocketSphinxASREngine(ASREngine):
 
         return " ".join(words)
 
+    def start_stream(self):
+        self._decoder.start_utt()
+
+    def feed_stream(self, pcm_bytes):
+        """Decode the next piece of 16 bit pcm and return the best hypothesis so far"""
+        self._decoder.process_raw(pcm_bytes, no_search=False, full_utt=False)
+        hyp = self._decoder.hyp()
+        if hyp is None:
+            return ""
+        return " ".join("".join([x for x in word if x.isalpha()]) for word in hyp.hypstr.split())
+
+    def finish_stream(self):
+        self._decoder.end_utt()
+        return self.words()
+
     def __str__(self):
         return "CMUPocketSphinx"
 
 
-engine = ASREngine.create()
+# the decoder of a worker process
+engine = None
+
+
+def init_worker():
+    global engine
+    engine = ASREngine.create()
+
+
+def transcribe_in_worker(wav_bytes):
+    return engine.transcribe(wav_bytes)
+
+
+def transcribe_timed_in_worker(wav_bytes):
+    start = time.perf_counter()
+    transcript = engine.transcribe(wav_bytes)
+    return transcript, time.perf_counter() - start
+
+
+def start_stream_in_worker():
+    engine.start_stream()
+
+
+def feed_stream_in_worker(pcm_bytes):
+    return engine.feed_stream(pcm_bytes)
+
+
+def finish_stream_in_worker():
+    return engine.finish_stream()
+
+
+# a single process executor per decoder rather than one pool, so that each /stream utterance keeps using the same decoder
+decoders = [ProcessPoolExecutor(max_workers=1, initializer=init_worker) for _ in range(DECODERS)]
+# decoders not in use, made on startup as it belongs to the event loop
+free_decoders = None
+
+
+@app.on_event("startup")
+async def start_decoders():
+    global free_decoders
+    free_decoders = asyncio.Queue()
+    # start the workers and load their decoders now rather than on the first requests
+    await asyncio.gather(*[asyncio.get_event_loop().run_in_executor(decoder, os.getpid) for decoder in decoders])
+    for decoder in decoders:
+        free_decoders.put_nowait(decoder)
+
+
+@app.on_event("shutdown")
+def stop_decoders():
+    for decoder in decoders:
+        decoder.shutdown()
+
+
+@contextlib.asynccontextmanager
+async def checked_out_decoder():
+    """Wait for a free decoder and have it to ourselves until the block ends"""
+    decoder = await free_decoders.get()
+    try:
+        yield decoder
+    finally:
+        free_decoders.put_nowait(decoder)
+
+
+async def run_on(decoder, fn, *args):
+    """Run in the decoder's worker, the event loop stays free for other requests and /healthcheck"""
+    return await asyncio.get_event_loop().run_in_executor(decoder, fn, *args)
+
+
+async def run_transcribe(wav_bytes):
+    async with checked_out_decoder() as decoder:
+        return await run_on(decoder, transcribe_in_worker, wav_bytes)
+
+
+async def run_transcribe_timed(wav_bytes):
+    """run_transcribe but also returns the seconds the worker spent on it"""
+    async with checked_out_decoder() as decoder:
+        return await run_on(decoder, transcribe_timed_in_worker, wav_bytes)
 
 
 @app.post("/transcribe")
 async def transcribe(audio: Audio):
 
     try:
-        transcript = engine.transcribe(audio.b64_wav)
+        transcript = await run_transcribe(b64decode(audio.b64_wav))
         return {"transcript": transcript}
     except:
         raise
 
 
+@app.post("/transcribe_raw")
+async def transcribe_raw(request: Request):
+    """Same as /transcribe but the body is the raw wav, which avoids the base64/JSON encoding and decoding"""
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type not in RAW_CONTENT_TYPES:
+        raise HTTPException(status_code=415, detail=f"Content-Type must be one of {', '.join(RAW_CONTENT_TYPES)}")
+
+    transcript = await run_transcribe(await request.body())
+    return {"transcript": transcript}
+
+
+def split_batch(body: bytes, item_lengths: str) -> list:
+    """Cut the body of a /transcribe_batch request into its wavs"""
+    try:
+        lengths = [int(x) for x in item_lengths.split(",") if x.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="X-Item-Lengths must be a comma separated list of byte counts")
+    if not lengths or any(n <= 0 for n in lengths) or sum(lengths) != len(body):
+        raise HTTPException(status_code=400, detail=f"X-Item-Lengths add up to {sum(lengths)} but the body is {len(body)} bytes")
+    view = memoryview(body)
+    items, start = [], 0
+    for n in lengths:
+        items.append(view[start : start + n].tobytes())
+        start += n
+    return items
+
+
+@app.post("/transcribe_batch")
+async def transcribe_batch(request: Request):
+    """
+    Several wavs in one request, the body is the wavs one after another and the X-Item-Lengths header has the byte length
+    of each e.g. "32044,16044". The items are shared out between the decoders and the transcripts come back in the same
+    order with the seconds spent on each.
+    """
+    items = split_batch(await request.body(), request.headers.get("x-item-lengths", ""))
+    results = await asyncio.gather(*[run_transcribe_timed(wav_bytes) for wav_bytes in items])
+    return {"transcripts": [transcript for transcript, _ in results], "inf_times": [seconds for _, seconds in results]}
+
+
+class Utterance:
+    """
+    One utterance of a /stream connection. It has a decoder to itself from its first audio until the final result, so idle
+    sockets don't hold on to decoders.
+
+    Clients may send a wav file as is, so a wav header at the start is skipped (its sample rate is checked).
+    """
+
+    def __init__(self):
+        self.resources = contextlib.AsyncExitStack()
+        self.decoder = None
+        self.header_checked = False
+        self.leftover = b""
+
+    async def start(self):
+        try:
+            self.decoder = await self.resources.enter_async_context(checked_out_decoder())
+            await run_on(self.decoder, start_stream_in_worker)
+        except BaseException:
+            await self.resources.aclose()
+            raise
+
+    async def feed(self, data: bytes) -> str:
+        if not self.header_checked:
+            self.header_checked = True
+            data = skip_wav_header(data)
+        # only whole 16 bit samples are decoded, an odd byte waits for the next message
+        data = self.leftover + data
+        cut = len(data) - len(data) % 2
+        self.leftover = data[cut:]
+        return await run_on(self.decoder, feed_stream_in_worker, data[:cut])
+
+    async def finish(self) -> str:
+        try:
+            return await run_on(self.decoder, finish_stream_in_worker)
+        finally:
+            await self.resources.aclose()
+
+
+def skip_wav_header(data: bytes) -> bytes:
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return data
+    position = 12
+    while position + 8 <= len(data):
+        chunk_id, chunk_size = data[position : position + 4], int.from_bytes(data[position + 4 : position + 8], "little")
+        if chunk_id == b"fmt ":
+            sample_rate = int.from_bytes(data[position + 12 : position + 16], "little")
+            if sample_rate != 16000:
+                raise ValueError(f"sample rate must be 16000 not {sample_rate}")
+        elif chunk_id == b"data":
+            return data[position + 8 :]
+        position += 8 + chunk_size + chunk_size % 2
+    raise ValueError("wav header must be in the first message")
+
+
+@app.websocket("/stream")
+async def stream(websocket: WebSocket):
+    """
+    Streaming recognition using the protocol of the vosk server: binary messages are 16kHz 16 bit mono audio and each
+    one is answered with {"partial": ...}. {"reset" : 1} is answered with the final {"text": ...} and the socket can be
+    used for the next utterance, {"eof" : 1} is answered the same way and the socket is closed.
+    """
+    await websocket.accept()
+    utterance = None
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                if utterance is None:
+                    starting = Utterance()
+                    await starting.start()
+                    utterance = starting
+                try:
+                    partial = await utterance.feed(message["bytes"])
+                except ValueError as e:
+                    await websocket.close(code=1003, reason=str(e))
+                    break
+                await websocket.send_json({"partial": partial})
+            else:
+                command = json.loads(message.get("text") or "{}")
+                finishing, utterance = utterance, None
+                final = await finishing.finish() if finishing is not None else ""
+                await websocket.send_json({"text": final})
+                if "eof" in command:
+                    await websocket.close()
+                    break
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if utterance is not None:
+            # the client went away part way through an utterance, end it so the decoder is ready for the next one
+            await utterance.finish()
+
+
 if __name__ == "__main__":
     import uvicorn
 
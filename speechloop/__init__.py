@@ -22,7 +22,14 @@ def interactive_cli():
     The argparseing done in speechloop.arguments.run_arguments and core.py is where things are really done
 
     The purpose of this program is to guide the user through a quickstart wizard.
+
+    `speechloop loadtest ...` runs the load test of speechloop.loadtest instead.
     """
+    if len(sys.argv) > 1 and sys.argv[1] == "loadtest":
+        from speechloop.loadtest import loadtest_main
+
+        loadtest_main(sys.argv[2:])
+        return
 
     # todo in the future even the CLI should be able to take args - i started this but wasn't pleased with the structure
     # parser = argparse.ArgumentParser(description="SpeechLoop -> Interactive quickstart wizard CLI")
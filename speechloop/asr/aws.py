@@ -1,7 +1,9 @@
 from speechloop.asr.base_asr import ASR
-from speechloop.file_utils import disk_in_memory
+from speechloop.file_utils import AudioBuffer
 
 import asyncio
+import datetime
+import time
 
 try:
     from amazon_transcribe.client import TranscribeStreamingClient
@@ -9,67 +11,117 @@ try:
     from amazon_transcribe.model import TranscriptEvent
 except ImportError as e:
     print(f"Amazon not imported, for reason:{e}")
+    # lets the module import, Aws can't be used without amazon_transcribe
+    TranscriptResultStreamHandler = object
+
+# AWS allows 25 concurrent streams per account/region by default
+DEFAULT_MAX_STREAMS = 25
+
+
+class TranscriptCollector(TranscriptResultStreamHandler):
+    """
+    Collects the results of one stream. handle_events returns once AWS closes the output stream, which it does after the
+    last final result, so there is nothing to poll for.
+    """
+
+    def __init__(self, transcript_result_stream):
+        self._transcript_result_stream = transcript_result_stream
+        self.finals = []
+        self.last_partial = ""
+        self.start = time.monotonic()
+        # seconds from the start until the first words came back
+        self.first_partial = None
+
+    async def handle_transcript_event(self, transcript_event: "TranscriptEvent"):
+        for result in transcript_event.transcript.results:
+            if not result.alternatives:
+                continue
+            if self.first_partial is None and result.alternatives[0].transcript:
+                self.first_partial = time.monotonic() - self.start
+            if result.is_partial:
+                self.last_partial = result.alternatives[0].transcript
+            else:
+                self.finals.append(result.alternatives[0].transcript)
+
+    def transcript(self) -> str:
+        return " ".join(self.finals) if self.finals else self.last_partial
 
 
 class Aws(ASR):
-    def __init__(self):
+    """
+    :param client_factory: makes the streaming client, called once with region=. Defaults to amazon_transcribe's
+        TranscribeStreamingClient, anything with the same start_stream_transcription can be used instead e.g. a local
+        stand-in for testing offline
+    :param max_streams: max streams open at once, further files wait for one to finish
+    :param realtime: send the audio no faster than it would play rather than as fast as possible
+    """
+
+    def __init__(self, client_factory=None, max_streams=DEFAULT_MAX_STREAMS, realtime=False):
 
         super().__init__("aw", "cloud-api")
         # credentials will be auto retrieved from ~/.aws/credentials however in future should be overriden by param?
 
         self.longname = "aws"
         self.shortname = "aw"
-        self.handler = None
-        self.stream = None
+        self.region = "us-east-1"
+        self.language = "en-US"
+        self.chunk_size = 1024 * 16
+        self.client_factory = client_factory
+        self.max_streams = max_streams
+        self.realtime = realtime
         self.client = None
 
         if self.verbose:
             print(f"Using {self.longname}")
 
-    def execute_with_audio(self, audio):
-        audio_file = disk_in_memory(audio)
-        return asyncio.get_event_loop().run_until_complete(self.write_chunks(audio_file))
+    def engine_config(self):
+        return dict(super().engine_config(), region=self.region, language=self.language)
 
-    async def write_chunks(self, audio_file):
-
-        self.client = TranscribeStreamingClient(region="us-east-1")
-        self.stream = await self.client.start_stream_transcription(
-            language_code="en-US",
-            media_sample_rate_hz=16000,
-            media_encoding="pcm",
-        )
+    def get_client(self):
+        # one client (and its connection pool/credentials) for the whole run
+        if self.client is None:
+            factory = self.client_factory if self.client_factory is not None else TranscribeStreamingClient
+            self.client = factory(region=self.region)
+        return self.client
 
-        while True:
-            data = audio_file.read(1024 * 16)
-            if len(data) == 0:
-                await self.stream.input_stream.end_stream()
-                break
-            await self.stream.input_stream.send_audio_event(audio_chunk=data)
+    def stream_semaphore(self) -> asyncio.Semaphore:
+        return self.loop_resource("streams", lambda: asyncio.Semaphore(self.max_streams))
 
-        async for event in self.stream.output_stream:
-            if isinstance(event, TranscriptEvent):
-                result = await self.handle_transcript_event(event)
-            else:
-                print(event)
+    async def execute_with_audio_async(self, audio):
+        audio_file = AudioBuffer(audio)
+        async with self.stream_semaphore():
+            return await self.write_chunks(audio_file)
 
-        # todo this is not a very good implementation but quick first attempt
-        while True:
-            # wait until generator has been iterated over
-            await asyncio.sleep(0.1)
-            if result[-1].is_partial == False:
-                break
+    async def write_chunks(self, audio_file):
 
-        # await asyncio.sleep(0.1)
-        transcript = result[-1].alternatives[-1].transcript
+        # stream is kept local so that several files can be transcribed at once
+        stream = await self.get_client().start_stream_transcription(
+            language_code=self.language,
+            media_sample_rate_hz=self.sr,
+            media_encoding="pcm",
+        )
+        handler = TranscriptCollector(stream.output_stream)
+
+        async def send_audio():
+            # 16 bit mono
+            chunk_seconds = self.chunk_size / (self.sr * 2)
+            while True:
+                data = audio_file.read(self.chunk_size)
+                if len(data) == 0:
+                    await stream.input_stream.end_stream()
+                    break
+                await stream.input_stream.send_audio_event(audio_chunk=data)
+                if self.realtime:
+                    await asyncio.sleep(chunk_seconds)
+
+        # results are read while the audio is still being sent
+        await asyncio.gather(send_audio(), handler.handle_events())
+        first_partial = datetime.timedelta(seconds=handler.first_partial) if handler.first_partial is not None else None
+        self.add_stream_latency(first_partial, datetime.timedelta(seconds=time.monotonic() - handler.start))
+        transcript = handler.transcript()
 
         if transcript.endswith("."):
             # aws ends always with a period, let's kill it.
             transcript = transcript[:-1]
 
         return transcript
-
-    async def handle_transcript_event(self, transcript_event: TranscriptEvent):
-        # This handler can be implemented to handle transcriptions as needed.
-        # Here's an example to get started.
-        results = transcript_event.transcript.results
-        return results
@@ -1,4 +1,4 @@
-from speechloop.asr.base_asr import ASR
+from speechloop.asr.base_asr import ASR, run_sync
 from speechloop.asr.errors import APIKeyError
 
 import json
@@ -6,16 +6,17 @@ from time import monotonic
 from os import environ
 from urllib.parse import urlencode
 
-import requests
-
 
 class Azure(ASR):
     """
     Sign up to Speech service at: https://portal.azure.com
     create project and set one of the 2 keys to be passed in through OS ENV var: AZURE_KEY
+
+    :param url: recognition endpoint, defaults to the public one for self.location
+    :param credential_url: token endpoint, defaults to the public one for self.location
     """
 
-    def __init__(self, apikey=None):
+    def __init__(self, apikey=None, url=None, credential_url=None):
 
         super().__init__("az", "cloud-api")
         self.longname = "azure"
@@ -25,31 +26,40 @@ class Azure(ASR):
         self.language = "en-US"
         self.profanity = "False"
         self.start_time = monotonic()
-        self.credential_url = f"https://{self.location}.api.cognitive.microsoft.com/sts/v1.0/issueToken"
+        self.credential_url = credential_url or f"https://{self.location}.api.cognitive.microsoft.com/sts/v1.0/issueToken"
         settings = urlencode({"language": self.language, "format": "simple", "profanity": self.profanity})
-        self.url = f"https://{self.location}.stt.speech.microsoft.com/speech/recognition/conversation/cognitiveservices/v1?{settings}"
+        self.url = f"{url or f'https://{self.location}.stt.speech.microsoft.com/speech/recognition/conversation/cognitiveservices/v1'}?{settings}"
 
         self.renew_token()
 
         if self.verbose:
             print(f"Using {self.longname}")
 
+    def engine_config(self):
+        return dict(super().engine_config(), location=self.location, language=self.language, profanity=self.profanity)
+
     def now(self):
         return monotonic()
 
     def renew_token(self):
+        run_sync(self.renew_token_async())
+
+    async def renew_token_async(self):
         try:
-            cred_req = requests.post(
+            session = self.http_session()
+            async with session.post(
                 self.credential_url,
                 data=b"",
                 headers={
                     "Content-type": "application/x-www-form-urlencoded",
                     "Content-Length": "0",
-                    "Ocp-Apim-Subscription-Key": self.key,
+                    "Ocp-Apim-Subscription-Key": self.key or "",
                 },
-            )
-            if cred_req.status_code == 200:
-                self.access_token = cred_req.text
+            ) as cred_req:
+                status = cred_req.status
+                cred_text = await cred_req.text()
+            if status == 200:
+                self.access_token = cred_text
                 self.azure_cached_access_token = self.access_token
                 self.start_time = monotonic()
                 self.azure_cached_access_token_expiry = (
@@ -60,20 +70,21 @@ class Azure(ASR):
         except APIKeyError as e:
             raise APIKeyError(f"Error renewing token: {e}")
 
-    def execute_with_audio(self, audio):
+    async def execute_with_audio_async(self, audio):
 
         if self.now() > self.azure_cached_access_token_expiry:
-            self.renew_token()
-
-        req = requests.post(self.url, data=audio, headers={"Authorization": f"Bearer {self.access_token}", "Content-type": 'audio/wav; codec="audio/pcm"; samplerate=16000'})
+            await self.renew_token_async()
 
-        if req.status_code == 200:
-            result = json.loads(req.text)
-        else:
-            return self.return_error
+        session = self.http_session()
+        headers = {"Authorization": f"Bearer {self.access_token}", "Content-type": 'audio/wav; codec="audio/pcm"; samplerate=16000'}
+        async with session.post(self.url, data=audio, headers=headers) as req:
+            if req.status == 200:
+                result = json.loads(await req.text())
+            else:
+                return self.return_error()
 
         if "RecognitionStatus" not in result or result["RecognitionStatus"] != "Success" or "DisplayText" not in result:
-            return self.return_error
+            return self.return_error()
 
         res = result["DisplayText"].strip()
         final_result = res[:-1] if res.endswith(".") else res
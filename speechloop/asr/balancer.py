@@ -0,0 +1,168 @@
+import asyncio
+import contextlib
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List
+
+from speechloop.asr.base_asr import backoff_sleep
+from speechloop.engine_settings import parse_engine_settings
+
+# consecutive failed requests before a replica is ejected, and for how long
+DEFAULT_MAX_FAILURES = 3
+DEFAULT_EJECT_SECONDS = 30.0
+# times a request is sent while the server answers that it is busy
+MAX_BUSY_RETRIES = 60
+# errors sending a request that mean the replica is down, clients add their library's own
+CONNECT_FAILURES = (OSError, asyncio.TimeoutError)
+
+
+class Replica:
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.outstanding = 0
+        self.picks = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def __repr__(self):
+        return f"Replica({self.endpoint}, outstanding={self.outstanding})"
+
+
+class Lease:
+    """One request's use of a replica, call fail() if the replica was at fault (connection refused/dropped, 5xx)"""
+
+    def __init__(self, replica: Replica):
+        self.replica = replica
+        self.endpoint = replica.endpoint
+        self.failed = False
+
+    def fail(self):
+        self.failed = True
+
+
+class TryAgain(Exception):
+    """
+    Raised by a request sent with ReplicaBalancer.send to have it sent again after retry_after seconds, e.g. the server is
+    busy. result is returned if it still hasn't gone through after MAX_BUSY_RETRIES, otherwise the cause is raised
+    """
+
+    def __init__(self, retry_after: float = 1.0, result=None):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+        self.result = result
+
+
+class ReplicaBalancer:
+    """
+    Spreads an engine's requests over its replicas, each request goes to the healthy replica with the fewest requests
+    outstanding (ties go to the one picked least). A replica that fails max_failures requests in a row is ejected for
+    eject_seconds, after which it is tried again. When every replica is ejected they are all used rather than failing.
+
+    Used from the runner threads and event loops at once so the counts are kept under a lock.
+    """
+
+    def __init__(self, endpoints: List[str], max_failures: int = DEFAULT_MAX_FAILURES, eject_seconds: float = DEFAULT_EJECT_SECONDS):
+        assert len(endpoints) > 0, "at least one endpoint is needed"
+        self.replicas = [Replica(endpoint) for endpoint in endpoints]
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+
+    @property
+    def endpoints(self) -> List[str]:
+        return [replica.endpoint for replica in self.replicas]
+
+    def healthy(self) -> List[Replica]:
+        now = time.monotonic()
+        with self._lock:
+            return [replica for replica in self.replicas if replica.ejected_until <= now]
+
+    def pick(self) -> Replica:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [replica for replica in self.replicas if replica.ejected_until <= now] or self.replicas
+            replica = min(candidates, key=lambda r: (r.outstanding, r.picks))
+            replica.outstanding += 1
+            replica.picks += 1
+            return replica
+
+    def release(self, replica: Replica, failed: bool = False, counted: bool = True):
+        """End a request on the replica, failed ones count towards ejecting it and counted successes reset the count"""
+        with self._lock:
+            replica.outstanding -= 1
+            if not failed:
+                if counted:
+                    replica.failures = 0
+                return
+            if replica.ejected_until > time.monotonic():
+                # requests that were already in flight when it was ejected
+                return
+            replica.failures += 1
+            if replica.failures >= self.max_failures:
+                replica.failures = 0
+                replica.ejected_until = time.monotonic() + self.eject_seconds
+                print(f"Ejecting {replica.endpoint} for {self.eject_seconds}s after {self.max_failures} failed requests")
+
+    @contextlib.contextmanager
+    def request(self, failures=(OSError,)):
+        """
+        A replica for one request, its outstanding count covers the block. The request failed if lease.fail() was called
+        or one of failures was raised, other exceptions (e.g. cancellation) don't count either way.
+        """
+        lease = Lease(self.pick())
+        finished = False
+        try:
+            yield lease
+            finished = True
+        except failures:
+            lease.fail()
+            raise
+        finally:
+            self.release(lease.replica, failed=lease.failed, counted=finished)
+
+    async def send(self, request: Callable[[Lease], Awaitable], failures=CONNECT_FAILURES):
+        """
+        Await request(lease) on a replica until it goes through. A replica it can't reach (one of failures) is failed and
+        the request sent to another, once it has failed on as many replicas as there are in a row the error is raised.
+        TryAgain is waited out as back-off (see base_asr.track_backoff).
+        """
+        connect_failures, retries = 0, 0
+        while True:
+            with self.request(failures=failures) as lease:
+                try:
+                    return await request(lease)
+                except failures:
+                    lease.fail()
+                    connect_failures += 1
+                    if connect_failures >= len(self.replicas):
+                        raise
+                    continue
+                except TryAgain as again:
+                    # the replica was reached
+                    connect_failures = 0
+                    retries += 1
+                    if retries >= MAX_BUSY_RETRIES:
+                        if again.result is not None or again.__cause__ is None:
+                            return again.result
+                        raise again.__cause__
+                    retry_after = again.retry_after
+            if retry_after > 0:
+                await backoff_sleep(retry_after)
+
+
+def replica_endpoints(template: str, base_port: int, replicas: int) -> List[str]:
+    """Endpoints of replicas on consecutive ports from base_port, template has a {port} e.g. "ws://localhost:{port}" """
+    return [template.format(port=base_port + i) for i in range(replicas)]
+
+
+def parse_replicas(spec: str) -> Dict[str, int]:
+    """ "vs=4,cq=8" -> {"vs": 4, "cq": 8}"""
+    replicas = {code: int(value) for code, value in parse_engine_settings(spec, "Replicas").items()}
+    if any(n < 1 for n in replicas.values()):
+        raise ValueError(f"Replicas must be at least 1: {spec}")
+    return replicas
+
+
+def parse_endpoints(spec: str) -> Dict[str, List[str]]:
+    """ "vs=ws://a:2800|ws://b:2800,cq=http://a:3200" -> {"vs": ["ws://a:2800", "ws://b:2800"], "cq": ["http://a:3200"]}"""
+    return {code: [url.strip() for url in value.split("|") if url.strip()] for code, value in parse_engine_settings(spec, "Endpoints").items()}
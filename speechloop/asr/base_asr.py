@@ -1,12 +1,100 @@
 import time
 
-from speechloop.file_utils import valid_readable_file, disk_in_memory
+from speechloop.file_utils import valid_readable_file
 from speechloop.asr.container_utils import kill_container
 from speechloop.asr.errors import DEFAULT_ERROR
+from speechloop.call_stats import CallStats
+from speechloop.rate_limit import RateLimiter
 
 import abc
+import asyncio
+import contextlib
+import contextvars
 import datetime
+import hashlib
+import json
 import atexit
+import os
+import threading
+import weakref
+
+import aiohttp
+
+# default max connections each HTTP engine keeps open at once (aiohttp's own default)
+DEFAULT_POOL_SIZE = 100
+
+_BACKGROUND_LOOP = None
+_BACKGROUND_LOOP_LOCK = threading.Lock()
+# seconds slept by backoff_sleep inside track_backoff, the context is copied into run_sync so it follows the request
+_BACKOFF = contextvars.ContextVar("speechloop_backoff", default=None)
+# (first partial, final) of each file streamed inside track_stream_latency
+_STREAM_LATENCY = contextvars.ContextVar("speechloop_stream_latency", default=None)
+
+
+def background_loop():
+    """
+    A single event loop running forever in a daemon thread. All blocking (non async) calls into the async engines are run
+    here, which means they work from any thread, from inside an already running loop (e.g. jupyter) and that connections
+    can be kept open between files.
+    """
+    global _BACKGROUND_LOOP
+    with _BACKGROUND_LOOP_LOCK:
+        if _BACKGROUND_LOOP is None:
+            _BACKGROUND_LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_BACKGROUND_LOOP.run_forever, name="speechloop-loop", daemon=True).start()
+    return _BACKGROUND_LOOP
+
+
+def _forget_background_loop():
+    # a forked child has the parent's loop object but not the thread running it, it makes its own on first use
+    global _BACKGROUND_LOOP, _BACKGROUND_LOOP_LOCK
+    _BACKGROUND_LOOP = None
+    _BACKGROUND_LOOP_LOCK = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_background_loop)
+
+
+def run_sync(coro):
+    """
+    Block until the coroutine has finished on the background loop and return its result.
+    Must not be called from the background loop itself.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, background_loop()).result()
+
+
+@contextlib.contextmanager
+def track_backoff():
+    """Collect the time the engine calls made in the block spent backing off from a busy server, sum the yielded list"""
+    backoff = []
+    token = _BACKOFF.set(backoff)
+    try:
+        yield backoff
+    finally:
+        _BACKOFF.reset(token)
+
+
+@contextlib.contextmanager
+def track_stream_latency():
+    """Collect the latencies add_stream_latency records in the block, one per attempt at streaming the file"""
+    latencies = []
+    token = _STREAM_LATENCY.set(latencies)
+    try:
+        yield latencies
+    finally:
+        _STREAM_LATENCY.reset(token)
+
+
+async def backoff_sleep(seconds: float):
+    """Wait before retrying a busy server, the time is recorded against the request being tracked (see track_backoff)"""
+    start = time.monotonic()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        backoff = _BACKOFF.get()
+        if backoff is not None:
+            backoff.append(time.monotonic() - start)
 
 
 class ASR(metaclass=abc.ABCMeta):
@@ -17,23 +105,141 @@ class ASR(metaclass=abc.ABCMeta):
     """
 
     def __init__(self, name, asrtype, sr=16000):
+        # the defaults of these two call each other, without an implementation of one the first call never returns
+        cls = type(self)
+        if cls.execute_with_audio is ASR.execute_with_audio and cls.execute_with_audio_async is ASR.execute_with_audio_async:
+            raise TypeError(f"{cls.__name__} must implement execute_with_audio or execute_with_audio_async")
         self.init_starttime = datetime.datetime.now()
         self.name = name
         self.asrtype = asrtype
         self.init_finishtime = None
-        self.total_inf_time = datetime.datetime.now() - datetime.datetime.now()
+        self.total_inf_time = datetime.timedelta(0)
+        self.total_wait_time = datetime.timedelta(0)
+        self.total_backoff_time = datetime.timedelta(0)
+        self.cache_hits = 0
+        self.cache_saved_time = datetime.timedelta(0)
+        self.total_connect_time = datetime.timedelta(0)
+        self.connections_opened = 0
+        self.streamed_files = 0
+        self.first_partials = 0
+        self.total_first_partial_time = datetime.timedelta(0)
+        self.total_final_time = datetime.timedelta(0)
+        self.calls = CallStats()
+        self.pool_size = DEFAULT_POOL_SIZE
+        self.rate_limiter = RateLimiter()
+        self._time_lock = threading.Lock()
+        self._loop_resources = weakref.WeakKeyDictionary()
         self.verbose = True
         self.kill_containers_on_quit = True
         self.sr = sr
 
         if self.asrtype == "docker-local" and self.kill_containers_on_quit:
             atexit.register(self.kill)
+        atexit.register(self.close)
 
     def finish_init(self):
         self.init_finishtime = datetime.datetime.now()
 
     def add_time(self, time_to_add):
-        self.total_inf_time += time_to_add
+        # may be called from several runner threads at once
+        with self._time_lock:
+            self.total_inf_time += time_to_add
+
+    def add_wait_time(self, time_to_add):
+        """time spent waiting on the rate limiter, kept out of the inference time"""
+        with self._time_lock:
+            self.total_wait_time += time_to_add
+
+    def add_backoff_time(self, time_to_add):
+        """time spent waiting for a busy server (503 / 1013) before retrying, kept out of the inference time"""
+        with self._time_lock:
+            self.total_backoff_time += time_to_add
+
+    def add_cache_hit(self, saved_time=datetime.timedelta(0)):
+        """a transcript from the cache, saved_time is what the engine took for it originally and is not inference time"""
+        with self._time_lock:
+            self.cache_hits += 1
+            self.cache_saved_time += saved_time
+
+    def add_connect_time(self, time_to_add):
+        """time spent opening a new connection (DNS, TCP and TLS handshakes), this is included in the inference time"""
+        with self._time_lock:
+            self.total_connect_time += time_to_add
+            self.connections_opened += 1
+
+    def add_call(self, inf_time, attempts=1, duration=None, failed=False, stream_latency=None):
+        """
+        one file sent to the engine: its inference time, the requests it took, its audio duration in seconds, whether it
+        was still an error after the last of them and the (first partial, final) times of its last attempt if streamed
+        """
+        first_partial, final = stream_latency if stream_latency is not None else (None, None)
+        with self._time_lock:
+            self.calls.add(
+                inf_time.total_seconds(),
+                attempts,
+                duration,
+                failed,
+                first_partial.total_seconds() if first_partial is not None else None,
+                final.total_seconds() if final is not None else None,
+            )
+
+    def add_stream_latency(self, first_partial, final):
+        """
+        Latency of one streamed file, measured from the first audio sent: first_partial is when the first words came back
+        (None if none did before the end) and final is when the final result did. Inside track_stream_latency they are
+        also kept for the file's call
+        """
+        latencies = _STREAM_LATENCY.get()
+        if latencies is not None:
+            latencies.append((first_partial, final))
+        with self._time_lock:
+            self.streamed_files += 1
+            self.total_final_time += final
+            if first_partial is not None:
+                self.first_partials += 1
+                self.total_first_partial_time += first_partial
+
+    def run_stats(self) -> dict:
+        return {
+            "total_inf_time": self.total_inf_time,
+            "total_wait_time": self.total_wait_time,
+            "total_backoff_time": self.total_backoff_time,
+            "cache_hits": self.cache_hits,
+            "cache_saved_time": self.cache_saved_time,
+            "total_connect_time": self.total_connect_time,
+            "connections_opened": self.connections_opened,
+            "streamed_files": self.streamed_files,
+            "first_partials": self.first_partials,
+            "total_first_partial_time": self.total_first_partial_time,
+            "total_final_time": self.total_final_time,
+            "calls": self.calls.copy(),
+        }
+
+    def add_run_stats(self, stats: dict):
+        """merge the run_stats of another instance of this ASR (e.g. from a worker process)"""
+        self.add_time(stats["total_inf_time"])
+        self.add_wait_time(stats["total_wait_time"])
+        self.add_backoff_time(stats["total_backoff_time"])
+        with self._time_lock:
+            self.cache_hits += stats["cache_hits"]
+            self.cache_saved_time += stats["cache_saved_time"]
+            self.total_connect_time += stats["total_connect_time"]
+            self.connections_opened += stats["connections_opened"]
+            self.streamed_files += stats["streamed_files"]
+            self.first_partials += stats["first_partials"]
+            self.total_first_partial_time += stats["total_first_partial_time"]
+            self.total_final_time += stats["total_final_time"]
+            self.calls.extend(stats["calls"])
+
+    def engine_config(self) -> dict:
+        """
+        Everything that can change this ASR's transcript for the same audio. Engines with more settings (language, model
+        version...) should extend this.
+        """
+        return {"name": self.name, "asrtype": self.asrtype, "sr": self.sr, "dockerhub_url": getattr(self, "dockerhub_url", None)}
+
+    def config_fingerprint(self) -> str:
+        return hashlib.md5(json.dumps(self.engine_config(), sort_keys=True).encode("utf-8")).hexdigest()
 
     def return_error(self, error_msg=DEFAULT_ERROR):
         return error_msg
@@ -41,11 +247,84 @@ class ASR(metaclass=abc.ABCMeta):
     def kill(self):
         kill_container(self.dockerhub_url, verbose=self.verbose)
 
-    @abc.abstractmethod
+    def loop_resource(self, name, factory):
+        """
+        Sessions, sockets and asyncio locks belong to the event loop that created them, so keep one of each per loop.
+        Resources with a close() coroutine are closed by aclose. Must be called from inside a coroutine.
+        """
+        loop = asyncio.get_event_loop()
+        with self._time_lock:
+            resources = self._loop_resources.setdefault(loop, {})
+            if name not in resources:
+                resources[name] = factory()
+            return resources[name]
+
+    def http_session(self) -> aiohttp.ClientSession:
+        """
+        Keep-alive session of this ASR for the running loop, at most pool_size connections are open at once and requests
+        beyond that wait for a free one. Must be called from inside a coroutine.
+        """
+        return self.loop_resource("session", self._new_http_session)
+
+    def _new_http_session(self) -> aiohttp.ClientSession:
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_start.append(self._on_connection_create_start)
+        trace.on_connection_create_end.append(self._on_connection_create_end)
+        connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.pool_size)
+        return aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+
+    async def _on_connection_create_start(self, session, ctx, params):
+        ctx.connect_start = asyncio.get_event_loop().time()
+
+    async def _on_connection_create_end(self, session, ctx, params):
+        self.add_connect_time(datetime.timedelta(seconds=asyncio.get_event_loop().time() - ctx.connect_start))
+
+    def set_pool_size(self, pool_size: int):
+        """Change the max connections per session, open sessions are closed so the next request makes one with the new size"""
+        if pool_size != self.pool_size:
+            self.pool_size = pool_size
+            self.close()
+
+    async def aclose(self):
+        """Close any sessions/sockets that were opened on the running loop"""
+        resources = self._loop_resources.pop(asyncio.get_event_loop(), {})
+        for resource in resources.values():
+            if hasattr(resource, "close"):
+                await resource.close()
+
+    def close(self):
+        if _BACKGROUND_LOOP is not None and _BACKGROUND_LOOP.is_running():
+            run_sync(self.aclose())
+
     def execute_with_audio(self, audio):
-        pass
+        """
+        Blocking transcription of wav bytes. Engines with an async client only implement execute_with_audio_async,
+        which is run to completion here.
+        """
+        return run_sync(self.execute_with_audio_async(audio))
+
+    async def execute_with_audio_async(self, audio):
+        """
+        Async transcription of wav bytes. Engines with only a blocking client (e.g. google) implement execute_with_audio
+        instead and it is run in the loop's default executor so it doesn't block other engines.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.execute_with_audio, audio)
+
+    def execute_batch(self, audios):
+        return run_sync(self.execute_batch_async(audios))
+
+    async def execute_batch_async(self, audios):
+        """
+        Transcribe several wavs. Engines with a batch endpoint send them in one request, by default each one is sent on its
+        own, all at the same time.
+
+        :return: the transcripts in the same order, and the seconds the engine spent on each one or None if it doesn't say
+        """
+        return list(await asyncio.gather(*[self.execute_with_audio_async(audio) for audio in audios])), None
 
     def read_audio_file(self, path_to_audio):
         if valid_readable_file(path_to_audio):
-            audio = open(path_to_audio, "rb").read()
+            with open(path_to_audio, "rb") as f:
+                audio = f.read()
             return self.execute_with_audio(audio)
@@ -1,40 +1,184 @@
+import base64
+import os
+import socket
+import threading
 import time
+import urllib.error
+import urllib.request
 import warnings
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
+from speechloop.asr.errors import ContainerNotReady, DockerNotAvailable
 
-try:
-    import docker
+# seconds a container has to answer its ready check, cold starts load models before they do
+DEFAULT_READY_TIMEOUT = 120
+# seconds between ready checks
+POLL_INTERVAL = 0.25
 
-    DOCKER_CLIENT = docker.from_env()
-except Exception as e:
-    warnings.warn("Either docker is not installed OR the docker client cannot be connected to. " "This might be ok if using just APIs")
+# made on first use by docker_client(), or set with set_docker_client (e.g. a fake one in tests)
+DOCKER_CLIENT = None
+# host ports published by the running containers of each image tag, listed once and added to as containers are started
+_RUNNING = None
+_DOCKER_LOCK = threading.Lock()
+# held while an image is checked for and started, so an image asked for twice at once is only started once
+_IMAGE_LOCKS = defaultdict(threading.Lock)
 
 
-def launch_container(dockerhub_url, ports_dict, verbose=True, delay=5):
-    container_running = False
-    for container in DOCKER_CLIENT.containers.list():
-        if len(container.image.tags) > 0 and container.image.tags[-1] == dockerhub_url:
+def set_docker_client(client):
+    """Use this client rather than the one from the environment, anything with docker's containers.list/run will do"""
+    global DOCKER_CLIENT, _RUNNING
+    with _DOCKER_LOCK:
+        DOCKER_CLIENT = client
+        _RUNNING = None
+
+
+def docker_client():
+    global DOCKER_CLIENT
+    with _DOCKER_LOCK:
+        if DOCKER_CLIENT is None:
+            try:
+                import docker
+
+                DOCKER_CLIENT = docker.from_env()
+            except Exception as e:
+                warnings.warn("Either docker is not installed OR the docker client cannot be connected to. " "This might be ok if using just APIs")
+                raise DockerNotAvailable(f"Docker is needed for the local ASRs: {e}")
+        return DOCKER_CLIENT
+
+
+def host_ports(container) -> set:
+    """Host ports the container publishes, e.g. {"2800"}"""
+    ports = getattr(container, "ports", None) or {}
+    return {binding["HostPort"] for bindings in ports.values() if bindings for binding in bindings}
+
+
+def running_containers(refresh=False) -> dict:
+    """Image tag -> host ports of the running containers, docker is only asked once unless refresh"""
+    global _RUNNING
+    client = docker_client()
+    with _DOCKER_LOCK:
+        if _RUNNING is None or refresh:
+            _RUNNING = {}
+            for container in client.containers.list():
+                if len(container.image.tags) > 0:
+                    _RUNNING.setdefault(container.image.tags[-1], set()).update(host_ports(container))
+        return _RUNNING
+
+
+def running_images(refresh=False) -> set:
+    return set(running_containers(refresh))
+
+
+def is_running(dockerhub_url, ports_dict) -> bool:
+    """A container of the image is running on the host ports, containers that don't say which ports they publish match any"""
+    running = running_containers()
+    if dockerhub_url not in running:
+        return False
+    wanted = {str(port) for port in ports_dict.values()}
+    return not running[dockerhub_url] or wanted <= running[dockerhub_url]
+
+
+def cpu_share(replicas: int) -> int:
+    """CPUs of this machine for each of replicas containers, so that together they don't oversubscribe it"""
+    return max(1, (os.cpu_count() or 1) // replicas)
+
+
+def launch_container(dockerhub_url, ports_dict, verbose=True, ready_check=None, timeout=DEFAULT_READY_TIMEOUT, run_options=None):
+    """
+    Start the image unless a container of it is already running on the same host ports, then wait until ready_check (if
+    given) returns True
+
+    :param ready_check: called with no arguments until it returns True or timeout seconds have passed, see http_ready and
+        websocket_ready
+    :param run_options: more keyword arguments of docker's containers.run e.g. environment
+    """
+    client = docker_client()
+    with _DOCKER_LOCK:
+        image_lock = _IMAGE_LOCKS[dockerhub_url]
+    with image_lock:
+        if is_running(dockerhub_url, ports_dict):
             if verbose:
-                print(f"Docker container: {dockerhub_url} found running")
-            container_running = True
-
-    if not container_running:
-        if verbose:
-            print(f"Docker container: {dockerhub_url} NOT found... downloading and/or running...")
-        DOCKER_CLIENT.containers.run(
-            dockerhub_url,
-            detach=True,
-            ports=ports_dict,
-            restart_policy={"Name": "on-failure", "MaximumRetryCount": 5},
-        )
-        if verbose:
-            print(f"{dockerhub_url} Downloaded. Starting container...")
-        time.sleep(delay)
+                print(f"Docker container: {dockerhub_url} found running on {list(ports_dict.values())}")
+        else:
+            if verbose:
+                print(f"Docker container: {dockerhub_url} NOT found... downloading and/or running...")
+            client.containers.run(
+                dockerhub_url,
+                detach=True,
+                ports=ports_dict,
+                restart_policy={"Name": "on-failure", "MaximumRetryCount": 5},
+                **(run_options or {}),
+            )
+            with _DOCKER_LOCK:
+                _RUNNING.setdefault(dockerhub_url, set()).update(str(port) for port in ports_dict.values())
+            if verbose:
+                print(f"{dockerhub_url} Downloaded. Starting container...")
+
+    if ready_check is not None:
+        wait_until_ready(ready_check, dockerhub_url, timeout, verbose)
+
+
+def launch_replicas(dockerhub_url, container_port, ports, ready_checks, verbose=True, timeout=DEFAULT_READY_TIMEOUT, run_options=None):
+    """A container of the image for each host port, started and waited for at the same time"""
+
+    def launch(port, ready_check):
+        launch_container(dockerhub_url, {container_port: port}, verbose=verbose, ready_check=ready_check, timeout=timeout, run_options=run_options)
+
+    with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        list(pool.map(launch, ports, ready_checks))
+
+
+def wait_until_ready(ready_check, name, timeout=DEFAULT_READY_TIMEOUT, verbose=True):
+    start = time.monotonic()
+    while not ready_check():
+        if time.monotonic() - start > timeout:
+            raise ContainerNotReady(f"{name} was not ready after {timeout}s")
+        time.sleep(POLL_INTERVAL)
+    if verbose:
+        print(f"{name} ready after {time.monotonic() - start:.1f}s")
+
+
+def http_ready(url, request_timeout=2):
+    """A ready check that passes once a GET of url answers 200, e.g. the model servers' /healthcheck"""
+
+    def check():
+        try:
+            with urllib.request.urlopen(url, timeout=request_timeout) as r:
+                return r.status == 200
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            return False
+
+    return check
+
+
+def websocket_ready(uri, request_timeout=2):
+    """A ready check that passes once a websocket handshake with uri succeeds (the server answers 101), e.g. vosk"""
+    parsed = urlparse(uri)
+    host, port, path = parsed.hostname, parsed.port or 80, parsed.path or "/"
+    handshake = (
+        f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        f"Sec-WebSocket-Key: {base64.b64encode(os.urandom(16)).decode()}\r\nSec-WebSocket-Version: 13\r\n\r\n"
+    ).encode()
+
+    def check():
+        try:
+            with socket.create_connection((host, port), timeout=request_timeout) as s:
+                s.sendall(handshake)
+                return s.recv(1024).split(b"\r\n", 1)[0].split(b" ")[1:2] == [b"101"]
+        except (OSError, IndexError):
+            return False
+
+    return check
 
 
 def kill_container(dockerhub_url, verbose=True):
-    for container in DOCKER_CLIENT.containers.list():
+    for container in docker_client().containers.list():
         if len(container.image.tags) > 0 and container.image.tags[-1] == dockerhub_url:
             if verbose:
                 print(f"Docker container: {dockerhub_url} found. Killing...")
             container.stop()
+    with _DOCKER_LOCK:
+        if _RUNNING is not None:
+            _RUNNING.pop(dockerhub_url, None)
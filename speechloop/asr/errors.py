@@ -10,4 +10,12 @@ class APIKeyError(Exception):
     pass
 
 
+class DockerNotAvailable(Exception):
+    pass
+
+
+class ContainerNotReady(Exception):
+    pass
+
+
 DEFAULT_ERROR = "<asr_error>"
@@ -13,12 +13,19 @@ except ImportError as e:
 
 
 class Google(ASR):
-    def __init__(self, apikey=None):
+    """
+    :param client: anything with SpeechClient's recognize, e.g. a local stand-in. Credentials are only needed when it
+        isn't given
+    """
+
+    def __init__(self, apikey=None, client=None):
 
         super().__init__("gg", "cloud-api")
         # Check GOOGLE_APPLICATION_CREDENTIALS
 
-        if apikey and valid_readable_file(apikey, quiet=True):
+        if client is not None:
+            pass
+        elif apikey and valid_readable_file(apikey, quiet=True):
             environ["GOOGLE_APPLICATION_CREDENTIALS"] = apikey
         else:
             if valid_readable_file("../models/google/google.json", quiet=True) and environ.get("GOOGLE_APPLICATION_CREDENTIALS") is None:
@@ -30,7 +37,7 @@ class Google(ASR):
                 )
                 raise InvalidConfigPath
 
-        self.client = speech.SpeechClient()
+        self.client = client if client is not None else speech.SpeechClient()
         self.longname = "google"
         self.shortname = "gg"
         self.configpath = environ.get("GOOGLE_APPLICATION_CREDENTIALS")
@@ -44,6 +51,9 @@ class Google(ASR):
         if self.verbose:
             print(f"Using {self.longname} with config: {self.configpath}")
 
+    def engine_config(self):
+        return dict(super().engine_config(), recognition_config=str(self.recognition_config))
+
     def execute_with_audio(self, audio):
 
         rec_audio = speech.RecognitionAudio(content=audio)
@@ -54,7 +64,7 @@ class Google(ASR):
             transcript_list.append(result.alternatives[0].transcript)
 
         if len(transcript_list) == 0:
-            transcript = self.return_error
+            transcript = self.return_error()
         else:
             transcript = " ".join(transcript_list)
 
@@ -0,0 +1,131 @@
+from speechloop.asr import balancer
+from speechloop.asr.balancer import ReplicaBalancer, TryAgain, replica_endpoints
+from speechloop.asr.base_asr import ASR
+from speechloop.asr.container_utils import cpu_share, http_ready, launch_replicas
+from speechloop.asr.streaming import DEFAULT_CHUNK_SIZE, WebsocketStreamer
+from speechloop.file_utils import AudioBuffer
+
+import atexit
+import base64
+import json
+import warnings
+
+import aiohttp
+
+# errors sending a request that mean the server (replica) is down
+CONNECT_FAILURES = balancer.CONNECT_FAILURES + (aiohttp.ClientConnectionError,)
+
+
+class ModelServerASR(ASR):
+    """
+    Client for the FastAPI model servers in models/ (sphinx, coqui) which all have the same endpoints:
+    /transcribe (base64 wav in JSON), /transcribe_raw (the wav as the body) and /transcribe_batch (several wavs in one body)
+
+    Images built before /transcribe_raw or /transcribe_batch existed answer 404, the client then falls back to the older
+    endpoint for the rest of the run.
+
+    Requests are spread over the server's replicas with a ReplicaBalancer, a request that can't connect to one is sent to
+    another.
+
+    :param streaming_mode: None sends whole files over HTTP, otherwise one of asr.streaming.STREAMING_MODES and files are
+        streamed in chunks of chunk_size to the /stream websocket, recording the time to the first partial and the final
+    :param replicas: number of containers to run, on consecutive ports from port
+    :param endpoints: base URLs of servers started outside SpeechLoop e.g. ["http://10.0.0.2:3200"], no containers are
+        started (or stopped) when these are given
+    """
+
+    def __init__(self, name, port, streaming_mode=None, chunk_size=DEFAULT_CHUNK_SIZE, replicas=1, endpoints=None):
+        super().__init__(name, "docker-local")
+        self.port = port
+        self.external = bool(endpoints)
+        self.endpoints = [e.rstrip("/") for e in endpoints] if self.external else replica_endpoints("http://localhost:{port}", port, replicas)
+        self.balancer = ReplicaBalancer(self.endpoints)
+        self.use_raw_endpoint = True
+        self.use_batch_endpoint = True
+        self.streaming_mode = streaming_mode
+        self.chunk_size = chunk_size
+        stream_uris = [e.replace("http", "ws", 1) + "/stream" for e in self.endpoints]
+        self.streamer = WebsocketStreamer(self, stream_uris, chunk_size, streaming_mode) if streaming_mode else None
+
+    def launch_containers(self, container_port, workers_env):
+        """
+        Run a container for each replica and wait until they are all ready. The servers load a model per CPU by default,
+        so each replica is told with workers_env to load only its share of them
+        """
+        if self.external:
+            atexit.unregister(self.kill)
+            return
+        ready_checks = [http_ready(f"{endpoint}/healthcheck") for endpoint in self.endpoints]
+        ports = [self.port + i for i in range(len(self.endpoints))]
+        environment = {workers_env: str(cpu_share(len(ports)))}
+        launch_replicas(self.dockerhub_url, container_port, ports, ready_checks, verbose=self.verbose, run_options={"environment": environment})
+
+    def engine_config(self):
+        if self.streamer is None:
+            return super().engine_config()
+        # partial decoding can give a different transcript to decoding the whole file
+        return dict(super().engine_config(), streaming=True, chunk_size=self.chunk_size)
+
+    async def execute_with_audio_async(self, audio):
+        if self.streamer is not None:
+            return await self.streamer.transcribe(AudioBuffer(audio))
+
+        if self.use_raw_endpoint:
+            status, body = await self.post("/transcribe_raw", data=audio, headers={"Content-Type": "audio/wav"})
+            if status != 404:
+                return self.read_response(status, body)
+            self.use_raw_endpoint = False
+
+        b64 = base64.b64encode(audio).decode("utf-8")
+        json_message = {"b64_wav": b64, "sr": 16000}
+        return self.read_response(*await self.post("/transcribe", json=json_message))
+
+    async def execute_batch_async(self, audios):
+        if self.use_batch_endpoint and self.streamer is None:
+            headers = {"Content-Type": "application/octet-stream", "X-Item-Lengths": ",".join(str(len(audio)) for audio in audios)}
+            status, body = await self.post("/transcribe_batch", data=b"".join(audios), headers=headers)
+            if status == 200:
+                try:
+                    result = json.loads(body)
+                    return result["transcripts"], result["inf_times"]
+                except (KeyError, ValueError) as e:
+                    warnings.warn(f"Engine did not return transcripts: {e}")
+                    return [self.return_error()] * len(audios), None
+            elif status != 404:
+                return [self.return_error()] * len(audios), None
+            self.use_batch_endpoint = False
+        return await super().execute_batch_async(audios)
+
+    async def post(self, path, **kwargs):
+        """
+        :return: status and body of the response from one of the replicas. While the server is busy (503) wait for its
+            Retry-After and try again, up to balancer.MAX_BUSY_RETRIES times
+        """
+        session = self.http_session()
+
+        async def send(lease):
+            async with session.post(lease.endpoint + path, **kwargs) as r:
+                status, body = r.status, await r.read()
+                retry_after = r.headers.get("Retry-After", 1)
+            if status == 503:
+                try:
+                    retry_after = float(retry_after)
+                except ValueError:
+                    retry_after = 1.0
+                raise TryAgain(retry_after, result=(status, body))
+            if status >= 500:
+                lease.fail()
+            return status, body
+
+        return await self.balancer.send(send, failures=CONNECT_FAILURES)
+
+    def read_response(self, status, body):
+        if status == 200:
+            try:
+                response = json.loads(body)["transcript"]
+                return response
+            except (KeyError, ValueError) as e:
+                warnings.warn(f"Engine did not return transcript: {e}")
+                return self.return_error()
+        else:
+            return self.return_error()
@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from speechloop.asr.errors import AsrNotRecognized
 from speechloop.asr.vosk import Vosk
 from speechloop.asr.sphinx import Sphinx
@@ -7,26 +9,30 @@ from speechloop.asr.aws import Aws
 from speechloop.asr.azure import Azure
 
 
-def create_model_objects(wanted_asr: list) -> list:
-    list_of_asr = []
+ENGINES = {"vs": Vosk, "sp": Sphinx, "cq": Coqui, "gg": Google, "aw": Aws, "az": Azure}
+
+
+def create_model_objects(wanted_asr: list, asr_options: dict = None) -> list:
+    """
+    The engines are made at the same time, so their containers start (and load their models) concurrently rather than
+    one after another. The list is in the order asked for.
+
+    :param asr_options: optional engine settings by shortcode, passed to the engine's constructor
+        e.g. {"vs": {"chunk_size": 8000, "streaming_mode": "realtime"}}
+    """
+    options = asr_options or {}
 
     print(wanted_asr)
+    codes = []
     for asr in wanted_asr:
         if asr == "all":
-            list_of_asr = [Vosk(), Sphinx(), Coqui(), Google(), Aws(), Azure()]
-        elif asr == "vs":
-            list_of_asr.append(Vosk())
-        elif asr == "sp":
-            list_of_asr.append(Sphinx())
-        elif asr == "cq":
-            list_of_asr.append(Coqui())
-        elif asr == "gg":
-            list_of_asr.append(Google())
-        elif asr == "aw":
-            list_of_asr.append(Aws())
-        elif asr == "az":
-            list_of_asr.append(Azure())
+            codes = list(ENGINES)
+        elif asr in ENGINES:
+            codes.append(asr)
         else:
             raise AsrNotRecognized("ASR not recognised")
 
-    return list_of_asr
+    if not codes:
+        return []
+    with ThreadPoolExecutor(max_workers=len(codes)) as pool:
+        return list(pool.map(lambda code: ENGINES[code](**options.get(code, {})), codes))
@@ -1,36 +1,16 @@
-from speechloop.asr.base_asr import ASR
-from speechloop.asr.container_utils import launch_container
+from speechloop.asr.model_server import ModelServerASR
+from speechloop.asr.streaming import DEFAULT_CHUNK_SIZE
 
-import base64
-import warnings
 
-import requests
-
-
-class Sphinx(ASR):
+class Sphinx(ModelServerASR):
     """
     Vosk
     """
 
-    def __init__(self):
-        super().__init__("sp", "docker-local")
-        self.uri = "http://localhost:3000/transcribe"
+    def __init__(self, streaming_mode=None, chunk_size=DEFAULT_CHUNK_SIZE, replicas=1, endpoints=None):
+        super().__init__("sp", 3000, streaming_mode, chunk_size, replicas, endpoints)
         self.dockerhub_url = "ghcr.io/robmsmt/speechloop/sl-sphinx-en-16k:latest"
         self.shortname = self.dockerhub_url.rsplit("/")[-1].rsplit(":")[0]
         self.longname = "sphinx"
-        launch_container(self.dockerhub_url, {"3000/tcp": 3000}, verbose=self.verbose, delay=2)
+        self.launch_containers("3000/tcp", "SPHINX_DECODERS")
         self.finish_init()
-
-    def execute_with_audio(self, audio):
-        b64 = base64.b64encode(audio).decode("utf-8")
-        json_message = {"b64_wav": b64, "sr": 16000}
-        r = requests.post(self.uri, json=json_message)
-        if r.status_code == 200:
-            try:
-                response = r.json()["transcript"]
-                return response
-            except Exception as e:
-                warnings.warn(f"Engine did not return transcript: {e}")
-                return self.return_error()
-        else:
-            return self.return_error()
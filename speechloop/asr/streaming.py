@@ -0,0 +1,208 @@
+import asyncio
+import datetime
+import json
+import time
+
+# ext packages
+import websockets
+from websockets.exceptions import ConnectionClosed, InvalidHandshake
+
+from speechloop.asr import balancer
+from speechloop.asr.balancer import ReplicaBalancer, TryAgain
+
+# lockstep: send a chunk and wait for its reply before the next one
+# pipelined: chunks are sent as fast as the socket allows while the replies are read at the same time
+# realtime: pipelined but chunks are sent no faster than the audio would play, like a live microphone
+STREAMING_MODES = ["lockstep", "pipelined", "realtime"]
+DEFAULT_CHUNK_SIZE = 1024 * 16
+# close code of a server with no free model, the file is tried again on a new socket after a second
+TRY_AGAIN_LATER = 1013
+# errors opening a socket that mean the server (replica) is down
+CONNECT_FAILURES = balancer.CONNECT_FAILURES + (InvalidHandshake,)
+
+
+class WebsocketPool:
+    """
+    Open websockets to one server that are reused from file to file, each socket is only used by one file at a time.
+    A new socket is opened when all of them are busy, so there are never more than the number of files in flight.
+    """
+
+    def __init__(self, uri, asr):
+        self.uri = uri
+        self.asr = asr
+        self.idle = []
+
+    async def connect(self):
+        start = time.monotonic()
+        websocket = await websockets.connect(self.uri)
+        self.asr.add_connect_time(datetime.timedelta(seconds=time.monotonic() - start))
+        return websocket
+
+    async def get(self):
+        return self.idle.pop() if self.idle else await self.connect()
+
+    def put(self, websocket):
+        self.idle.append(websocket)
+
+    async def close(self):
+        idle, self.idle = self.idle, []
+        for websocket in idle:
+            await websocket.close()
+
+
+class StreamTimer:
+    """Time from the first chunk sent to the first reply with any words in it, and to the final result"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.first_partial = None
+        self.final = None
+
+    def reply(self, reply, final=False):
+        now = datetime.timedelta(seconds=time.monotonic() - self.start)
+        if self.first_partial is None and (reply.get("partial") or reply.get("text")):
+            self.first_partial = now
+        if final:
+            self.final = now
+
+
+class WebsocketStreamer:
+    """
+    Streams files to a server that speaks the vosk server protocol: binary chunks of audio are each answered with a partial
+    (or a result the server finalized along the way) and {"reset" : 1} is answered with the final result. Used by Vosk
+    and by the /stream endpoint of the sphinx and coqui servers.
+
+    Each file is finished with a reset rather than an eof, which gives the final result but keeps the socket (and the
+    recognizer the server made for it) open for the next file. The time to the first partial and to the final result of
+    every file are added to the ASR's stream stats.
+
+    Files are spread over the server's replicas (if it has more than one) by a ReplicaBalancer, each replica has its own
+    pool of sockets.
+    """
+
+    def __init__(self, asr, uris, chunk_size=DEFAULT_CHUNK_SIZE, streaming_mode="pipelined"):
+        """
+        :param uris: the server's websocket uri, or a list of them (or a ReplicaBalancer) to spread files over replicas
+        """
+        assert streaming_mode in STREAMING_MODES, f"streaming_mode must be one of {STREAMING_MODES}"
+        self.asr = asr
+        if isinstance(uris, ReplicaBalancer):
+            self.balancer = uris
+        else:
+            self.balancer = ReplicaBalancer([uris] if isinstance(uris, str) else list(uris))
+        self.chunk_size = chunk_size
+        self.streaming_mode = streaming_mode
+
+    @property
+    def uri(self):
+        return self.balancer.endpoints[0]
+
+    def pool(self, uri) -> WebsocketPool:
+        return self.asr.loop_resource(f"websockets {uri}", lambda: WebsocketPool(uri, self.asr))
+
+    async def transcribe(self, audio_file):
+        reconnected = False
+
+        async def send(lease):
+            nonlocal reconnected
+            pool = self.pool(lease.endpoint)
+            websocket = await (pool.connect() if reconnected else pool.get())
+            audio_file.seek(0)
+            try:
+                result = await self.transcribe_on_socket(websocket, audio_file)
+            except ConnectionClosed as e:
+                # the socket may be part way through a file, don't hand it to the next one
+                await websocket.close()
+                if e.rcvd is not None and e.rcvd.code == TRY_AGAIN_LATER:
+                    # every model on the server is busy, wait like an HTTP 503
+                    raise TryAgain(1) from e
+                if not reconnected:
+                    # the socket was dropped while it sat in the pool (e.g. the server restarted), try again on a new one
+                    reconnected = True
+                    raise TryAgain(0) from e
+                lease.fail()
+                raise
+            except BaseException:
+                await websocket.close()
+                raise
+            pool.put(websocket)
+            return result
+
+        return await self.balancer.send(send, failures=CONNECT_FAILURES)
+
+    async def transcribe_on_socket(self, websocket, audio_file):
+        timer = StreamTimer()
+        if self.streaming_mode == "lockstep":
+            replies = await self.send_lockstep(websocket, audio_file, timer)
+        else:
+            replies = await self.send_pipelined(websocket, audio_file, timer, realtime=self.streaming_mode == "realtime")
+        self.asr.add_stream_latency(timer.first_partial, timer.final)
+        return self.combine_replies(replies)
+
+    async def send_lockstep(self, websocket, audio_file, timer):
+        replies = []
+        for data in audio_file.chunks(self.chunk_size):
+            await websocket.send(data)
+            replies.append(json.loads(await websocket.recv()))
+            timer.reply(replies[-1])
+
+        await websocket.send('{"reset" : 1}')
+        replies.append(json.loads(await websocket.recv()))
+        timer.reply(replies[-1], final=True)
+        return replies
+
+    async def send_pipelined(self, websocket, audio_file, timer, realtime=False):
+        """
+        A sender task streams the chunks while a receiver task reads the replies. The server replies once to every message
+        so the reply to the reset is the one after a reply to every chunk.
+        """
+        # 16 bit mono
+        chunk_seconds = self.chunk_size / (self.asr.sr * 2)
+        sent = {"messages": 0, "done": False}
+        replies = []
+
+        async def sender():
+            # counted before sending, the reply can be read before send returns
+            for data in audio_file.chunks(self.chunk_size):
+                sent["messages"] += 1
+                await websocket.send(data)
+                if realtime:
+                    await asyncio.sleep(chunk_seconds)
+            sent["messages"] += 1
+            sent["done"] = True
+            await websocket.send('{"reset" : 1}')
+
+        async def receiver():
+            while not sent["done"] or len(replies) < sent["messages"]:
+                replies.append(json.loads(await websocket.recv()))
+                timer.reply(replies[-1], final=sent["done"] and len(replies) == sent["messages"])
+
+        tasks = [asyncio.ensure_future(sender()), asyncio.ensure_future(receiver())]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return replies
+
+    @staticmethod
+    def combine_replies(replies):
+        """The last reply is the final result, earlier ones are partials or results the server finalized along the way"""
+        all_finals = ""
+        all_partials = []
+        for reply in replies[:-1]:
+            if "partial" in reply:
+                if reply["partial"]:
+                    all_partials.append(reply["partial"])
+            else:
+                all_finals += reply["text"] + " "
+        final_result = replies[-1]["text"]
+
+        if len(all_finals) > 0 and len(final_result) == 0:
+            return all_finals
+        elif len(all_finals) > 0 and len(final_result) > 0:
+            return all_finals + f" {final_result}"
+        elif len(final_result) == 0 and len(all_partials) > 0:
+            return all_partials[-1]
+        else:
+            return final_result
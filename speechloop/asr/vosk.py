@@ -1,59 +1,45 @@
+from speechloop.asr.balancer import replica_endpoints
 from speechloop.asr.base_asr import ASR
-from speechloop.asr.container_utils import launch_container
-from speechloop.file_utils import disk_in_memory
+from speechloop.asr.container_utils import cpu_share, launch_replicas, websocket_ready
+from speechloop.asr.streaming import DEFAULT_CHUNK_SIZE, STREAMING_MODES, WebsocketStreamer
+from speechloop.file_utils import AudioBuffer
 
-import json
-import asyncio
+import atexit
 
-# ext packages
-import websockets
+PORT = 2800
 
 
 class Vosk(ASR):
     """
     Vosk
+
+    :param replicas: number of containers to run, on consecutive ports from 2800
+    :param endpoints: websocket uris of servers started outside SpeechLoop e.g. ["ws://10.0.0.2:2700"], no containers are
+        started (or stopped) when these are given
     """
 
-    def __init__(self):
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, streaming_mode="pipelined", replicas=1, endpoints=None):
         super().__init__("vs", "docker-local")
-        self.uri = "ws://localhost:2800"
+        self.chunk_size = chunk_size
+        self.streaming_mode = streaming_mode
+        self.endpoints = list(endpoints) if endpoints else replica_endpoints("ws://localhost:{port}", PORT, replicas)
+        self.uri = self.endpoints[0]
+        self.streamer = WebsocketStreamer(self, self.endpoints, chunk_size, streaming_mode)
         self.dockerhub_url = "ghcr.io/robmsmt/speechloop/sl-vosk-en-16k:latest"
         self.shortname = self.dockerhub_url.rsplit("/")[-1].rsplit(":")[0]
         self.longname = "vosk"
         self.container_found = False
-        launch_container(self.dockerhub_url, {"2700/tcp": 2800}, verbose=self.verbose, delay=5)
+        if endpoints:
+            atexit.unregister(self.kill)
+        else:
+            ports = [PORT + i for i in range(replicas)]
+            # the vosk server has a thread per CPU and no setting for it, so each replica's CPU time is capped instead
+            run_options = {"nano_cpus": cpu_share(replicas) * 10**9}
+            launch_replicas(self.dockerhub_url, "2700/tcp", ports, [websocket_ready(uri) for uri in self.endpoints], verbose=self.verbose, run_options=run_options)
         self.finish_init()
 
-    def execute_with_audio(self, audio):
-        audio_file = disk_in_memory(audio)
-        return asyncio.get_event_loop().run_until_complete(self.send_websocket(audio_file))
-
-    async def send_websocket(self, audio_file):
-        async with websockets.connect(self.uri) as websocket:
-            all_finals = ""
-            all_partials = []
-            while True:
-                partial = None
-                data = audio_file.read(1024 * 16)
-                if len(data) == 0:
-                    break
-                await websocket.send(data)
-                try:
-                    partial_json = json.loads(await websocket.recv())
-                    partial = partial_json["partial"]
-                    if partial:
-                        all_partials.append(partial)
-                except KeyError:
-                    all_finals += partial_json["text"] + " "
-
-            await websocket.send('{"eof" : 1}')
-            final_result = json.loads(await websocket.recv())["text"]
-
-            if len(all_finals) > 0 and len(final_result) == 0:
-                return all_finals
-            elif len(all_finals) > 0 and len(final_result) > 0:
-                return all_finals + f" {final_result}"
-            elif len(final_result) == 0 and len(all_partials) > 0:
-                return all_partials[-1]
-            else:
-                return final_result
+    def engine_config(self):
+        return dict(super().engine_config(), chunk_size=self.chunk_size)
+
+    async def execute_with_audio_async(self, audio):
+        return await self.streamer.transcribe(AudioBuffer(audio))
@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+import wave
+from typing import Optional
+
+
+def read_audio_info(filename: str) -> Optional[dict]:
+    """
+    Stat the file and read its wav header in one go
+
+    :return: {"mtime", "size", "sample_rate", "channels", "duration"} or None if the file is missing or unreadable.
+        sample_rate, channels and duration are None if the file is not a wav
+    """
+    try:
+        if not os.path.isfile(filename) or not os.access(filename, os.R_OK):
+            return None
+        stat = os.stat(filename)
+        info = {"mtime": stat.st_mtime, "size": stat.st_size, "sample_rate": None, "channels": None, "duration": None}
+        with wave.open(filename, "rb") as wf:
+            sample_rate, channels, frames = wf.getframerate(), wf.getnchannels(), wf.getnframes()
+    except (EOFError, wave.Error):
+        return info
+    except OSError:
+        return None
+    return dict(info, sample_rate=sample_rate, channels=channels, duration=frames / sample_rate if sample_rate else 0.0)
+
+
+class AudioIndex:
+    """
+    Sidecar JSON lines file of wav header info (duration, sample rate, channels) keyed on the file path. An entry is only used
+    while the file's mtime and size are unchanged, so validating the same dataset again only needs a stat per file rather
+    than opening every wav.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = self.load(path) if os.path.isfile(path) else {}
+        self._lock = threading.Lock()
+        self._new = []
+
+    @staticmethod
+    def load(path: str) -> dict:
+        """
+        :return: {abs path: info}, later lines replace earlier ones and incomplete lines are skipped
+        """
+        entries = {}
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                entries[entry.pop("path")] = entry
+        return entries
+
+    def info(self, filename: str) -> Optional[dict]:
+        """Header info of the file, from the index if it is still up to date otherwise read from the file and added to the index"""
+        key = os.path.abspath(filename)
+        entry = self.entries.get(key)
+        if entry is not None:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                return None
+            if stat.st_mtime == entry["mtime"] and stat.st_size == entry["size"] and os.access(filename, os.R_OK):
+                return entry
+
+        entry = read_audio_info(filename)
+        if entry is not None:
+            with self._lock:
+                self.entries[key] = entry
+                self._new.append(dict(entry, path=key))
+        return entry
+
+    def save(self):
+        """Append the entries added since the last save"""
+        with self._lock:
+            new, self._new = self._new, []
+        if not new:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in new))
@@ -0,0 +1,74 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+# rough per row overhead on top of the text columns, used for the size limit
+ROW_OVERHEAD_BYTES = 64
+
+
+class TranscriptionCache:
+    """
+    On disk cache of transcripts keyed on (audio_hash, engine_name, engine_config) where engine_config is the ASR's
+    config_fingerprint. Re-running the same audio through an unchanged ASR is then free, e.g. when only the normalization
+    or WER settings have changed.
+
+    Rows are evicted least recently used first once the cache is over max_size_mb. One sqlite connection is shared by all
+    threads (behind a lock), worker processes each open their own.
+    """
+
+    def __init__(self, cache_dir: str, max_size_mb: float = 1024):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "transcriptions.sqlite")
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS transcriptions ("
+            "audio_hash TEXT NOT NULL, engine_name TEXT NOT NULL, engine_config TEXT NOT NULL, "
+            "transcript TEXT NOT NULL, inf_time REAL NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL, "
+            "PRIMARY KEY (audio_hash, engine_name, engine_config))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS transcriptions_last_used ON transcriptions (last_used)")
+        self._size = self._total_size()
+
+    def _total_size(self) -> int:
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM transcriptions").fetchone()[0]
+
+    def get(self, audio_hash: str, asr) -> Optional[dict]:
+        """
+        :return: {"transcript": str, "inf_time": float seconds} or None on a miss
+        """
+        key = (audio_hash, asr.name, asr.config_fingerprint())
+        with self._lock:
+            row = self._conn.execute("SELECT transcript, inf_time FROM transcriptions WHERE audio_hash=? AND engine_name=? AND engine_config=?", key).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE transcriptions SET last_used=? WHERE audio_hash=? AND engine_name=? AND engine_config=?", (time.time(),) + key)
+        return {"transcript": row[0], "inf_time": row[1]}
+
+    def put(self, audio_hash: str, asr, transcript: str, inf_time: float):
+        size = len(transcript.encode("utf-8")) + len(audio_hash) + ROW_OVERHEAD_BYTES
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO transcriptions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (audio_hash, asr.name, asr.config_fingerprint(), transcript, inf_time, size, time.time()),
+            )
+            self._size += size
+            if self._size > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self):
+        # other processes may be writing too, so work from the real size rather than our running total
+        self._size = self._total_size()
+        while self._size > self.max_size_bytes:
+            # drop the least recently used ~10% at a time rather than one row per query
+            count = max(1, self._conn.execute("SELECT COUNT(*) FROM transcriptions").fetchone()[0] // 10)
+            self._conn.execute("DELETE FROM transcriptions WHERE rowid IN (SELECT rowid FROM transcriptions ORDER BY last_used LIMIT ?)", (count,))
+            self._size = self._total_size()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
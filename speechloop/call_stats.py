@@ -0,0 +1,108 @@
+import io
+import math
+import wave
+from array import array
+from typing import Optional
+
+import numpy as np
+
+PERCENTILES = [50, 90, 99]
+
+
+def wav_duration(audio: bytes) -> Optional[float]:
+    """Seconds of audio from the wav header, None if it isn't a wav"""
+    try:
+        with wave.open(io.BytesIO(audio), "rb") as wf:
+            return wf.getnframes() / wf.getframerate() if wf.getframerate() else None
+    except (EOFError, wave.Error):
+        return None
+
+
+class CallStats:
+    """
+    Latency, attempts and audio duration of every request an ASR made, whether it still failed after its retries and, for
+    streamed files, the time to the first partial and to the final result. Kept as array columns (34 bytes a call)
+    rather than an object per call so that it stays small for large datasets and pickles quickly between processes.
+
+    Latency excludes time waiting on the rate limiter and the sleeps between retries. Unknown durations and stream times
+    (files that weren't streamed, or gave no partial) are stored as nan.
+    """
+
+    def __init__(self):
+        self.latency = array("d")
+        self.attempts = array("B")
+        self.duration = array("d")
+        self.failed = array("B")
+        self.first_partial = array("d")
+        self.final = array("d")
+
+    def add(
+        self,
+        latency: float,
+        attempts: int = 1,
+        duration: Optional[float] = None,
+        failed: bool = False,
+        first_partial: Optional[float] = None,
+        final: Optional[float] = None,
+    ):
+        self.latency.append(latency)
+        self.attempts.append(min(attempts, 255))
+        self.duration.append(math.nan if duration is None else duration)
+        self.failed.append(failed)
+        self.first_partial.append(math.nan if first_partial is None else first_partial)
+        self.final.append(math.nan if final is None else final)
+
+    def extend(self, other: "CallStats"):
+        self.latency.extend(other.latency)
+        self.attempts.extend(other.attempts)
+        self.duration.extend(other.duration)
+        self.failed.extend(other.failed)
+        self.first_partial.extend(other.first_partial)
+        self.final.extend(other.final)
+
+    def since(self, start: int) -> "CallStats":
+        """The calls after the first start, e.g. the ones made while processing a shard"""
+        stats = CallStats()
+        stats.latency, stats.attempts, stats.duration = self.latency[start:], self.attempts[start:], self.duration[start:]
+        stats.failed, stats.first_partial, stats.final = self.failed[start:], self.first_partial[start:], self.final[start:]
+        return stats
+
+    def copy(self) -> "CallStats":
+        return self.since(0)
+
+    def __len__(self):
+        return len(self.latency)
+
+    def summary(self, wall_seconds: float) -> dict:
+        """
+        :param wall_seconds: how long the run took, for the throughput
+        :return: latency percentiles (seconds), throughput and real time factor (latency / audio duration, <1 is faster
+            than real time) of the calls whose duration is known. For streamed calls the percentiles of the time to the
+            first partial and to the final result too
+        """
+        latency = np.frombuffer(self.latency, dtype=np.float64)
+        attempts = np.frombuffer(self.attempts, dtype=np.uint8)
+        failed = np.frombuffer(self.failed, dtype=np.uint8)
+        duration = np.frombuffer(self.duration, dtype=np.float64)
+        known = ~np.isnan(duration)
+        audio_seconds = float(duration[known].sum())
+        result = {"calls": len(self), "retried_calls": int((attempts > 1).sum()), "attempts": int(attempts.sum()), "failed_calls": int(failed.sum())}
+        if len(self) == 0:
+            return result
+        for p, value in zip(PERCENTILES, np.percentile(latency, PERCENTILES)):
+            result[f"latency_p{p}"] = float(value)
+        result["latency_mean"] = float(latency.mean())
+        result["latency_max"] = float(latency.max())
+        result["audio_seconds"] = audio_seconds
+        result["rtf"] = float(latency[known].sum()) / audio_seconds if audio_seconds > 0 else None
+        result["files_per_second"] = len(self) / wall_seconds if wall_seconds > 0 else None
+        result["audio_seconds_per_second"] = audio_seconds / wall_seconds if wall_seconds > 0 else None
+        for name in ["first_partial", "final"]:
+            times = np.frombuffer(getattr(self, name), dtype=np.float64)
+            times = times[~np.isnan(times)]
+            if name == "final":
+                result["streamed_calls"] = len(times)
+            if len(times) > 0:
+                for p, value in zip(PERCENTILES, np.percentile(times, PERCENTILES)):
+                    result[f"{name}_p{p}"] = float(value)
+        return result
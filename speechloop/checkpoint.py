@@ -0,0 +1,63 @@
+import json
+import os
+import threading
+from typing import Optional
+
+
+class Checkpoint:
+    """
+    Append-only JSON lines file with one line per finished (audio file, ASR) pair. Every line is flushed as soon as it is
+    written so a crash or ctrl+c loses at most the requests that were in flight. Opening an existing checkpoint loads the
+    finished pairs so a run can be resumed and skip them.
+
+    Each line is written with a single write call so several threads/worker processes can append to the same file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done = self.load(path) if os.path.isfile(path) else {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        needs_newline = os.path.isfile(path) and os.path.getsize(path) > 0 and not self._ends_with_newline(path)
+        self._file = open(path, "a", encoding="utf-8")
+        if needs_newline:
+            # the last line was cut off by a crash, don't append onto it
+            self._file.write("\n")
+            self._file.flush()
+
+    @staticmethod
+    def _ends_with_newline(path: str) -> bool:
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    @staticmethod
+    def load(path: str) -> dict:
+        """
+        :return: {(filename, asr_name): {"transcript": str, "inf_time": float seconds}}, incomplete lines are skipped
+        """
+        done = {}
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                done[(entry["filename"], entry["asr"])] = {"transcript": entry["transcript"], "inf_time": entry["inf_time"]}
+        return done
+
+    def get(self, filename: str, asr_name: str) -> Optional[dict]:
+        return self.done.get((filename, asr_name))
+
+    def has_all(self, filename: str, asr_names: list) -> bool:
+        return all((filename, name) in self.done for name in asr_names)
+
+    def record(self, filename: str, asr_name: str, transcript: str, inf_time: float):
+        line = json.dumps({"filename": filename, "asr": asr_name, "transcript": transcript, "inf_time": inf_time}) + "\n"
+        with self._lock:
+            self.done[(filename, asr_name)] = {"transcript": transcript, "inf_time": inf_time}
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
@@ -3,26 +3,71 @@
 from __future__ import absolute_import
 
 from speechloop.validate import validate_manditory_data, validate_optional_csv_data
-from speechloop.file_utils import import_csvs, save_output
+from speechloop.file_utils import import_csvs, iter_csv_chunks, append_output, output_file_path
+from speechloop.checkpoint import Checkpoint
+from speechloop.audio_index import AudioIndex
+from speechloop.cache import TranscriptionCache
 from speechloop.hash_utils import compute_hashes
 from speechloop.model_runner import add_transcriptions
 from speechloop.asr.registry import create_model_objects
-from speechloop.text import add_wer
-from speechloop.summary import print_wer_summary
+from speechloop.asr.streaming import DEFAULT_CHUNK_SIZE
+from speechloop.asr.aws import DEFAULT_MAX_STREAMS
+from speechloop.asr.balancer import parse_endpoints, parse_replicas
+from speechloop.text import add_wer, COUNT_SUFFIXES
+from speechloop.rate_limit import apply_rate_limits, parse_rate_limit, parse_rate_limits
+from speechloop.summary import print_wer_summary, engine_stats, print_latency_summary, write_run_stats
+from speechloop.call_stats import CallStats
+from speechloop import tracing
 
-import datetime, time
+import atexit, datetime, time
+import multiprocessing
 import sys
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import List
 
 if sys.version_info < (3, 6):
     print("SpeechLoop requires at least Python 3.6 to run.")
     sys.exit(1)
 
+import pandas as pd
 from tqdm import tqdm
 from commoncorrections import CommonCorrections
 
 
+# engines that run in containers, they can have replicas
+LOCAL_ENGINES = ["vs", "sp", "cq"]
+
+
+def make_asr_options(
+    vosk_chunk_size: int = DEFAULT_CHUNK_SIZE,
+    vosk_streaming: str = "pipelined",
+    aws_max_streams: int = DEFAULT_MAX_STREAMS,
+    aws_realtime: bool = False,
+    server_streaming: str = "off",
+    server_chunk_size: int = DEFAULT_CHUNK_SIZE,
+    engine_options: dict = None,
+    replicas: str = "",
+    endpoints: str = "",
+) -> dict:
+    """Engine constructor options by ASR shortcode from the CLI settings, see benchmark for what each one does"""
+    asr_options = {
+        "vs": {"chunk_size": vosk_chunk_size, "streaming_mode": vosk_streaming},
+        "aw": {"max_streams": aws_max_streams, "realtime": aws_realtime},
+    }
+    for code in ["sp", "cq"]:
+        asr_options[code] = {"streaming_mode": None if server_streaming == "off" else server_streaming, "chunk_size": server_chunk_size}
+    for code, n in parse_replicas(replicas).items():
+        assert code in LOCAL_ENGINES, f"--replicas is only for the local engines {LOCAL_ENGINES}, not {code}"
+        asr_options[code]["replicas"] = n
+    for code, urls in parse_endpoints(endpoints).items():
+        assert code in LOCAL_ENGINES, f"--endpoints is only for the local engines {LOCAL_ENGINES}, not {code}"
+        asr_options[code]["endpoints"] = urls
+    for code, options in (engine_options or {}).items():
+        asr_options[code] = dict(asr_options.get(code, {}), **options)
+    return asr_options
+
+
 def benchmark(
     wanted_asr: List[str],
     input_csvs_str: str,
@@ -37,6 +82,29 @@ def benchmark(
     column_audiofile: str = "filename",
     column_transcript: str = "transcript",
     normalization_suffix: str = "_cor",
+    runner: str = "sequential",
+    max_in_flight: int = 1,
+    workers: int = 1,
+    rate_limits: str = "",
+    enable_checkpoint: bool = True,
+    resume: str = "",
+    cache_dir: str = "",
+    cache_max_mb: float = 1024,
+    chunksize: int = 0,
+    audio_index: str = "",
+    pool_size: int = 0,
+    vosk_chunk_size: int = DEFAULT_CHUNK_SIZE,
+    vosk_streaming: str = "pipelined",
+    aws_max_streams: int = DEFAULT_MAX_STREAMS,
+    aws_realtime: bool = False,
+    batch_size: int = 1,
+    server_streaming: str = "off",
+    server_chunk_size: int = DEFAULT_CHUNK_SIZE,
+    trace: str = "",
+    trace_memory: bool = True,
+    engine_options: dict = None,
+    replicas: str = "",
+    endpoints: str = "",
 ) -> None:
     """
 
@@ -44,60 +112,280 @@ def benchmark(
     :param input_csvs_str:
     :param sample_rate: -- integer corresponding to wav sample rate
     :param shell_script_mode: -- bool determines how to print output
-    :param wav_delay: -- float delay
-    :param quick_test -- perform test on small 5 subset sample
+    :param wav_delay: -- float min seconds between requests to an ASR, used for any ASR without an entry in rate_limits
+    :param quick_test -- perform test on small 5 subset sample (of the first chunk when using chunksize)
     :param home_dir: -- location for output
     :param enable_wer: bool = False,
     :param enable_text_normalization: bool = False,
     :param enable_compute_hashes: bool = False,
     :param column_audiofile:str = 'filename',
     :param column_transcript:str = 'transcript',
+    :param runner: -- "sequential", "threads" or "async" (send each file to all ASRs at once)
+    :param max_in_flight: -- max requests in flight per ASR with the threads/async runner
+    :param workers: -- number of processes, when >1 the data is split into shards that each run in their own process
+    :param rate_limits: -- per ASR rate limits e.g. "gg=5/s,az=20/s:4,vs=unlimited" (see rate_limit.parse_rate_limit)
+    :param enable_checkpoint: -- append every result to a checkpoint file as soon as it finishes
+    :param resume: -- path to the checkpoint of an earlier run, (file, ASR) pairs in it are skipped and new results are appended to it
+    :param cache_dir: -- directory of the transcription cache, audio already transcribed by an unchanged ASR is not sent again
+    :param cache_max_mb: -- size the cache is kept under, least recently used results are removed first
+    :param chunksize: -- if >0 the CSV(s) are read and processed this many rows at a time, the output CSV is appended to after each chunk
+    :param pool_size: -- max keep-alive connections each HTTP ASR opens at once, 0 uses max_in_flight
+    :param vosk_chunk_size: -- bytes of audio per websocket message sent to vosk
+    :param vosk_streaming: -- "lockstep", "pipelined" or "realtime" (see asr.vosk.STREAMING_MODES)
+    :param aws_max_streams: -- max AWS transcribe streams open at once
+    :param aws_realtime: -- send audio to AWS no faster than it would play
+    :param server_streaming: -- "off" sends whole files to sphinx/coqui, otherwise how they are streamed to the servers' /stream websocket (see asr.streaming.STREAMING_MODES)
+    :param server_chunk_size: -- bytes of audio per websocket message when streaming to sphinx/coqui
+    :param batch_size: -- if >1 files are sent to each ASR this many at a time, in one request to ASRs with a batch endpoint
+    :param trace: -- if given a Chrome trace JSON file of every stage and engine call is written here (see tracing.py)
+    :param trace_memory: -- with trace, record the traced memory and peak memory of each stage using tracemalloc (slows the run)
+    :param replicas: -- containers to run per local ASR on consecutive ports e.g. "vs=4,cq=8", requests are balanced over them
+    :param endpoints: -- servers started outside SpeechLoop to use instead of containers, "|" between the URLs of an ASR e.g. "cq=http://a:3200|http://b:3200"
+    :param engine_options: -- extra constructor options by ASR shortcode, merged over the ones made from the params above e.g. to point the engines at local stand-ins
+    :param audio_index: -- sidecar file of wav header info reused by later runs, defaults to <home_dir>/output/audio_index.jsonl, "none" disables it
     :return: None
     """
     start_time = datetime.datetime.now().replace(microsecond=0)
+    run_start = time.monotonic()
+    if trace:
+        tracing.start(trace_memory)
 
     # IMPORT CSV(s)
-    df = import_csvs(input_csvs_str)
+    if chunksize > 0:
+        # stream the CSV(s) so that processing starts straight away and the whole manifest is never in memory
+        chunks = tracing.traced(iter_csv_chunks(input_csvs_str, chunksize), "import csv")
+    else:
+        with tracing.span("import csv"):
+            chunks = iter([import_csvs(input_csvs_str)])
 
-    if quick_test:
-        df = df.sample(5, random_state=42)
-        print(f"Using small quick test dataset: \n{df.head()}\n\n")
+    # fail on a bad --rate_limits before any containers are started
+    [parse_rate_limit(spec) for spec in parse_rate_limits(rate_limits).values()]
 
-    # VALIDATE
-    validate_manditory_data(df, wanted_asr, sample_rate, column_audiofile)
-    validate_optional_csv_data(df, enable_wer, column_transcript, enable_text_normalization)
+    if audio_index.lower() != "none":
+        audio_index = AudioIndex(audio_index or os.path.join(home_dir, "output", "audio_index.jsonl"))
+    else:
+        audio_index = None
 
-    if enable_compute_hashes:
-        df = compute_hashes(df, column_audiofile, column_transcript)
+    asr_options = make_asr_options(vosk_chunk_size, vosk_streaming, aws_max_streams, aws_realtime, server_streaming, server_chunk_size, engine_options, replicas, endpoints)
 
-    list_of_asr = create_model_objects(wanted_asr)
-    list_of_asr_names = [asr.name for asr in list_of_asr]
+    list_of_asr = None
+    summary_frames = []
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) if workers > 1 else None
+    try:
+        for df in chunks:
+            if quick_test:
+                df = df.sample(min(5, df.shape[0]), random_state=42)
+                print(f"Using small quick test dataset: \n{df.head()}\n\n")
+
+            # VALIDATE
+            with tracing.span("validate", rows=df.shape[0]):
+                validate_manditory_data(df, wanted_asr, sample_rate, column_audiofile, audio_index)
+                validate_optional_csv_data(df, enable_wer, column_transcript, enable_text_normalization)
+
+            if enable_compute_hashes:
+                with tracing.span("hashes", rows=df.shape[0]):
+                    df = compute_hashes(df, column_audiofile, column_transcript)
+
+            if list_of_asr is None:
+                # first chunk is valid, start the ASRs
+                with tracing.span("create models"):
+                    list_of_asr = create_model_objects(wanted_asr, asr_options)
+                list_of_asr_names = [asr.name for asr in list_of_asr]
+                output_path_name = output_file_path(home_dir, quick_test, list_of_asr_names)
+                first_chunk = True
+
+                checkpoint_path = None
+                if resume:
+                    checkpoint_path = resume
+                    print(f"Resuming from checkpoint: {resume} which has {len(Checkpoint.load(resume))} results")
+                elif enable_checkpoint:
+                    checkpoint_path = output_file_path(home_dir, quick_test, list_of_asr_names, ".jsonl", subfolder="checkpoints")
+                    print(f"Checkpoint file (use with --resume if this run is interrupted): {checkpoint_path}")
+                checkpoint = Checkpoint(checkpoint_path) if checkpoint_path and pool is None else None
+                cache = TranscriptionCache(cache_dir, cache_max_mb) if cache_dir and pool is None else None
+                state_args = dict(
+                    checkpoint_path=checkpoint_path, cache_dir=cache_dir, cache_max_mb=cache_max_mb, asr_options=asr_options, trace=bool(trace), trace_memory=trace_memory
+                )
+
+                process_args = dict(
+                    shell_script_mode=shell_script_mode,
+                    wav_delay=wav_delay,
+                    rate_limits=rate_limits,
+                    runner=runner,
+                    max_in_flight=max_in_flight,
+                    pool_size=pool_size,
+                    batch_size=batch_size,
+                    enable_wer=enable_wer,
+                    enable_text_normalization=enable_text_normalization,
+                    column_transcript=column_transcript,
+                    normalization_suffix=normalization_suffix,
+                )
+                if not shell_script_mode:
+                    tqdm.pandas()
+
+            # RUN & GET TRANSCRIPTIONS, NORMALIZATION & WER
+            if pool is not None:
+                with tracing.span("process shards", rows=df.shape[0]):
+                    df_out = sharded_process_frame(df, pool, workers, wanted_asr, list_of_asr, process_args, state_args)
+            else:
+                df_out = process_frame(df, list_of_asr, checkpoint, cache, **process_args)
 
-    # RUN & GET TRANSCRIPTIONS
-    if not shell_script_mode:
-        tqdm.pandas()
-    df_trans = add_transcriptions(df, list_of_asr, shell_script_mode, wav_delay)
+            # OUTPUT CSV - WITH WER IF ENABLED
+            with tracing.span("save csv", rows=df_out.shape[0]):
+                append_output(output_path_name, df_out, header=first_chunk)
+            first_chunk = False
+            if enable_wer:
+                summary_frames.append(df_out[[c for c in df_out.columns if c.endswith(tuple(["_wer"] + COUNT_SUFFIXES))]])
+
+            if quick_test:
+                break
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if list_of_asr is not None:
+            if checkpoint is not None:
+                checkpoint.close()
+            if cache is not None:
+                cache.close()
+
+    # an empty CSV never gets as far as the first chunk's validation
+    assert list_of_asr is not None, f"No rows of data found in: {input_csvs_str}"
+
+    with tracing.span("summary"):
+        if enable_wer:
+            # SUMMARY
+            print_wer_summary(list_of_asr, pd.concat(summary_frames), start_time)
+
+        # LATENCY & THROUGHPUT
+        wall_seconds = time.monotonic() - run_start
+        stats = engine_stats(list_of_asr, wall_seconds)
+        print_latency_summary(stats)
+        stats_path = os.path.splitext(output_path_name)[0] + "_stats.json"
+        write_run_stats(stats_path, stats, wall_seconds)
+
+    print(f"Output file: {output_path_name}")
+    print(f"Latency stats: {stats_path}")
+    if trace:
+        tracing.stop(trace)
+        print(f"Trace file (open in chrome://tracing or ui.perfetto.dev): {trace}")
+    print("Done.")
+    time.sleep(2)
+
+
+def process_frame(
+    df: pd.DataFrame,
+    list_of_asr: list,
+    checkpoint: Checkpoint,
+    cache: TranscriptionCache,
+    shell_script_mode: bool,
+    wav_delay: float,
+    rate_limits: str,
+    runner: str,
+    max_in_flight: int,
+    pool_size: int,
+    batch_size: int,
+    enable_wer: bool,
+    enable_text_normalization: bool,
+    column_transcript: str,
+    normalization_suffix: str,
+    rate_share: int = 1,
+) -> pd.DataFrame:
+    """
+    Transcribe, normalize and score a (possibly partial) dataset. This is the part of benchmark that scales with the
+    number of rows, so it is what is run for each chunk of a streamed CSV and each shard when using multiple workers.
+
+    rate_share is the number of processes the rate limits are split between.
+    """
+    list_of_asr_names = [asr.name for asr in list_of_asr]
+    apply_rate_limits(list_of_asr, rate_limits, wav_delay, rate_share)
+    for asr in list_of_asr:
+        asr.set_pool_size(pool_size or max(1, max_in_flight))
+    with tracing.span("transcribe", rows=df.shape[0]):
+        df_trans = add_transcriptions(df, list_of_asr, shell_script_mode, runner, max_in_flight, checkpoint, cache, batch_size)
 
     if enable_text_normalization:
         # USE COMMON CORRECTIONS
-        df_trans = text_normalization(df_trans, list_of_asr_names, column_transcript, normalization_suffix)
+        with tracing.span("normalize", rows=df.shape[0]):
+            df_trans = text_normalization(df_trans, list_of_asr_names, column_transcript, normalization_suffix)
 
     if enable_wer:
         # ADD WER
         wer_substring = f"{normalization_suffix}_wer" if enable_text_normalization else "_wer"
         trans_substring = column_transcript + normalization_suffix if enable_text_normalization else column_transcript
         wer_cols = [asr + wer_substring for asr in list_of_asr_names]
-        df_wer = add_wer(df_trans, wer_cols, trans_substring)
-        # SUMMARY
-        print_wer_summary(list_of_asr, df_wer, start_time)
-        # OUTPUT CSV WITH WER
-        save_output(home_dir, quick_test, list_of_asr_names, df_wer)
-    else:
-        # OUTPUT CSV - JUST TRANSCRIPTS
-        save_output(home_dir, quick_test, list_of_asr_names, df_trans)
+        with tracing.span("wer", rows=df.shape[0]):
+            df_trans = add_wer(df_trans, wer_cols, trans_substring)
 
-    print("Done.")
-    time.sleep(2)
+    return df_trans
+
+
+def split_shards(df: pd.DataFrame, n_shards: int) -> List[pd.DataFrame]:
+    """Split by position into n_shards contiguous, nearly equal sized pieces (keeps the original order)"""
+    n_shards = max(1, min(n_shards, df.shape[0]))
+    bounds = [round(i * df.shape[0] / n_shards) for i in range(n_shards + 1)]
+    return [df.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+# ASR objects, checkpoint and cache of a worker process, made for its first shard and reused for the rest
+WORKER_STATE = {}
+
+
+def run_shard(shard: pd.DataFrame, wanted_asr: List[str], process_args: dict, state_args: dict):
+    """
+    Entry point of a worker process. Each worker makes its own ASR objects, containers are already running as they were
+    launched by the parent.
+
+    :return: the processed shard, the run stats of each ASR for this shard and its trace events
+    """
+    if state_args["trace"] and not tracing.enabled():
+        tracing.start(state_args["trace_memory"], f"worker {os.getpid()}")
+    if not WORKER_STATE:
+        list_of_asr = create_model_objects(wanted_asr, state_args["asr_options"])
+        for asr in list_of_asr:
+            # the parent process owns the containers, don't let a worker stop them when it exits
+            atexit.unregister(asr.kill)
+        WORKER_STATE["list_of_asr"] = list_of_asr
+        WORKER_STATE["checkpoint"] = Checkpoint(state_args["checkpoint_path"]) if state_args["checkpoint_path"] else None
+        WORKER_STATE["cache"] = TranscriptionCache(state_args["cache_dir"], state_args["cache_max_mb"]) if state_args["cache_dir"] else None
+
+    list_of_asr = WORKER_STATE["list_of_asr"]
+    before = {asr.name: asr.run_stats() for asr in list_of_asr}
+    df_out = process_frame(shard, list_of_asr, WORKER_STATE["checkpoint"], WORKER_STATE["cache"], **process_args)
+    return df_out, {asr.name: stats_since(before[asr.name], asr.run_stats()) for asr in list_of_asr}, tracing.drain()
+
+
+def stats_since(before: dict, after: dict) -> dict:
+    """run_stats added between the two snapshots, totals are subtracted and only the calls made since are kept"""
+    return {k: v.since(len(before[k])) if isinstance(v, CallStats) else v - before[k] for k, v in after.items()}
+
+
+def sharded_process_frame(
+    df: pd.DataFrame, pool: ProcessPoolExecutor, workers: int, wanted_asr: List[str], list_of_asr: list, process_args: dict, state_args: dict
+) -> pd.DataFrame:
+    """
+    Split the dataset into shards and run process_frame on each of them in a pool of worker processes. The shards are merged
+    back in the original order and each ASR in list_of_asr has the run stats of all its shards added to it.
+    Rate limits are divided between the workers.
+    """
+    # more shards than workers balances the load better and gives a more useful progress bar
+    shards = split_shards(df, workers * 4)
+    shard_args = dict(process_args, shell_script_mode=True, rate_share=workers)
+    print(f"Running {len(shards)} shards with {workers} worker processes")
+
+    results = [None] * len(shards)
+    futures = {pool.submit(run_shard, shard, wanted_asr, shard_args, state_args): i for i, shard in enumerate(shards)}
+    completed = as_completed(futures)
+    if not process_args["shell_script_mode"]:
+        completed = tqdm(completed, total=len(futures))
+    for future in completed:
+        results[futures[future]] = future.result()
+
+    for _, shard_stats, shard_events in results:
+        for asr in list_of_asr:
+            asr.add_run_stats(shard_stats[asr.name])
+        tracing.add_events(shard_events)
+
+    return pd.concat([df_shard for df_shard, _, _ in results], sort=False)
 
 
 def text_normalization(df, list_of_asr_names, column_transcript, normalization_suffix):
@@ -0,0 +1,15 @@
+"""
+Per engine command line settings like --rate_limits gg=5/s,az=20/s:4 or --replicas vs=4,cq=8, keyed by the ASR code
+"""
+from typing import Dict, Type
+
+
+def parse_engine_settings(spec: str, what: str, example: str = "<asr code>=<value>", error: Type[ValueError] = ValueError) -> Dict[str, str]:
+    """Split "vs=4,cq=8" into {"vs": "4", "cq": "8"}, items without an = raise error"""
+    settings = {}
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        if "=" not in item:
+            raise error(f"{what} '{item}' should look like {example}")
+        code, value = item.split("=", 1)
+        settings[code.strip()] = value.strip()
+    return settings
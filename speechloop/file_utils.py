@@ -1,26 +1,118 @@
-from io import BytesIO
-import os, sys, datetime, csv, tempfile, argparse
+import os, sys, datetime, csv, mmap, argparse
+from typing import Iterator, List
 
 import pandas as pd
 
 
-def disk_in_memory(wav_bytes: bytes) -> BytesIO:
+class AudioBuffer:
     """
-    this spooled wav was chosen because it's much more efficient than writing to disk,
-    it effectively is writing to memory only and can still be read (by some python modules) as a file
+    Read only file-like view of audio that is already in memory (bytes, bytearray, memoryview or an mmap). read() returns
+    memoryview slices of it so streaming a file in chunks never copies the audio. Websockets, aiohttp, hashlib and
+    soundfile all take memoryviews, call bytes() on a chunk for anything that only takes bytes.
+
+    Use AudioBuffer.from_file to map a file on disk rather than reading it in.
+    """
+
+    def __init__(self, data, _mmap=None):
+        self.view = memoryview(data).cast("B")
+        self.position = 0
+        self._mmap = _mmap
+
+    @classmethod
+    def from_file(cls, filename: str) -> "AudioBuffer":
+        with open(filename, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # empty files can't be mapped
+                return cls(b"")
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapped, _mmap=mapped)
+
+    def read(self, size: int = -1) -> memoryview:
+        end = len(self.view) if size is None or size < 0 else min(self.position + size, len(self.view))
+        chunk = self.view[self.position : end]
+        self.position = max(self.position, end)
+        return chunk
+
+    def chunks(self, size: int) -> Iterator[memoryview]:
+        """Chunks of up to size bytes from the current position to the end"""
+        while True:
+            chunk = self.read(size)
+            if len(chunk) == 0:
+                return
+            yield chunk
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: len(self.view)}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def __len__(self) -> int:
+        return len(self.view)
+
+    def close(self) -> None:
+        """
+        Only needed for mapped files. Slices handed out by read() that are still held stay readable, the file is unmapped
+        when the last of them is dropped
+        """
+        self.view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # slices still point into the map, it is closed when it is garbage collected after them
+                pass
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CSVHeaderMismatch(ValueError):
+    pass
+
+
+def check_csv_headers(filepaths: List[str]) -> List[str]:
+    """
+    Read only the header row of each CSV and check that they all have the same columns
+
+    :return: the columns
     """
-    with tempfile.SpooledTemporaryFile() as spooled_wav:
-        spooled_wav.write(wav_bytes)
-        spooled_wav.seek(0)
-        return BytesIO(spooled_wav.read())
+    columns = None
+    for path in filepaths:
+        found = pd.read_csv(path, index_col=None, nrows=0).columns.tolist()
+        if columns is None:
+            columns = found
+        elif found != columns:
+            raise CSVHeaderMismatch(f"CSV: {path} has headings {found} but {filepaths[0]} has {columns}, multiple CSVs must have the same headings")
+    return columns
 
 
 def import_csvs(filepaths: str) -> pd.DataFrame:
-    df = pd.DataFrame()
-    for csv in filepaths.split(","):
-        df_new = pd.read_csv(csv, index_col=None)
-        df = pd.concat([df, df_new], sort=False)
-    return df
+    paths = filepaths.split(",")
+    check_csv_headers(paths)
+    # concat once at the end, concatenating inside the loop copies everything read so far for every CSV
+    return pd.concat([pd.read_csv(csv, index_col=None) for csv in paths], ignore_index=True, sort=False)
+
+
+def iter_csv_chunks(filepaths: str, chunksize: int) -> Iterator[pd.DataFrame]:
+    """
+    Streaming version of import_csvs, yields DataFrames of up to chunksize rows across all the CSVs in order.
+    The index carries on across chunks/files as if the CSVs had been loaded with import_csvs.
+    """
+    paths = filepaths.split(",")
+    check_csv_headers(paths)
+    start = 0
+    for csv in paths:
+        for chunk in pd.read_csv(csv, index_col=None, chunksize=chunksize):
+            chunk.index = pd.RangeIndex(start, start + chunk.shape[0])
+            start += chunk.shape[0]
+            yield chunk
 
 
 def directory_writeable(path: str) -> bool:
@@ -61,13 +153,22 @@ def flush_buffers() -> None:
     sys.stderr.flush()
 
 
-def save_output(home_dir, quick_test, wanted_asr, df_wer):
+def output_file_path(home_dir, quick_test, wanted_asr, extension=".csv", subfolder=""):
     date_str = datetime.datetime.now().strftime("%Y%m%d_%H-%M-%S")
     qt = "QT_" if quick_test else ""
     asr_str = "-".join(wanted_asr)
-    save_folder = os.path.join(home_dir, "output")
+    save_folder = os.path.join(home_dir, "output", subfolder)
     os.makedirs(save_folder, exist_ok=True)
-    output_path_name = f"{save_folder}/{qt}{date_str}_{asr_str}.csv"
+    return os.path.join(save_folder, f"{qt}{date_str}_{asr_str}{extension}")
+
+
+def save_output(home_dir, quick_test, wanted_asr, df_wer):
+    output_path_name = output_file_path(home_dir, quick_test, wanted_asr)
     print(f"Output file: {output_path_name}")
     df_wer.to_csv(output_path_name, index=False, quoting=csv.QUOTE_ALL)
     print(f"Success!")
+
+
+def append_output(output_path_name, df_wer, header=False):
+    """Used when the data is processed in chunks, the first chunk creates the file and writes the header"""
+    df_wer.to_csv(output_path_name, index=False, quoting=csv.QUOTE_ALL, mode="w" if header else "a", header=header)
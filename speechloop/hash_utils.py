@@ -1,13 +1,21 @@
 import hashlib
 import pandas as pd
 
+from speechloop.file_utils import AudioBuffer
+
+
+def hash_bytes(audio_bytes: bytes) -> str:
+    return hashlib.md5(audio_bytes).hexdigest()
+
 
 def hash_audio(row, column_audiofile):
-    return hashlib.md5(open(row[column_audiofile], "rb").read()).hexdigest()
+    return hash_file(row[column_audiofile])
 
 
 def hash_file(f):
-    return hashlib.md5(open(f, "rb").read()).hexdigest()
+    # mapped rather than read in, the file is hashed straight from the page cache
+    with AudioBuffer.from_file(f) as audio:
+        return hash_bytes(audio.view)
 
 
 def hash_transcript(row, column_transcript):
@@ -39,7 +39,8 @@ def clear_screen():
 
 
 def simple_transcribe(asr_list, filename, keep_audio=False):
-    raw_audio_file = open(filename, "rb").read()
+    with open(filename, "rb") as f:
+        raw_audio_file = f.read()
     print(f"Selected ASRs: ")
     for asr in asr_list:
         transcript = asr.execute_with_audio(raw_audio_file)
@@ -0,0 +1,271 @@
+"""
+Load test of one engine: audio from a manifest is replayed against it at increasing levels of load and the achieved
+throughput, latency percentiles and error rate of each level are written as CSV and JSON, i.e. its latency vs throughput
+curve. Used to find where an engine (or a fleet of its containers) saturates.
+
+    speechloop loadtest --wanted_asr vs --input_csv data/simple_test/simple_test.csv --concurrency 1,2,4,8,16
+    speechloop loadtest --wanted_asr cq --input_csv data/simple_test/simple_test.csv --qps 1,2,5,10
+
+Concurrency levels are a closed loop: that many files are in flight at all times, each sent as soon as the last one
+finished. QPS levels are an open loop: files are sent at the target rate whether or not earlier ones have finished, and
+latency is measured from when a file was due to be sent so that a saturated engine shows up as queueing rather than as a
+lower send rate.
+
+Requests go straight to the engine, rate limits and retries don't apply and transcripts aren't scored.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from typing import List
+
+import pandas as pd
+
+from speechloop.asr.aws import DEFAULT_MAX_STREAMS
+from speechloop.asr.base_asr import run_sync
+from speechloop.asr.errors import DEFAULT_ERROR
+from speechloop.asr.registry import create_model_objects
+from speechloop.asr.streaming import DEFAULT_CHUNK_SIZE, STREAMING_MODES
+from speechloop.call_stats import CallStats, wav_duration
+from speechloop.core import make_asr_options
+from speechloop.file_utils import import_csvs, output_file_path, valid_readable_file
+
+DEFAULT_CONCURRENCY = "1,2,4,8,16,32"
+DEFAULT_LEVEL_SECONDS = 30.0
+DEFAULT_WARMUP_SECONDS = 5.0
+DEFAULT_TIMEOUT = 60.0
+# later levels are skipped once a level has more errors than this
+DEFAULT_STOP_ERROR_RATE = 0.5
+
+
+def parse_levels(levels: str) -> List[float]:
+    values = [float(level) for level in levels.split(",") if level.strip()]
+    assert values and all(value > 0 for value in values), f"levels must be a comma separated list of numbers > 0, got: {levels}"
+    return values
+
+
+class LevelStats:
+    """Requests of one load level, the latency of the successful ones is kept in a CallStats"""
+
+    def __init__(self):
+        self.calls = CallStats()
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.last_error = None
+
+    async def call(self, asr, audio: bytes, duration: float, due: float, timeout: float):
+        """Transcribe one file, its latency is measured from due (the monotonic time it was meant to be sent)"""
+        self.requests += 1
+        try:
+            transcript = await asyncio.wait_for(asr.execute_with_audio_async(audio), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self.errors += 1
+            return
+        except Exception as e:
+            self.errors += 1
+            self.last_error = repr(e)
+            return
+        if transcript == DEFAULT_ERROR:
+            self.errors += 1
+            return
+        self.calls.add(time.monotonic() - due, 1, duration)
+
+    def summary(self, mode: str, level: float, seconds: float) -> dict:
+        calls = self.calls.summary(seconds)
+        result = {
+            "mode": mode,
+            "level": level,
+            "seconds": seconds,
+            "requests": self.requests,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "error_rate": self.errors / self.requests if self.requests else 0.0,
+            "throughput": calls.get("files_per_second") or 0.0,
+        }
+        for key in ["latency_p50", "latency_p90", "latency_p99", "latency_mean", "latency_max", "rtf", "audio_seconds_per_second"]:
+            result[key] = calls.get(key)
+        result["last_error"] = self.last_error
+        return result
+
+
+async def closed_loop(asr, audios, concurrency: int, seconds: float, timeout: float) -> LevelStats:
+    """concurrency files in flight until seconds have passed, the ones in flight then are waited for"""
+    level = LevelStats()
+    deadline = time.monotonic() + seconds
+
+    async def user():
+        while time.monotonic() < deadline:
+            audio, duration = next(audios)
+            await level.call(asr, audio, duration, time.monotonic(), timeout)
+
+    await asyncio.gather(*[user() for _ in range(concurrency)])
+    return level
+
+
+async def open_loop(asr, audios, qps: float, seconds: float, timeout: float) -> LevelStats:
+    """A file every 1/qps seconds for seconds, then the ones still in flight are waited for"""
+    level = LevelStats()
+    start = time.monotonic()
+    tasks = []
+    for i in itertools.count():
+        due = start + i / qps
+        if due >= start + seconds:
+            break
+        await asyncio.sleep(max(0.0, due - time.monotonic()))
+        audio, duration = next(audios)
+        tasks.append(asyncio.ensure_future(level.call(asr, audio, duration, due, timeout)))
+    await asyncio.gather(*tasks)
+    return level
+
+
+def run_level(asr, audios, mode: str, level: float, seconds: float, timeout: float) -> dict:
+    start = time.monotonic()
+    if mode == "concurrency":
+        stats = run_sync(closed_loop(asr, audios, int(level), seconds, timeout))
+    else:
+        stats = run_sync(open_loop(asr, audios, level, seconds, timeout))
+    return stats.summary(mode, level, time.monotonic() - start)
+
+
+def load_audios(input_csvs_str: str, column_audiofile: str = "filename", max_files: int = 0) -> list:
+    """(wav bytes, seconds of audio) of the files in the manifest, read into memory up front so disk reads aren't measured"""
+    paths = import_csvs(input_csvs_str)[column_audiofile].tolist()
+    if max_files > 0:
+        paths = paths[:max_files]
+    audios = []
+    for path in paths:
+        if valid_readable_file(path):
+            with open(path, "rb") as f:
+                audio = f.read()
+            audios.append((audio, wav_duration(audio)))
+    assert audios, f"No readable audio found in: {input_csvs_str}"
+    return audios
+
+
+def print_level(result: dict):
+    name = f"{result['level']:g} in flight" if result["mode"] == "concurrency" else f"{result['level']:g} qps"
+    if result["latency_p50"] is None:
+        print(f"{name}: no successful requests, {result['errors']} errors (last: {result['last_error']})")
+        return
+    print(
+        f"{name}: {result['throughput']:.2f} files/s, latency p50={result['latency_p50']:.3f}s p90={result['latency_p90']:.3f}s "
+        f"p99={result['latency_p99']:.3f}s, {result['error_rate']:.1%} errors over {result['requests']} requests"
+    )
+
+
+def loadtest(
+    wanted_asr: str,
+    input_csvs_str: str,
+    concurrency: str = DEFAULT_CONCURRENCY,
+    qps: str = "",
+    level_seconds: float = DEFAULT_LEVEL_SECONDS,
+    warmup_seconds: float = DEFAULT_WARMUP_SECONDS,
+    timeout: float = DEFAULT_TIMEOUT,
+    stop_error_rate: float = DEFAULT_STOP_ERROR_RATE,
+    max_files: int = 0,
+    home_dir: str = ".",
+    column_audiofile: str = "filename",
+    vosk_chunk_size: int = DEFAULT_CHUNK_SIZE,
+    vosk_streaming: str = "pipelined",
+    aws_max_streams: int = DEFAULT_MAX_STREAMS,
+    server_streaming: str = "off",
+    server_chunk_size: int = DEFAULT_CHUNK_SIZE,
+    replicas: str = "",
+    endpoints: str = "",
+    engine_options: dict = None,
+) -> List[dict]:
+    """
+    :param wanted_asr: -- 2 char code of the one ASR to load test
+    :param concurrency: -- comma separated files in flight of each level, used when qps isn't given
+    :param qps: -- comma separated target requests per second of each level
+    :param level_seconds: -- how long each level sends files for
+    :param warmup_seconds: -- files are sent at the first level for this long before measuring, to open connections and load models
+    :param timeout: -- seconds before a request counts as an error
+    :param stop_error_rate: -- later levels are skipped once a level's error rate is above this
+    :param max_files: -- only use the first max_files of the manifest (they are all held in memory), 0 uses all of them
+    :param replicas: -- e.g. "cq=4" to load test 4 containers of the ASR, see benchmark
+    :param endpoints: -- servers started outside SpeechLoop to load test instead of containers, see benchmark
+    :param engine_options: -- extra constructor options by ASR shortcode, see benchmark
+    :return: a dict of results for each level that was run, these are also written to <home_dir>/output as CSV and JSON
+    """
+    mode, levels = ("qps", parse_levels(qps)) if qps else ("concurrency", parse_levels(concurrency))
+    audios = load_audios(input_csvs_str, column_audiofile, max_files)
+    print(f"Load testing {wanted_asr} with {len(audios)} files at {mode} levels {levels}, {level_seconds}s each")
+
+    asr_options = make_asr_options(vosk_chunk_size, vosk_streaming, aws_max_streams, False, server_streaming, server_chunk_size, engine_options, replicas, endpoints)
+    asr = create_model_objects([wanted_asr], asr_options)[0]
+    if mode == "concurrency":
+        # enough keep-alive connections that requests never queue in the client
+        asr.set_pool_size(int(max(levels)))
+    audio_cycle = itertools.cycle(audios)
+
+    if warmup_seconds > 0:
+        run_level(asr, audio_cycle, mode, levels[0], warmup_seconds, timeout)
+
+    results = []
+    for level in levels:
+        result = run_level(asr, audio_cycle, mode, level, level_seconds, timeout)
+        print_level(result)
+        results.append(result)
+        if result["error_rate"] > stop_error_rate:
+            print(f"Stopping, the error rate of {result['error_rate']:.1%} is above {stop_error_rate:.1%}")
+            break
+
+    csv_path = output_file_path(home_dir, False, [wanted_asr], extension="_loadtest.csv")
+    pd.DataFrame(results).to_csv(csv_path, index=False)
+    json_path = csv_path[: -len(".csv")] + ".json"
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump({"asr": wanted_asr, "engine_config": asr.engine_config(), "files": len(audios), "levels": results}, f, indent=2, default=str)
+    print(f"Load test results: {csv_path} and {json_path}")
+    return results
+
+
+def loadtest_main(args=None):
+    parser = argparse.ArgumentParser(prog="speechloop loadtest", description="SpeechLoop -> Load test one ASR at increasing concurrency or QPS")
+    parser.add_argument("--wanted_asr", type=str, required=True, help="2 letter acronym of the one ASR to load test e.g. vs")
+    parser.add_argument("--input_csv", required=True, help="CSV(s) comma delimited whose audio files are replayed, in order and repeating")
+    parser.add_argument("--column_audiofile", type=str, default="filename", help="header in CSV which points to the audio file")
+    parser.add_argument("--concurrency", type=str, default=DEFAULT_CONCURRENCY, help="comma separated number of files in flight at each level")
+    parser.add_argument("--qps", type=str, default="", help="comma separated target requests per second at each level, used instead of --concurrency")
+    parser.add_argument("--level_seconds", type=float, default=DEFAULT_LEVEL_SECONDS, help="seconds each level sends files for")
+    parser.add_argument("--warmup_seconds", type=float, default=DEFAULT_WARMUP_SECONDS, help="seconds of unmeasured load at the first level")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="seconds before a request counts as an error")
+    parser.add_argument("--stop_error_rate", type=float, default=DEFAULT_STOP_ERROR_RATE, help="skip the remaining levels once a level's error rate is above this")
+    parser.add_argument("--max_files", type=int, default=0, help="only use the first max_files audio files (all are read into memory), 0 uses them all")
+    parser.add_argument("--home_dir", type=str, default=".", help="results are written to <home_dir>/output")
+    parser.add_argument("--vosk_chunk_size", type=int, default=DEFAULT_CHUNK_SIZE, help="bytes of audio sent to vosk per websocket message")
+    parser.add_argument("--vosk_streaming", type=str, default="pipelined", choices=STREAMING_MODES, help="how audio is streamed to vosk")
+    parser.add_argument("--aws_max_streams", type=int, default=DEFAULT_MAX_STREAMS, help="max AWS transcribe streams open at once")
+    parser.add_argument("--server_streaming", type=str, default="off", choices=["off"] + STREAMING_MODES, help="stream to the sphinx/coqui /stream websocket")
+    parser.add_argument("--server_chunk_size", type=int, default=DEFAULT_CHUNK_SIZE, help="bytes of audio per websocket message when streaming to sphinx/coqui")
+    parser.add_argument("--replicas", type=str, default="", help="containers of the ASR to run and balance over e.g. cq=4")
+    parser.add_argument("--endpoints", type=str, default="", help="servers started outside SpeechLoop to load test instead e.g. cq=http://10.0.0.2:3200|http://10.0.0.3:3200")
+    parsed_args = parser.parse_args(args)
+
+    loadtest(
+        parsed_args.wanted_asr,
+        parsed_args.input_csv,
+        concurrency=parsed_args.concurrency,
+        qps=parsed_args.qps,
+        level_seconds=parsed_args.level_seconds,
+        warmup_seconds=parsed_args.warmup_seconds,
+        timeout=parsed_args.timeout,
+        stop_error_rate=parsed_args.stop_error_rate,
+        max_files=parsed_args.max_files,
+        home_dir=parsed_args.home_dir,
+        column_audiofile=parsed_args.column_audiofile,
+        vosk_chunk_size=parsed_args.vosk_chunk_size,
+        vosk_streaming=parsed_args.vosk_streaming,
+        aws_max_streams=parsed_args.aws_max_streams,
+        server_streaming=parsed_args.server_streaming,
+        server_chunk_size=parsed_args.server_chunk_size,
+        replicas=parsed_args.replicas,
+        endpoints=parsed_args.endpoints,
+    )
+
+
+if __name__ == "__main__":
+    loadtest_main()
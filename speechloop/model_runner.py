@@ -1,25 +1,60 @@
-import datetime, time
+import asyncio, datetime, threading, time, warnings
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
+from tqdm import tqdm
 from speechloop.file_utils import flush_buffers, valid_readable_file
+from speechloop.asr.base_asr import run_sync, track_backoff, track_stream_latency
+from speechloop.checkpoint import Checkpoint
+from speechloop.cache import TranscriptionCache
+from speechloop.hash_utils import hash_bytes
+from speechloop.call_stats import wav_duration
+from speechloop import tracing
 
 MAX_RETRIES = 3
+# seconds between retries, kept out of the inference time
+RETRY_DELAY = 1
+RUNNERS = ["sequential", "threads", "async"]
+MISSING_FILE = "<Missing file error>"
 
 
-def add_transcriptions(df: pd.DataFrame, list_of_asr: list, shell_script_mode: bool, wav_delay: float) -> pd.DataFrame:
+def add_transcriptions(
+    df: pd.DataFrame,
+    list_of_asr: list,
+    shell_script_mode: bool,
+    runner: str = "sequential",
+    max_in_flight: int = 1,
+    checkpoint: Checkpoint = None,
+    cache: TranscriptionCache = None,
+    batch_size: int = 1,
+) -> pd.DataFrame:
     """
     Responsible for driving the wav_run_manager and adding transcriptions
 
     :param:
     df: Input dataframe that needs following headers: text, wav_filename
-    list_of_asr: list of ASR to test the file against
+    list_of_asr: list of ASR to test the file against, each request waits on the ASR's own rate_limiter
+    runner: "sequential" sends each file to each ASR in turn, "threads" gives each ASR its own pool of threads that work
+        through the files independently of the other ASRs and "async" does the same on a single event loop
+    max_in_flight: (threads/async runner only) max requests in flight per ASR, each ASR works through the files at its own pace
+    checkpoint: if given every result is appended to it as soon as it finishes and (file, ASR) pairs already in it are skipped
+    cache: if given it is checked before sending audio to an ASR and every new transcript is added to it
+    batch_size: if >1 files are sent to each ASR this many at a time using its execute_batch_async (one request per batch for
+        engines with a batch endpoint), max_in_flight batches are worked on at once. This always runs on the event loop.
 
     :returns: out_df that is returned which contains extra columns for each ASR transcript
     """
-    if shell_script_mode:
+    if batch_size > 1:
+        trans_df = run_sync(batch_transcriptions(df, list_of_asr, shell_script_mode, batch_size, max_in_flight, checkpoint, cache))
+    elif runner == "threads":
+        trans_df = threaded_transcriptions(df, list_of_asr, shell_script_mode, max_in_flight, checkpoint, cache)
+    elif runner == "async":
+        trans_df = run_sync(async_transcriptions(df, list_of_asr, shell_script_mode, max_in_flight, checkpoint, cache))
+    elif shell_script_mode:
         # when in shell script mode we don't want the weird progress bar to ruin the logs
-        trans_df = df.apply(lambda row: wav_run_manager(row, list_of_asr, wav_delay), axis=1)
+        trans_df = df.apply(lambda row: wav_run_manager(row, list_of_asr, checkpoint=checkpoint, cache=cache), axis=1)
     else:
-        trans_df = df.progress_apply(lambda row: wav_run_manager(row, list_of_asr, wav_delay), axis=1)
+        trans_df = df.progress_apply(lambda row: wav_run_manager(row, list_of_asr, checkpoint=checkpoint, cache=cache), axis=1)
     renamecol = {k: v.name for k, v in enumerate(list_of_asr)}
     trans_df.rename(columns=renamecol, inplace=True)
     out_df = pd.concat([df, trans_df], axis=1, sort=False)
@@ -27,40 +62,413 @@ def add_transcriptions(df: pd.DataFrame, list_of_asr: list, shell_script_mode: b
     return out_df
 
 
-def wav_run_manager(row: dict, list_of_asr: list, wav_delay: float) -> pd.Series:
+class RowProgress:
+    """Progress bar of rows, a row is done when every ASR has finished it. Safe to update from several threads"""
+
+    def __init__(self, rows: int, n_asr: int, shell_script_mode: bool):
+        self.remaining = [n_asr] * rows
+        self.bar = None if shell_script_mode else tqdm(total=rows)
+        self._lock = threading.Lock()
+
+    def done(self, i: int):
+        with self._lock:
+            self.remaining[i] -= 1
+            if self.remaining[i] == 0 and self.bar is not None:
+                self.bar.update()
+
+    def close(self):
+        if self.bar is not None:
+            self.bar.close()
+
+
+def threaded_transcriptions(
+    df: pd.DataFrame, list_of_asr: list, shell_script_mode: bool, max_in_flight: int = 1, checkpoint: Checkpoint = None, cache: TranscriptionCache = None
+) -> pd.DataFrame:
+    """
+    Concurrent version of the df.apply in add_transcriptions. Each ASR has its own max_in_flight worker threads that work
+    through the rows, so no ASR ever has more than max_in_flight requests outstanding and an ASR waiting on its rate limit
+    doesn't hold up the others.
+
+    Results come back in the same order and shape as the sequential path.
+    """
+    max_in_flight = max(1, max_in_flight)
+    rows = [row for _, row in df.iterrows()]
+    trans = [[None] * len(list_of_asr) for _ in rows]
+    progress = RowProgress(len(rows), len(list_of_asr), shell_script_mode)
+
+    def worker(k, asr, todo, lock):
+        while True:
+            # todo is shared between the ASR's workers, each one takes a different row
+            with lock:
+                i = next(todo, None)
+            if i is None:
+                return
+            trans[i][k] = transcribe_row(rows[i], asr, checkpoint, cache)
+            progress.done(i)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight * len(list_of_asr)) as pool:
+        futures = []
+        for k, asr in enumerate(list_of_asr):
+            todo, lock = iter(range(len(rows))), threading.Lock()
+            futures += [pool.submit(worker, k, asr, todo, lock) for _ in range(max_in_flight)]
+        for future in futures:
+            future.result()
+    progress.close()
+    return pd.DataFrame(trans, index=df.index, columns=range(len(list_of_asr)))
+
+
+async def async_transcriptions(
+    df: pd.DataFrame, list_of_asr: list, shell_script_mode: bool, max_in_flight: int = 1, checkpoint: Checkpoint = None, cache: TranscriptionCache = None
+) -> pd.DataFrame:
+    """
+    Asyncio version of threaded_transcriptions, the whole dataset is run on one event loop using each ASR's
+    execute_with_audio_async. Each ASR has its own max_in_flight workers that take the next row.
+    """
+    rows = [row for _, row in df.iterrows()]
+    trans = [[None] * len(list_of_asr) for _ in rows]
+    progress = RowProgress(len(rows), len(list_of_asr), shell_script_mode)
+
+    async def worker(k, asr, todo):
+        # todo is shared between the ASR's workers, each next() call hands out a different row
+        for i in todo:
+            trans[i][k] = await transcribe_row_async(rows[i], asr, checkpoint, cache)
+            progress.done(i)
+
+    workers = []
+    for k, asr in enumerate(list_of_asr):
+        todo = iter(range(len(rows)))
+        workers += [worker(k, asr, todo) for _ in range(max(1, max_in_flight))]
+    await asyncio.gather(*workers)
+    progress.close()
+    return pd.DataFrame(trans, index=df.index, columns=range(len(list_of_asr)))
+
+
+async def batch_transcriptions(
+    df: pd.DataFrame,
+    list_of_asr: list,
+    shell_script_mode: bool,
+    batch_size: int,
+    max_in_flight: int = 1,
+    checkpoint: Checkpoint = None,
+    cache: TranscriptionCache = None,
+) -> pd.DataFrame:
+    """
+    Like async_transcriptions but each worker takes the next batch_size rows and sends them to every ASR as one batch.
+    """
+    rows = [row for _, row in df.iterrows()]
+    batches = iter(range(0, len(rows), batch_size))
+    trans = [None] * len(rows)
+    progress = None if shell_script_mode else tqdm(total=len(rows))
+
+    async def worker():
+        # batches is shared between workers, each next() call hands out a different batch
+        for start in batches:
+            batch_rows = rows[start : start + batch_size]
+            trans[start : start + len(batch_rows)] = await batch_run_manager(batch_rows, list_of_asr, checkpoint, cache)
+            if progress is not None:
+                progress.update(len(batch_rows))
+
+    await asyncio.gather(*[worker() for _ in range(max(1, max_in_flight))])
+    if progress is not None:
+        progress.close()
+    return pd.DataFrame(trans, index=df.index, columns=range(len(list_of_asr)))
+
+
+def execute_limited(asr, audio_bytes: bytes):
+    """
+    One request to the ASR once its rate limiter allows it
+
+    :return: transcript, the time spent waiting on the rate limiter and the time the engine backed off from a busy server
+    """
+    waited = asr.rate_limiter.acquire()
+    try:
+        with track_backoff() as backoff:
+            text = asr.execute_with_audio(audio_bytes)
+        return text, datetime.timedelta(seconds=waited), backed_off(asr, backoff)
+    finally:
+        asr.rate_limiter.release()
+
+
+async def execute_limited_async(asr, audio_bytes: bytes):
+    waited = await asr.rate_limiter.acquire_async()
+    try:
+        with track_backoff() as backoff:
+            text = await asr.execute_with_audio_async(audio_bytes)
+        return text, datetime.timedelta(seconds=waited), backed_off(asr, backoff)
+    finally:
+        asr.rate_limiter.release_async()
+
+
+def backed_off(asr, backoff: list) -> datetime.timedelta:
+    backoff = datetime.timedelta(seconds=sum(backoff))
+    asr.add_backoff_time(backoff)
+    return backoff
+
+
+def from_checkpoint(asr, wav_file: str, checkpoint: Checkpoint):
+    """
+    :return: the transcript if this file was already done by this ASR in a previous run, else None
     """
+    entry = checkpoint.get(wav_file, asr.name) if checkpoint is not None else None
+    if entry is None:
+        return None
+    asr.add_time(datetime.timedelta(seconds=entry["inf_time"]))
+    return entry["transcript"]
+
+
+def from_cache(asr, audio_hash: str, cache: TranscriptionCache, wav_file: str, checkpoint: Checkpoint):
+    """
+    :return: the transcript if this audio was already transcribed by an ASR with the same config, else None
+    """
+    entry = cache.get(audio_hash, asr) if cache is not None else None
+    if entry is None:
+        return None
+    # the engine's time for it was spent in an earlier run, it isn't inference time or a call of this one
+    asr.add_cache_hit(datetime.timedelta(seconds=entry["inf_time"]))
+    if checkpoint is not None:
+        checkpoint.record(wav_file, asr.name, entry["transcript"], 0.0)
+    return entry["transcript"]
+
+
+def finish_asr(
+    asr, text: str, inf_time: datetime.timedelta, waited: datetime.timedelta, wav_file: str, checkpoint: Checkpoint, cache: TranscriptionCache = None, audio_hash: str = None
+):
+    asr.add_time(inf_time)
+    asr.add_wait_time(waited)
+    # errors are not checkpointed/cached so that a resumed run tries them again
+    if text == asr.return_error():
+        return
+    if checkpoint is not None:
+        checkpoint.record(wav_file, asr.name, text, inf_time.total_seconds())
+    if cache is not None:
+        cache.put(audio_hash, asr, text, inf_time.total_seconds())
+
+
+def run_asr(asr, audio_bytes: bytes, wav_file: str = None, checkpoint: Checkpoint = None, cache: TranscriptionCache = None, audio_hash: str = None) -> str:
+    """
+    Send audio to a single ASR, retrying on error up to MAX_RETRIES and adding the time taken to the ASR's total and
+    its per call stats. Time waiting on the rate limiter is added to the ASR's wait time instead.
+    """
+    done = from_checkpoint(asr, wav_file, checkpoint)
+    if done is None:
+        done = from_cache(asr, audio_hash, cache, wav_file, checkpoint)
+    if done is not None:
+        return done
+
+    asr_start = datetime.datetime.now()
+
+    with tracing.span(asr.name, cat="engine", overlapping=True, file=wav_file), track_stream_latency() as streamed:
+        text, waited, backoff = execute_limited(asr, audio_bytes)
+        attempts = 1
 
-    Function responsible for checking that file is valid and readable, then send it to every one of the ASRs
+        # checks that if an error is received the run is repeated until MAX_RETRIES is reached
+        while text == asr.return_error() and attempts < MAX_RETRIES:
+            time.sleep(RETRY_DELAY)
+            print(f"{text} ---> attempt:{attempts}")
+            text, retry_waited, retry_backoff = execute_limited(asr, audio_bytes)
+            waited += retry_waited
+            backoff += retry_backoff
+            attempts += 1
+
+    inf_time = datetime.datetime.now() - asr_start - waited - backoff - datetime.timedelta(seconds=RETRY_DELAY * (attempts - 1))
+    asr.add_call(inf_time, attempts, wav_duration(audio_bytes), failed=text == asr.return_error(), stream_latency=streamed[-1] if streamed else None)
+    finish_asr(asr, text, inf_time, waited, wav_file, checkpoint, cache, audio_hash)
+    return text
+
+
+async def run_asr_async(
+    asr,
+    audio_bytes: bytes,
+    wav_file: str = None,
+    checkpoint: Checkpoint = None,
+    cache: TranscriptionCache = None,
+    audio_hash: str = None,
+    earlier_attempts: int = 0,
+    earlier_time: datetime.timedelta = datetime.timedelta(0),
+) -> str:
+    """
+    Async version of run_asr, retry sleeps and rate limiting don't block the other ASRs/files
+
+    :param earlier_attempts: failed attempts already made at this file (its share of a batch), they count towards
+        MAX_RETRIES and earlier_time, their inference time, is part of the file's call
+    """
+    done = from_checkpoint(asr, wav_file, checkpoint)
+    if done is None:
+        done = from_cache(asr, audio_hash, cache, wav_file, checkpoint)
+    if done is not None:
+        return done
+
+    asr_start = datetime.datetime.now()
+
+    with tracing.span(asr.name, cat="engine", overlapping=True, file=wav_file), track_stream_latency() as streamed:
+        text, waited, backoff = await execute_limited_async(asr, audio_bytes)
+        attempts = earlier_attempts + 1
+
+        while text == asr.return_error() and attempts < MAX_RETRIES:
+            await asyncio.sleep(RETRY_DELAY)
+            print(f"{text} ---> attempt:{attempts}")
+            text, retry_waited, retry_backoff = await execute_limited_async(asr, audio_bytes)
+            waited += retry_waited
+            backoff += retry_backoff
+            attempts += 1
+
+    retry_sleeps = datetime.timedelta(seconds=RETRY_DELAY * (attempts - earlier_attempts - 1))
+    inf_time = earlier_time + datetime.datetime.now() - asr_start - waited - backoff - retry_sleeps
+    asr.add_call(inf_time, attempts, wav_duration(audio_bytes), failed=text == asr.return_error(), stream_latency=streamed[-1] if streamed else None)
+    finish_asr(asr, text, inf_time, waited, wav_file, checkpoint, cache, audio_hash)
+    return text
+
+
+async def execute_batch_limited(asr, audios: list):
+    """One batch request to the ASR once its rate limiter allows it"""
+    waited = await asr.rate_limiter.acquire_async()
+    try:
+        with track_backoff() as backoff:
+            texts, item_seconds = await asr.execute_batch_async(audios)
+        return texts, item_seconds, datetime.timedelta(seconds=waited), backed_off(asr, backoff)
+    finally:
+        asr.rate_limiter.release_async()
+
+
+async def run_asr_batch(asr, audios: list, wav_files: list, checkpoint: Checkpoint = None, cache: TranscriptionCache = None, audio_hashes: list = None) -> list:
+    """
+    Batch version of run_asr_async. Files already in the checkpoint/cache are not sent, the rest go in one batch and any
+    that come back as an error are retried on their own with run_asr_async, the batch counting as their first attempt.
+
+    The time the batch took is shared between its files in proportion to the time the engine says it spent on each, or
+    evenly if it doesn't say.
+    """
+    audio_hashes = audio_hashes or [None] * len(audios)
+    results = [None] * len(audios)
+    todo = []
+    for i, wav_file in enumerate(wav_files):
+        done = from_checkpoint(asr, wav_file, checkpoint)
+        if done is None:
+            done = from_cache(asr, audio_hashes[i], cache, wav_file, checkpoint)
+        if done is None:
+            todo.append(i)
+        results[i] = done
+    if not todo:
+        return results
+
+    batch_start = datetime.datetime.now()
+    with tracing.span(f"{asr.name} batch", cat="engine", overlapping=True, files=len(todo)):
+        texts, item_seconds, waited, backoff = await execute_batch_limited(asr, [audios[i] for i in todo])
+    elapsed = datetime.datetime.now() - batch_start - waited - backoff
+    if len(texts) != len(todo) or (item_seconds is not None and len(item_seconds) != len(todo)):
+        # can't tell which transcript is which file, retry them all on their own
+        times = "" if item_seconds is None else f" and {len(item_seconds)} times"
+        warnings.warn(f"{asr.name} returned {len(texts)} transcripts{times} for a batch of {len(todo)} files, retrying them one at a time")
+        texts, item_seconds = [asr.return_error()] * len(todo), None
+    shares = item_seconds if item_seconds and sum(item_seconds) > 0 else [1.0] * len(todo)
+
+    for i, text, share in zip(todo, texts, shares):
+        fraction = share / sum(shares)
+        if text == asr.return_error():
+            # the file's share of the batch goes in the call of its retry
+            asr.add_wait_time(waited * fraction)
+            results[i] = await run_asr_async(asr, audios[i], wav_files[i], checkpoint, cache, audio_hashes[i], 1, elapsed * fraction)
+        else:
+            asr.add_call(elapsed * fraction, 1, wav_duration(audios[i]))
+            finish_asr(asr, text, elapsed * fraction, waited * fraction, wav_files[i], checkpoint, cache, audio_hashes[i])
+            results[i] = text
+    return results
+
+
+def read_bytes(wav_file: str) -> bytes:
+    with open(wav_file, "rb") as f:
+        return f.read()
+
+
+def wav_run_manager(row: dict, list_of_asr: list, checkpoint: Checkpoint = None, cache: TranscriptionCache = None) -> pd.Series:
+    """
+
+    Function responsible for checking that file is valid and readable, then send it to every one of the ASRs in turn
 
     :param row: row is a path to a wav file
     :param list_of_asr: list of ASR to test the file against
+    :param checkpoint: results are recorded here, pairs that are already in it are not run again
+    :param cache: transcription cache looked up by the md5 of the audio
     :return: Pandas Series that contains ASR results from row WAV that is the size of the number of ASRs
     """
     flush_buffers()
 
     wav_file = row["filename"]
-    result = []
 
     # loop through every ASR
-    if valid_readable_file(wav_file):
-        audio_bytes = open(wav_file, "rb").read()
-        for asr in list_of_asr:
-            asr_start = datetime.datetime.now()
+    if checkpoint is not None and checkpoint.has_all(wav_file, [asr.name for asr in list_of_asr]):
+        # finished in a previous run, no need to read the file
+        return pd.Series([from_checkpoint(asr, wav_file, checkpoint) for asr in list_of_asr])
+    elif valid_readable_file(wav_file):
+        audio_bytes = read_bytes(wav_file)
+        audio_hash = hash_bytes(audio_bytes) if cache is not None else None
+        return pd.Series([run_asr(asr, audio_bytes, wav_file, checkpoint, cache, audio_hash) for asr in list_of_asr])
+    else:
+        return pd.Series([MISSING_FILE] * len(list_of_asr))
 
-            text = asr.execute_with_audio(audio_bytes)
-            attempts = 1
 
-            # checks that if an error is received the run is repeated until MAX_RETRIES is reached
-            while text == asr.return_error() and attempts < MAX_RETRIES:
-                time.sleep(1)
-                print(f"{text} ---> attempt:{attempts}")
-                text = asr.execute_with_audio(audio_bytes)
-                attempts += 1
+def transcribe_row(row: dict, asr, checkpoint: Checkpoint = None, cache: TranscriptionCache = None) -> str:
+    """
+    One ASR's transcript of the row's file, for runners where each ASR works through the rows on its own. The file is
+    read by each ASR that needs it.
+    """
+    flush_buffers()
 
-            result.append(text)
-            asr.add_time(datetime.datetime.now() - asr_start)
-            time.sleep(wav_delay)
+    wav_file = row["filename"]
 
-        return pd.Series(result)
+    if checkpoint is not None and checkpoint.has_all(wav_file, [asr.name]):
+        return from_checkpoint(asr, wav_file, checkpoint)
+    elif valid_readable_file(wav_file):
+        audio_bytes = read_bytes(wav_file)
+        return run_asr(asr, audio_bytes, wav_file, checkpoint, cache, hash_bytes(audio_bytes) if cache is not None else None)
     else:
-        return pd.Series(["<Missing file error>"] * len(list_of_asr))
+        return MISSING_FILE
+
+
+async def transcribe_row_async(row: dict, asr, checkpoint: Checkpoint = None, cache: TranscriptionCache = None) -> str:
+    """Async version of transcribe_row"""
+    flush_buffers()
+
+    wav_file = row["filename"]
+
+    if checkpoint is not None and checkpoint.has_all(wav_file, [asr.name]):
+        return from_checkpoint(asr, wav_file, checkpoint)
+    elif valid_readable_file(wav_file):
+        # file reads can be slow on network storage so keep them off the loop
+        audio_bytes = await asyncio.get_event_loop().run_in_executor(None, read_bytes, wav_file)
+        return await run_asr_async(asr, audio_bytes, wav_file, checkpoint, cache, hash_bytes(audio_bytes) if cache is not None else None)
+    else:
+        return MISSING_FILE
+
+
+async def batch_run_manager(rows: list, list_of_asr: list, checkpoint: Checkpoint = None, cache: TranscriptionCache = None) -> list:
+    """
+    Batch version of wav_run_manager_async, the readable files of the batch are sent to every ASR at once
+
+    :return: one list of ASR results per row
+    """
+    flush_buffers()
+
+    wav_files = [row["filename"] for row in rows]
+    names = [asr.name for asr in list_of_asr]
+    loop = asyncio.get_event_loop()
+
+    trans = [None] * len(rows)
+    to_send = []
+    for i, wav_file in enumerate(wav_files):
+        if checkpoint is not None and checkpoint.has_all(wav_file, names):
+            trans[i] = [from_checkpoint(asr, wav_file, checkpoint) for asr in list_of_asr]
+        elif valid_readable_file(wav_file):
+            to_send.append(i)
+        else:
+            trans[i] = [MISSING_FILE] * len(list_of_asr)
+    if not to_send:
+        return trans
+
+    audios = await asyncio.gather(*[loop.run_in_executor(None, read_bytes, wav_files[i]) for i in to_send])
+    audio_hashes = [hash_bytes(audio) for audio in audios] if cache is not None else None
+    send_files = [wav_files[i] for i in to_send]
+    by_asr = await asyncio.gather(*[run_asr_batch(asr, audios, send_files, checkpoint, cache, audio_hashes) for asr in list_of_asr])
+    for k, i in enumerate(to_send):
+        trans[i] = [results[k] for results in by_asr]
+    return trans
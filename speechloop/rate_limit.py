@@ -0,0 +1,133 @@
+"""
+Per ASR rate limiting. Each ASR gets its own token bucket (requests/sec) and an optional cap on concurrent requests, so
+waiting for a slow cloud API's quota never holds up a local docker engine.
+"""
+
+import asyncio
+import math
+import re
+import threading
+import time
+import weakref
+from typing import Dict
+
+from speechloop.engine_settings import parse_engine_settings
+
+RATE_RE = re.compile(r"^(?P<rate>\d+(\.\d+)?)/(?P<unit>s|m)(:(?P<concurrent>\d+))?$")
+
+
+class RateLimitParseError(ValueError):
+    pass
+
+
+class RateLimiter:
+    """
+    Token bucket allowing `rate` requests per second (with bursts of up to `burst`) and at most `max_concurrent` requests
+    in flight. rate=None or max_concurrent=None means unlimited.
+
+    Tokens are reserved under a lock and the wait happens outside it, so waiting never blocks other threads longer than
+    their own reservation.
+    """
+
+    def __init__(self, rate: float = None, max_concurrent: int = None, burst: float = 1.0):
+        self.rate = rate
+        self.max_concurrent = max_concurrent
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        self._async_semaphores = weakref.WeakKeyDictionary()
+
+    def __repr__(self):
+        rate = "unlimited" if self.rate is None else f"{self.rate:g}/s"
+        return f"RateLimiter({rate}, max_concurrent={self.max_concurrent})"
+
+    def reserve(self) -> float:
+        """Take a token and return how many seconds to wait before it may be used"""
+        if self.rate is None:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self) -> float:
+        """Blocking wait for a token and a concurrency slot, returns the seconds spent waiting"""
+        if self.rate is None and self._semaphore is None:
+            return 0.0
+        start = time.monotonic()
+        if self._semaphore is not None:
+            self._semaphore.acquire()
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return time.monotonic() - start
+
+    def release(self):
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def _async_semaphore(self):
+        # asyncio semaphores belong to a loop, keep one per loop
+        loop = asyncio.get_event_loop()
+        with self._lock:
+            if loop not in self._async_semaphores:
+                self._async_semaphores[loop] = asyncio.Semaphore(self.max_concurrent)
+            return self._async_semaphores[loop]
+
+    async def acquire_async(self) -> float:
+        """Same as acquire but only suspends the calling coroutine"""
+        if self.rate is None and not self.max_concurrent:
+            return 0.0
+        start = time.monotonic()
+        if self.max_concurrent:
+            await self._async_semaphore().acquire()
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return time.monotonic() - start
+
+    def release_async(self):
+        if self.max_concurrent:
+            self._async_semaphore().release()
+
+
+def parse_rate_limit(spec: str, share: int = 1) -> RateLimiter:
+    """
+    Parse a single limit e.g. "5/s", "120/m", "20/s:4" (20 per second with at most 4 in flight) or "unlimited".
+    The limit is divided by `share` when it is split between several worker processes.
+    """
+    spec = spec.strip().lower()
+    if spec in ("", "unlimited", "none"):
+        return RateLimiter()
+    m = RATE_RE.match(spec)
+    if m is None:
+        raise RateLimitParseError(f"Could not understand rate limit: '{spec}' expected e.g. 5/s, 120/m, 20/s:4 or unlimited")
+    rate = float(m.group("rate")) / (60.0 if m.group("unit") == "m" else 1.0)
+    concurrent = int(m.group("concurrent")) if m.group("concurrent") else None
+    if concurrent is not None:
+        concurrent = max(1, math.ceil(concurrent / share))
+    return RateLimiter(rate=rate / share, max_concurrent=concurrent)
+
+
+def parse_rate_limits(rate_limits: str) -> Dict[str, str]:
+    """Split "gg=5/s,az=20/s:4,vs=unlimited" into {"gg": "5/s", "az": "20/s:4", "vs": "unlimited"}"""
+    return parse_engine_settings(rate_limits, "Rate limit", "<asr code>=<limit> e.g. gg=5/s", RateLimitParseError)
+
+
+def apply_rate_limits(list_of_asr: list, rate_limits: str = "", wav_delay: float = 0.0, share: int = 1) -> None:
+    """
+    Give every ASR its own RateLimiter. ASRs without an entry in rate_limits fall back to one request every wav_delay
+    seconds (the old behaviour of --wav_delay) or unlimited.
+    """
+    limits = parse_rate_limits(rate_limits)
+    for asr in list_of_asr:
+        if asr.name in limits:
+            asr.rate_limiter = parse_rate_limit(limits[asr.name], share)
+        elif wav_delay > 0:
+            asr.rate_limiter = RateLimiter(rate=1.0 / wav_delay / share)
+        else:
+            asr.rate_limiter = RateLimiter()
@@ -27,4 +27,26 @@ def run_arguments(args=None):
         parsed_args.enable_compute_hashes,
         parsed_args.column_audiofile,
         parsed_args.column_transcript,
+        runner=parsed_args.runner,
+        max_in_flight=parsed_args.max_in_flight,
+        workers=parsed_args.workers,
+        rate_limits=parsed_args.rate_limits,
+        enable_checkpoint=parsed_args.enable_checkpoint,
+        resume=parsed_args.resume,
+        cache_dir=parsed_args.cache_dir,
+        cache_max_mb=parsed_args.cache_max_mb,
+        chunksize=parsed_args.chunksize,
+        audio_index=parsed_args.audio_index,
+        pool_size=parsed_args.pool_size,
+        vosk_chunk_size=parsed_args.vosk_chunk_size,
+        vosk_streaming=parsed_args.vosk_streaming,
+        aws_max_streams=parsed_args.aws_max_streams,
+        aws_realtime=parsed_args.aws_realtime,
+        batch_size=parsed_args.batch_size,
+        server_streaming=parsed_args.server_streaming,
+        server_chunk_size=parsed_args.server_chunk_size,
+        replicas=parsed_args.replicas,
+        endpoints=parsed_args.endpoints,
+        trace=parsed_args.trace,
+        trace_memory=parsed_args.trace_memory,
     )
@@ -1,5 +1,9 @@
 from distutils.util import strtobool
 
+from speechloop.model_runner import RUNNERS
+from speechloop.asr.streaming import STREAMING_MODES, DEFAULT_CHUNK_SIZE
+from speechloop.asr.aws import DEFAULT_MAX_STREAMS
+
 """These arguments are shared between the wizard cli that is invoked with just speechloop and the core program"""
 
 
@@ -15,7 +19,15 @@ def _add_all_arguments(parser):
         "--wav_delay",
         type=float,
         default=0.0,
-        help="wav delay is the number of seconds to wait between each file. If this is too small it may overload the server(s) and corrupt results",
+        help="wav delay is the min number of seconds between requests to each ASR. If this is too small it may overload the server(s) and corrupt results. "
+        "Only used for ASRs that are not set in --rate_limits",
+    )
+    parser.add_argument(
+        "--rate_limits",
+        type=str,
+        default="",
+        help="per ASR rate limits, comma delimited <code>=<limit> where limit is requests per second/minute with an optional max concurrent requests "
+        "e.g. gg=5/s,az=20/s:4,aw=120/m,vs=unlimited",
     )
     parser.add_argument(
         "--shell_script_mode",
@@ -41,6 +53,97 @@ def _add_all_arguments(parser):
         default=False,
         help="if True (False default) will add a hash column for audio + ground_truth, used for ensuring result is from same dataset by taking hash of sorted hashes ",
     )
+    parser.add_argument(
+        "--runner",
+        type=str,
+        default="sequential",
+        choices=RUNNERS,
+        help="sequential (default) sends each file to each ASR one after another. threads/async send each file to all the ASRs at the same time",
+    )
+    parser.add_argument(
+        "--max_in_flight", type=int, default=1, help="max requests in flight for each ASR (threads/async runner only), each ASR works through the files at its own pace"
+    )
+    parser.add_argument(
+        "--pool_size",
+        type=int,
+        default=0,
+        help="max keep-alive connections each HTTP based ASR (coqui, sphinx, azure) keeps open at once, 0 (default) uses --max_in_flight",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="if >1 files are sent to each ASR this many at a time, sphinx and coqui transcribe a batch in one request. --max_in_flight batches are sent at once",
+    )
+    parser.add_argument("--vosk_chunk_size", type=int, default=DEFAULT_CHUNK_SIZE, help="bytes of audio sent to vosk per websocket message")
+    parser.add_argument(
+        "--vosk_streaming",
+        type=str,
+        default="pipelined",
+        choices=STREAMING_MODES,
+        help="lockstep waits for the reply to each chunk before sending the next, pipelined (default) sends and receives at the same time, realtime is pipelined but paced like live audio",
+    )
+    parser.add_argument(
+        "--server_streaming",
+        type=str,
+        default="off",
+        choices=["off"] + STREAMING_MODES,
+        help="off (default) sends whole files to sphinx and coqui, otherwise they are streamed to the servers' websocket like vosk (see --vosk_streaming) to measure time to first partial and to final",
+    )
+    parser.add_argument("--server_chunk_size", type=int, default=DEFAULT_CHUNK_SIZE, help="bytes of audio per websocket message when --server_streaming is on")
+    parser.add_argument(
+        "--replicas",
+        type=str,
+        default="",
+        help="containers to run per local ASR (vs, sp, cq) on consecutive ports from the usual one e.g. vs=4,cq=8. Requests go to the replica with the fewest in flight",
+    )
+    parser.add_argument(
+        "--endpoints",
+        type=str,
+        default="",
+        help="servers started outside SpeechLoop to use instead of containers, | between the URLs of an ASR e.g. cq=http://10.0.0.2:3200|http://10.0.0.3:3200,vs=ws://10.0.0.2:2700",
+    )
+    parser.add_argument("--aws_max_streams", type=int, default=DEFAULT_MAX_STREAMS, help="max AWS transcribe streams open at once (per worker process)")
+    parser.add_argument("--aws_realtime", type=strtobool, default=False, help="if True audio is sent to AWS no faster than it would play, like a live stream")
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default="",
+        help="write a Chrome trace JSON file of every stage (import, validate, hashes, transcribe, normalize, wer, save) and engine call here, open it in chrome://tracing or ui.perfetto.dev",
+    )
+    parser.add_argument("--trace_memory", type=strtobool, default=True, help="with --trace, record the memory and peak memory of each stage using tracemalloc (slows the run down)")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes. If >1 the data is split into shards which each run in their own process with their own ASR objects, useful for very large CSVs",
+    )
+    parser.add_argument(
+        "--enable_checkpoint",
+        type=strtobool,
+        default=True,
+        help="if False (True default) results are not appended to a checkpoint file in <home_dir>/output/checkpoints as they finish",
+    )
+    parser.add_argument("--resume", type=str, default="", help="path to the checkpoint file of an interrupted run, files already transcribed by an ASR in it are skipped")
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="",
+        help="directory for the transcription cache (off by default). Audio already transcribed by an ASR with the same config is not sent again",
+    )
+    parser.add_argument("--cache_max_mb", type=float, default=1024, help="max size of the transcription cache, least recently used results are removed first")
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=0,
+        help="if >0 (0 default) the CSV(s) are streamed and processed this many rows at a time instead of loading them all first, useful for very large CSVs",
+    )
+    parser.add_argument(
+        "--audio_index",
+        type=str,
+        default="",
+        help="sidecar file of wav header info (duration, sample rate, channels) so later runs can skip reading the headers, default <home_dir>/output/audio_index.jsonl, none disables it",
+    )
     parser.add_argument("--column_audiofile", type=str, default="filename", help="header in CSV which points to the audio file")
     parser.add_argument("--column_transcript", type=str, default="transcript", help="header in CSV which points to the ground_truth")
 
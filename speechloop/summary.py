@@ -1,17 +1,34 @@
 import datetime
+import json
+
+from speechloop.call_stats import PERCENTILES
+from speechloop.text import COUNT_SUFFIXES
 
 
 def print_wer_summary(list_of_asr, df_wer, start_time):
 
     try:
-        wer_cols = [c for c in df_wer.columns if "wer" in c]
+        wer_cols = [c for c in df_wer.columns if c.endswith("_wer")]
 
         for w in wer_cols:
             print("-" * 30)
-            print(f"Average value of {w} is {df_wer[w].mean():.4f}\n")
+            print(f"Average value of {w} is {df_wer[w].mean():.4f}")
+            hits, sub, dele, ins = [df_wer[w[:-4] + suffix].sum() for suffix in COUNT_SUFFIXES]
+            ref_words = hits + sub + dele
+            if ref_words > 0:
+                print(f"Corpus {w} is {(sub + dele + ins) / ref_words:.4f} (sub={sub} del={dele} ins={ins} over {ref_words} reference words)")
+            print()
 
         for asr in list_of_asr:
             print(f"Total inference time taken for {asr.name} is {asr.total_inf_time}")
+            if asr.cache_hits > 0:
+                print(f"{asr.cache_hits} of the {asr.name} transcripts came from the cache, saving {asr.cache_saved_time} of inference time")
+            if asr.connections_opened > 0:
+                print(f"{asr.name} opened {asr.connections_opened} connections, setting them up took {asr.total_connect_time} of the inference time")
+            if asr.total_wait_time.total_seconds() > 0:
+                print(f"Total time {asr.name} waited on its rate limit ({asr.rate_limiter}) is {asr.total_wait_time}")
+            if asr.total_backoff_time.total_seconds() > 0:
+                print(f"Total time {asr.name} backed off from a busy server is {asr.total_backoff_time}, this is not in the inference time")
 
         print("-" * 30)
         print("-" * 30)
@@ -22,3 +39,51 @@ def print_wer_summary(list_of_asr, df_wer, start_time):
         print(f"With an average of {((end_time - start_time).total_seconds() / df_wer.shape[0] ):.2f} secs per wav file")
     except Exception as e:
         print(f"Error printing summary: {e}")
+
+
+def engine_stats(list_of_asr, wall_seconds: float) -> dict:
+    """Latency distribution, throughput and real time factor of each ASR with its other run stats, keyed by ASR name"""
+    stats = {}
+    for asr in list_of_asr:
+        engine = asr.calls.summary(wall_seconds)
+        engine.update(
+            total_inf_time=asr.total_inf_time.total_seconds(),
+            total_wait_time=asr.total_wait_time.total_seconds(),
+            total_backoff_time=asr.total_backoff_time.total_seconds(),
+            cache_hits=asr.cache_hits,
+            cache_saved_time=asr.cache_saved_time.total_seconds(),
+            connections_opened=asr.connections_opened,
+            total_connect_time=asr.total_connect_time.total_seconds(),
+        )
+        if asr.streamed_files > 0:
+            engine["streamed_files"] = asr.streamed_files
+        stats[asr.name] = engine
+    return stats
+
+
+def format_percentiles(engine: dict, name: str) -> str:
+    if f"{name}_p{PERCENTILES[0]}" not in engine:
+        return "n/a"
+    return " ".join(f"p{p}={engine[f'{name}_p{p}']:.3f}s" for p in PERCENTILES)
+
+
+def print_latency_summary(stats: dict):
+    for name, engine in stats.items():
+        print("-" * 30)
+        if engine["calls"] == 0:
+            print(f"{name} made no requests (all results came from the checkpoint/cache)")
+            continue
+        print(
+            f"{name} latency {format_percentiles(engine, 'latency')} max={engine['latency_max']:.3f}s over {engine['calls']} files ({engine['retried_calls']} needed retries, {engine['failed_calls']} failed)"
+        )
+        rtf = f"{engine['rtf']:.3f}" if engine["rtf"] is not None else "n/a"
+        print(f"{name} throughput {engine['files_per_second']:.2f} files/s, {engine['audio_seconds_per_second']:.2f} audio secs/s, real time factor {rtf}")
+        if engine["streamed_calls"] > 0:
+            first, final = format_percentiles(engine, "first_partial"), format_percentiles(engine, "final")
+            print(f"{name} streamed {engine['streamed_calls']} files, time to first partial {first}, to final {final}")
+    print("-" * 30)
+
+
+def write_run_stats(path: str, stats: dict, wall_seconds: float):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"wall_seconds": wall_seconds, "engines": stats}, f, indent=2)
@@ -1,34 +1,36 @@
 from speechloop.asr.errors import DEFAULT_ERROR
-from simplepythonwer import wer
+from speechloop.wer import WordInterner, align_counts
+import numpy as np
 import pandas as pd
 from typing import List
 
+# alignment counts stored next to each <asr>_wer column, the reference word count is hits + sub + del
+COUNT_SUFFIXES = ["_hits", "_sub", "_del", "_ins"]
 
-def add_wer(df_trans: pd.DataFrame, wer_cols: List[str], column_transcript: str) -> pd.DataFrame:
-    # apply transcript to each member of list_of_asr
-    for w in wer_cols:
-        df_trans[w] = df_trans.apply(lambda row: wer_df(row, w, column_transcript), axis=1)
-    return df_trans
 
-
-def wer_df(row, asr, column_transcript):
+def add_wer(df_trans: pd.DataFrame, wer_cols: List[str], column_transcript: str) -> pd.DataFrame:
     """
+    Adds for each wer column (<shortcode>_cor_wer OR <shortcode>_wer) the WER of every row, value between 0 <--> 1.0, and
+    the hits, substitutions, deletions and insertions it came from (<shortcode>_cor_hits etc.) so corpus WER can be worked out.
 
-    Parameters
-    ----------
-    row: comes from dataframe apply
-    asr: can be <shortcode>_cor_wer OR <shortcode>_wer
-    column_transcript: name in the csv file for the column of transcripts
-
-    Returns, value between 0 <--> 1.0
-    -------
-
+    The ground truth is tokenized once and the same word ids are used for every ASR. Rows where the ASR returned an error
+    score 1.0 and count every reference word as deleted.
     """
-    asr_result = str(row[asr[:-4]]).lower()
-    ground_truth = str(row[column_transcript]).lower()
-
-    # return an error
-    if DEFAULT_ERROR.lower() in asr_result:
-        return 1.0
+    interner = WordInterner()
+    ref_ids, ref_len = interner.encode(df_trans[column_transcript].astype(str).str.lower())
 
-    return min(wer(asr_result.strip(), ground_truth.strip()), 1.0)
+    for w in wer_cols:
+        asr_results = df_trans[w[:-4]].astype(str).str.lower()
+        is_error = asr_results.str.contains(DEFAULT_ERROR.lower(), regex=False).to_numpy()
+        hyp_ids, hyp_len = interner.encode(asr_results)
+
+        counts = align_counts(ref_ids, ref_len, hyp_ids, hyp_len)
+        counts[is_error] = 0
+        counts[is_error, 2] = ref_len[is_error]
+
+        errors = counts[:, 1:].sum(axis=1)
+        # an empty ground truth is scored as a single word, as before
+        df_trans[w] = np.where(is_error, 1.0, np.minimum(errors / np.maximum(ref_len, 1), 1.0))
+        for i, suffix in enumerate(COUNT_SUFFIXES):
+            df_trans[w[:-4] + suffix] = counts[:, i]
+    return df_trans
@@ -0,0 +1,137 @@
+import contextlib
+import itertools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from typing import Iterable, Iterator, List
+
+# the tracer of this process, None when tracing is off so spans cost next to nothing
+_TRACER = None
+
+
+class Tracer:
+    """
+    Collects spans as Chrome trace format events, the saved file can be opened in chrome://tracing or https://ui.perfetto.dev
+
+    Stages run one after another on a thread so they are complete ("X") events. Engine calls overlap when several files
+    are in flight so they are async ("b"/"e") events, which viewers give their own rows.
+
+    With memory on, tracemalloc is started and every stage records the traced memory at its end and the peak during it.
+    tracemalloc slows python allocations down a lot, so timings are best compared between runs with the same setting.
+    """
+
+    def __init__(self, memory: bool = True, process_name: str = "speechloop"):
+        self.memory = memory
+        self.pid = os.getpid()
+        self.events = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.emit({"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0, "args": {"name": process_name}})
+
+    def emit(self, event: dict):
+        with self._lock:
+            self.events.append(event)
+
+    def drain(self) -> List[dict]:
+        """The events so far, which are removed, e.g. to send them from a worker process to the parent"""
+        with self._lock:
+            events, self.events = self.events, []
+        return events
+
+    def next_id(self) -> int:
+        with self._lock:
+            return next(self._ids)
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self.drain(), "displayTimeUnit": "ms"}, f)
+
+
+def now_us() -> int:
+    # the monotonic clock is system wide so worker process events line up with the parent's
+    return time.monotonic_ns() // 1000
+
+
+def start(memory: bool = True, process_name: str = "speechloop") -> Tracer:
+    global _TRACER
+    if _TRACER is None:
+        _TRACER = Tracer(memory, process_name)
+    return _TRACER
+
+
+def stop(path: str = None):
+    """Write the trace file (if given) and turn tracing off"""
+    global _TRACER
+    tracer, _TRACER = _TRACER, None
+    if tracer is None:
+        return
+    if path:
+        tracer.save(path)
+    if tracer.memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def enabled() -> bool:
+    return _TRACER is not None
+
+
+def drain() -> List[dict]:
+    return _TRACER.drain() if _TRACER is not None else []
+
+
+def add_events(events: List[dict]):
+    """Add events recorded by another process"""
+    if _TRACER is not None:
+        for event in events:
+            _TRACER.emit(event)
+
+
+@contextlib.contextmanager
+def span(name: str, cat: str = "stage", overlapping: bool = False, **args):
+    """
+    Time the block as a span. overlapping is for blocks that can run at the same time as others on the same thread (e.g.
+    engine calls in the async runner), they don't record memory. args are shown on the span in the viewer.
+    """
+    tracer = _TRACER
+    if tracer is None:
+        yield
+        return
+
+    if overlapping:
+        # local ids only have to be unique within the process, worker processes count from 0 too
+        base = {"name": name, "cat": cat, "id2": {"local": tracer.next_id()}, "pid": tracer.pid, "tid": 0}
+        tracer.emit(dict(base, ph="b", ts=now_us(), args=args))
+        try:
+            yield
+        finally:
+            tracer.emit(dict(base, ph="e", ts=now_us()))
+        return
+
+    if tracer.memory and hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    start_us = now_us()
+    try:
+        yield
+    finally:
+        end_us = now_us()
+        if tracer.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            args = dict(args, memory_mb=round(current / 2**20, 3), peak_memory_mb=round(peak / 2**20, 3))
+            tracer.emit({"name": "memory", "ph": "C", "ts": end_us, "pid": tracer.pid, "tid": 0, "args": {"traced MB": round(current / 2**20, 3)}})
+        tracer.emit({"name": name, "cat": cat, "ph": "X", "ts": start_us, "dur": end_us - start_us, "pid": tracer.pid, "tid": threading.get_ident(), "args": args})
+
+
+def traced(iterable: Iterable, name: str, cat: str = "stage") -> Iterator:
+    """Each step of the iterable as a span, e.g. reading each chunk of a CSV"""
+    iterator = iter(iterable)
+    while True:
+        with span(name, cat):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
@@ -1,7 +1,7 @@
-from speechloop.file_utils import valid_readable_file
+from speechloop.audio_index import AudioIndex, read_audio_info
 
 import re
-import wave
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 import pandas as pd
@@ -38,7 +38,27 @@ def passes_regex(text: str) -> bool:
         return False
 
 
-def validate_manditory_data(df: pd.DataFrame, wanted_asr: List[str], sr: int, column_audiofile: str = "filename"):
+# wav headers are read by this many threads at once, mostly waiting on (network) storage
+VALIDATION_THREADS = 32
+
+
+def audio_infos(filenames: List[str], audio_index: AudioIndex = None) -> List[dict]:
+    """
+    Header info (see audio_index.read_audio_info) of every file, None for files that can't be read. Files are read
+    concurrently and looked up in audio_index first if given.
+    """
+    get_info = audio_index.info if audio_index is not None else read_audio_info
+    with ThreadPoolExecutor(max_workers=VALIDATION_THREADS) as pool:
+        infos = list(pool.map(get_info, filenames))
+    if audio_index is not None:
+        audio_index.save()
+    return infos
+
+
+def validate_manditory_data(df: pd.DataFrame, wanted_asr: List[str], sr: int, column_audiofile: str = "filename", audio_index: AudioIndex = None):
+    """
+    Every file is checked in a single pass, all the bad files are printed before failing.
+    """
     print(f"Validating dataset CSV contains: {df.shape[0]} rows of files")
 
     # 0. check that at least 1 ASR is in wanted_asr
@@ -48,10 +68,19 @@ def validate_manditory_data(df: pd.DataFrame, wanted_asr: List[str], sr: int, co
     # 2. check that >=1 row of data
     assert df.shape[0] >= 1
     # 3. check that all files are valid readable files that exist
-    assert all(df[column_audiofile].apply(valid_readable_file).tolist())
-    # 4. pass through data and check that SampleRate is all same value as set in args
+    filenames = df[column_audiofile].tolist()
+    infos = audio_infos(filenames, audio_index)
+    unreadable = [f for f, info in zip(filenames, infos) if info is None]
+    for f in unreadable:
+        print(f"The following file has issues loading: {f}")
+    # 4. check that SampleRate is all same value as set in args, can only handle mono currently
+    wrong_format = []
     if sr != -1:
-        assert all(df[column_audiofile].apply(lambda f: validate_audio(f, sr)).tolist())
+        wrong_format = [(f, info) for f, info in zip(filenames, infos) if info is not None and (info["sample_rate"] != sr or info["channels"] != 1)]
+    for f, info in wrong_format:
+        print(f"The following file does not have correct SR:{sr} (found {info['sample_rate']}) or channel count: {info['channels']} -> {f}")
+
+    assert not unreadable and not wrong_format, f"{len(unreadable)} unreadable files and {len(wrong_format)} files with the wrong sample rate or channels"
 
     print("All manditory validation tests passed. Data looks ok.")
 
@@ -64,10 +93,16 @@ def validate_optional_csv_data(df: pd.DataFrame, enable_wer: bool, column_transc
     if enable_wer:
         # dw1. check that required columns exist transcript
         assert column_transcript in df.columns
-        # dw2. check that len of all transcripts > 0 and is ascii
-        assert all(df[column_transcript].apply(valid_text).tolist())
-        # dw3. check that transcripts contain only allowed regex]
-        assert all(df[column_transcript].apply(passes_regex).tolist())
+        texts = df[column_transcript].fillna("").astype(str)
+        # dw2. check that len of all transcripts > 0 and is ascii (same as valid_text)
+        not_ascii = ~texts.str.upper().str.fullmatch("[ -Z]+")
+        # dw3. check that transcripts contain only allowed regex (same as passes_regex)
+        not_regex = ~texts.str.lower().str.fullmatch("[a-z '.0-9]+")
+        for i, text in texts[not_ascii].items():
+            print(f"Problem with the text:'{text}' on row {i} is not valid ASCII")
+        for i, text in texts[not_regex & ~not_ascii].items():
+            print(f"Problem with the text:'{text}' on row {i} does not match the Regex")
+        assert not (not_ascii | not_regex).any(), f"{(not_ascii | not_regex).sum()} transcripts are empty or have characters that are not allowed"
 
     if enable_text_normalization:
         # should check that if text normalization is enabled the we must have transcript field
@@ -77,12 +112,11 @@ def validate_optional_csv_data(df: pd.DataFrame, enable_wer: bool, column_transc
 
 
 def validate_audio(filename: str, sr: int, verbose=True) -> bool:
-    with wave.open(filename, "rb") as wf:
-        found_sr = wf.getframerate()
-        channels = wf.getnchannels()
+    info = read_audio_info(filename) or {"sample_rate": None, "channels": None}
+    channels = info["channels"]
 
     # can only handle mono currently
-    if found_sr == sr and channels == 1:
+    if info["sample_rate"] == sr and channels == 1:
         return True
     else:
         if verbose:
@@ -0,0 +1,135 @@
+"""
+Batched word error rate. Every transcript is tokenized once into integer word ids (shared between all ASRs) and the
+edit distance of many (reference, hypothesis) pairs is computed at once with numpy, keeping the hits, substitutions,
+deletions and insertions of the best alignment rather than just the distance.
+"""
+
+from itertools import chain
+from typing import Iterable, Tuple
+
+import numpy as np
+import pandas as pd
+
+# max DP cells of a diagonal (pairs * (longest ref + 1)) kept at once, bounds the memory used by a batch. A pair longer
+# than this is aligned on its own
+MAX_BATCH_CELLS = 250_000
+
+
+class WordInterner:
+    """Maps each distinct word to an int id so that word comparisons are integer comparisons"""
+
+    def __init__(self):
+        self.vocab = pd.Index([], dtype=object)
+
+    def encode(self, texts: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Tokenize on whitespace
+
+        :return: the word ids of all texts one after another, and the number of words in each text
+        """
+        tokens = [text.split() for text in texts]
+        lengths = np.array([len(t) for t in tokens], dtype=np.int64)
+        words = np.array(list(chain.from_iterable(tokens)), dtype=object)
+        ids = self.vocab.get_indexer(words)
+        new = ids < 0
+        if new.any():
+            self.vocab = self.vocab.append(pd.Index(pd.unique(words[new])))
+            ids[new] = self.vocab.get_indexer(words[new])
+        return ids.astype(np.int32), lengths
+
+
+def _pad(ids: np.ndarray, offsets: np.ndarray, lengths: np.ndarray, rows: np.ndarray, width: int, fill: int) -> np.ndarray:
+    """Word ids of the given rows as a (width, len(rows)) array, padded with fill"""
+    positions = np.arange(width)[:, None]
+    mask = positions < lengths[rows]
+    out = np.full((width, len(rows)), fill, dtype=np.int32)
+    out[mask] = ids[(offsets[rows] + positions)[mask]]
+    return out
+
+
+def _align_batch(ref: np.ndarray, ref_len: np.ndarray, hyp: np.ndarray, hyp_len: np.ndarray) -> np.ndarray:
+    """
+    Levenshtein alignment of every column of ref (R, n) against the same column of hyp (H, n).
+
+    The DP tables of the whole batch are filled one anti-diagonal (i + j == d) at a time since every cell on a diagonal only
+    depends on the previous two. The counts are carried forward rather than backtraced, so only three diagonals are kept,
+    each as (R + 1, n) arrays indexed by i, and memory grows with R rather than R * H. A pair's result is read when its
+    last diagonal is reached, padding never changes the cells it is read from. The batch is the last axis so each step works
+    on contiguous memory.
+
+    :return: int array of shape (n, 4) with hits, substitutions, deletions, insertions
+    """
+    R, n = ref.shape
+    H = hyp.shape[0]
+    cols = np.arange(n)
+    last_diagonal = ref_len + hyp_len
+    # cost = sub + dele + ins so only three tables are needed, each diagonal overwrites the one from three steps before
+    # and every cell that is read later is written first
+    diagonals = [tuple(np.zeros((R + 1, n), dtype=np.int32) for _ in range(3)) for _ in range(3)]
+    result = np.zeros((3, n), dtype=np.int32)
+
+    for d in range(R + H + 1):
+        cost, sub, dele = diagonals[d % 3]
+        # the first column and first row of the tables
+        if d <= R:
+            cost[d] = dele[d] = d
+            sub[d] = 0
+        if d <= H:
+            cost[0] = d
+            sub[0] = dele[0] = 0
+
+        i = np.arange(max(1, d - H), min(R, d - 1) + 1)
+        if len(i):
+            j = d - i
+            p_cost, p_sub, p_dele = diagonals[(d - 1) % 3]
+            q_cost, q_sub, q_dele = diagonals[(d - 2) % 3]
+            mismatch = ref[i - 1] != hyp[j - 1]
+            c_sub = q_cost[i - 1] + mismatch
+            c_del = p_cost[i - 1] + 1
+            c_ins = p_cost[i] + 1
+            # prefer a match/substitution, then a deletion, then an insertion
+            take_sub = (c_sub <= c_del) & (c_sub <= c_ins)
+            take_del = ~take_sub & (c_del <= c_ins)
+            cost[i] = np.where(take_sub, c_sub, np.where(take_del, c_del, c_ins))
+            sub[i] = np.where(take_sub, q_sub[i - 1] + mismatch, np.where(take_del, p_sub[i - 1], p_sub[i]))
+            dele[i] = np.where(take_sub, q_dele[i - 1], np.where(take_del, p_dele[i - 1] + 1, p_dele[i]))
+
+        done = last_diagonal == d
+        if done.any():
+            rows, done_cols = ref_len[done], cols[done]
+            result[:, done] = cost[rows, done_cols], sub[rows, done_cols], dele[rows, done_cols]
+
+    cost, s, de = result
+    ins = cost - s - de
+    return np.stack([ref_len - s - de, s, de, ins], axis=1)
+
+
+def align_counts(ref_ids: np.ndarray, ref_len: np.ndarray, hyp_ids: np.ndarray, hyp_len: np.ndarray) -> np.ndarray:
+    """
+    Alignment counts of every (reference, hypothesis) pair, both given as returned by WordInterner.encode. Pairs are sorted
+    by length and worked on in batches of similar sized pairs so that little work is wasted on padding.
+
+    :return: int array of shape (n pairs, 4) with hits, substitutions, deletions, insertions
+    """
+    n = len(ref_len)
+    out = np.zeros((n, 4), dtype=np.int64)
+    if n == 0:
+        return out
+    ref_offsets = np.concatenate([[0], np.cumsum(ref_len)[:-1]])
+    hyp_offsets = np.concatenate([[0], np.cumsum(hyp_len)[:-1]])
+    longest = np.maximum(ref_len, hyp_len)
+    order = np.argsort(longest, kind="stable")
+
+    start = 0
+    while start < n:
+        # sorted by length, so the last pair in a batch is the biggest: fit as many as the cell budget allows
+        window = order[start : start + MAX_BATCH_CELLS // (longest[order[start]] + 1) + 1]
+        size = (longest[window] + 1) * np.arange(1, len(window) + 1)
+        end = start + max(1, int(np.searchsorted(size, MAX_BATCH_CELLS, side="right")))
+        rows = order[start:end]
+        R, H = ref_len[rows].max(), hyp_len[rows].max()
+        ref = _pad(ref_ids, ref_offsets, ref_len, rows, R, -1)
+        hyp = _pad(hyp_ids, hyp_offsets, hyp_len, rows, H, -2)
+        out[rows] = _align_batch(ref, ref_len[rows], hyp, hyp_len[rows])
+        start = end
+    return out
@@ -0,0 +1,81 @@
+import asyncio
+import importlib.util
+import sys
+import unittest
+from unittest import mock
+
+from amazon_transcribe.model import Alternative, Result, Transcript, TranscriptEvent
+
+from speechloop.asr import aws
+from speechloop.asr.aws import Aws
+
+
+def transcript_event(text, is_partial):
+    return TranscriptEvent(Transcript([Result(is_partial=is_partial, alternatives=[Alternative(text, [], [])])]))
+
+
+class FakeStream:
+    """Local stand-in for a transcribe stream, replies with a partial per chunk and one final per file"""
+
+    def __init__(self, client):
+        self.client = client
+        self.input_stream = self
+        self.output_stream = self.events()
+        self.received = 0
+        self.ended = asyncio.Event()
+
+    async def send_audio_event(self, audio_chunk):
+        self.received += len(audio_chunk)
+
+    async def end_stream(self):
+        self.ended.set()
+
+    async def events(self):
+        yield transcript_event("hello", True)
+        await self.ended.wait()
+        yield transcript_event("hello", False)
+        yield transcript_event(f"{self.received} bytes.", False)
+        self.client.open_streams -= 1
+
+
+class FakeClient:
+    def __init__(self, region):
+        self.open_streams = 0
+        self.max_open_streams = 0
+
+    async def start_stream_transcription(self, **kwargs):
+        self.open_streams += 1
+        self.max_open_streams = max(self.max_open_streams, self.open_streams)
+        await asyncio.sleep(0.01)
+        return FakeStream(self)
+
+
+class TestAws(unittest.TestCase):
+    def test_offline_streams(self):
+        asr = Aws(client_factory=FakeClient, max_streams=3)
+        self.assertEqual(asr.execute_with_audio(b"x" * 40000), "hello 40000 bytes")
+
+        async def many():
+            return await asyncio.gather(*[asr.execute_with_audio_async(b"x" * 10) for _ in range(10)])
+
+        self.assertEqual(asyncio.run(many()), ["hello 10 bytes"] * 10)
+        # one client for every file and never more than max_streams at once
+        self.assertIs(asr.get_client(), asr.client)
+        self.assertEqual(asr.client.max_open_streams, 3)
+        # every file gave a partial before its final result
+        self.assertEqual((asr.streamed_files, asr.first_partials), (11, 11))
+        self.assertLessEqual(asr.total_first_partial_time, asr.total_final_time)
+
+    def test_imports_without_amazon_transcribe(self):
+        missing = {name: None for name in ["amazon_transcribe", "amazon_transcribe.client", "amazon_transcribe.handlers", "amazon_transcribe.model"]}
+        # loaded under another name so the real module is left alone
+        spec = importlib.util.spec_from_file_location("aws_without_sdk", aws.__file__)
+        module = importlib.util.module_from_spec(spec)
+        with mock.patch.dict(sys.modules, missing):
+            spec.loader.exec_module(module)
+        self.assertIs(module.TranscriptResultStreamHandler, object)
+        self.assertEqual(module.Aws().engine_config()["region"], "us-east-1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+from speechloop.asr import balancer as balancer_module
+from speechloop.asr.balancer import ReplicaBalancer, TryAgain, parse_endpoints, parse_replicas, replica_endpoints
+from speechloop.asr.base_asr import track_backoff
+
+
+class TestReplicaBalancer(unittest.TestCase):
+    def test_least_outstanding(self):
+        balancer = ReplicaBalancer(["a", "b", "c"])
+        first = [balancer.pick() for _ in range(3)]
+        self.assertEqual([r.endpoint for r in first], ["a", "b", "c"])
+        # b finishes first so it gets the next request
+        balancer.release(first[1])
+        self.assertEqual(balancer.pick().endpoint, "b")
+        # ties go to the replica picked least
+        [balancer.release(r) for r in balancer.replicas for _ in range(r.outstanding)]
+        self.assertEqual(balancer.pick().endpoint, "a")
+
+    def test_ejects_failing_replica(self):
+        balancer = ReplicaBalancer(["a", "b"], max_failures=2, eject_seconds=0.2)
+        a = balancer.replicas[0]
+        for _ in range(2):
+            with self.assertRaises(ConnectionRefusedError):
+                with balancer.request() as lease:
+                    self.assertEqual(lease.endpoint, "a")
+                    raise ConnectionRefusedError()
+            # keep b busier so a would be picked if it were healthy
+            balancer.replicas[1].outstanding = 5
+        self.assertEqual([r.endpoint for r in balancer.healthy()], ["b"])
+        self.assertEqual(balancer.pick().endpoint, "b")
+        self.assertEqual(a.outstanding, 0)
+        time.sleep(0.25)
+        self.assertEqual(balancer.pick().endpoint, "a")
+
+    def test_in_flight_failures_after_ejection(self):
+        balancer = ReplicaBalancer(["a", "b"], max_failures=1, eject_seconds=60)
+        a = balancer.pick()
+        a.outstanding += 1
+        balancer.release(a, failed=True)
+        ejected_until = a.ejected_until
+        # a request that was already in flight fails too, it doesn't eject the replica again
+        balancer.release(a, failed=True)
+        self.assertEqual((a.ejected_until, a.outstanding, a.failures), (ejected_until, 0, 0))
+
+    def test_success_resets_failures(self):
+        balancer = ReplicaBalancer(["a"], max_failures=2)
+        with balancer.request() as lease:
+            lease.fail()
+        with balancer.request():
+            pass
+        with balancer.request() as lease:
+            lease.fail()
+        self.assertEqual(len(balancer.healthy()), 1)
+        # other exceptions don't count either way
+        with self.assertRaises(KeyError):
+            with balancer.request():
+                raise KeyError()
+        self.assertEqual(balancer.replicas[0].failures, 1)
+
+    def test_all_ejected_still_used(self):
+        balancer = ReplicaBalancer(["a"], max_failures=1)
+        with balancer.request() as lease:
+            lease.fail()
+        self.assertEqual(balancer.healthy(), [])
+        self.assertEqual(balancer.pick().endpoint, "a")
+
+    def test_send_retries(self):
+        balancer = ReplicaBalancer(["a", "b"])
+        sent = []
+
+        async def request(lease):
+            sent.append(lease.endpoint)
+            if lease.endpoint == "a":
+                raise ConnectionRefusedError()
+            if sent.count("b") < 3:
+                raise TryAgain(0.05)
+            return "ok"
+
+        # a is down so everything goes to b, which is busy twice
+        with track_backoff() as backoff:
+            self.assertEqual(asyncio.run(balancer.send(request)), "ok")
+        self.assertEqual(sent.count("b"), 3)
+        self.assertGreaterEqual(sum(backoff), 0.1)
+        # a failed every time it was picked between b's busy replies, which ejected it
+        self.assertEqual([r.endpoint for r in balancer.healthy()], ["b"])
+
+    def test_send_gives_up(self):
+        balancer = ReplicaBalancer(["a", "b"])
+
+        async def down(lease):
+            raise ConnectionRefusedError()
+
+        async def busy(lease):
+            raise TryAgain(0, result="busy")
+
+        async def busy_socket(lease):
+            raise TryAgain(0) from ConnectionResetError()
+
+        # after failing on as many replicas as there are
+        with self.assertRaises(ConnectionRefusedError):
+            asyncio.run(balancer.send(down))
+        with mock.patch.object(balancer_module, "MAX_BUSY_RETRIES", 3):
+            self.assertEqual(asyncio.run(balancer.send(busy)), "busy")
+            with self.assertRaises(ConnectionResetError):
+                asyncio.run(balancer.send(busy_socket))
+
+    def test_parsers(self):
+        self.assertEqual(parse_replicas("vs=4, cq=8"), {"vs": 4, "cq": 8})
+        self.assertEqual(parse_replicas(""), {})
+        with self.assertRaises(ValueError):
+            parse_replicas("vs=0")
+        with self.assertRaises(ValueError):
+            parse_replicas("vs")
+        self.assertEqual(
+            parse_endpoints("vs=ws://a:2800|ws://b:2800,cq=http://a:3200"),
+            {"vs": ["ws://a:2800", "ws://b:2800"], "cq": ["http://a:3200"]},
+        )
+        self.assertEqual(replica_endpoints("http://localhost:{port}", 3200, 3), ["http://localhost:3200", "http://localhost:3201", "http://localhost:3202"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import asyncio
+import datetime
+import unittest
+
+from speechloop.asr.base_asr import ASR, backoff_sleep
+from speechloop.model_runner import run_asr, run_asr_async, run_asr_batch
+
+
+class BlockingOnly(ASR):
+    def __init__(self):
+        super().__init__("blocking", "cloud-api")
+
+    def execute_with_audio(self, audio):
+        return "ok"
+
+
+class Neither(ASR):
+    def __init__(self):
+        super().__init__("neither", "cloud-api")
+
+
+class BusyOnce(ASR):
+    """Backs off 0.2s from a busy server then takes 0.05s"""
+
+    def __init__(self):
+        super().__init__("busy", "cloud-api")
+
+    async def execute_with_audio_async(self, audio):
+        await backoff_sleep(0.2)
+        await asyncio.sleep(0.05)
+        return "ok"
+
+
+class ShortBatch(ASR):
+    """Its batch endpoint drops the last transcript"""
+
+    def __init__(self):
+        super().__init__("short", "cloud-api")
+
+    async def execute_with_audio_async(self, audio):
+        return audio.decode()
+
+    async def execute_batch_async(self, audios):
+        return [audio.decode() for audio in audios[:-1]], None
+
+
+class FailsInBatch(ASR):
+    """Its batch endpoint takes 0.1s and can't transcribe b, which works on its own"""
+
+    def __init__(self):
+        super().__init__("fails", "cloud-api")
+
+    async def execute_with_audio_async(self, audio):
+        await asyncio.sleep(0.01)
+        return audio.decode()
+
+    async def execute_batch_async(self, audios):
+        await asyncio.sleep(0.1)
+        return [self.return_error() if audio == b"b" else audio.decode() for audio in audios], None
+
+
+class Streams(ASR):
+    """Streams every file, the first partial after 10ms and the final after 30ms"""
+
+    def __init__(self):
+        super().__init__("streams", "cloud-api")
+
+    async def execute_with_audio_async(self, audio):
+        self.add_stream_latency(datetime.timedelta(seconds=0.01), datetime.timedelta(seconds=0.03))
+        return "ok"
+
+
+class TestBaseAsr(unittest.TestCase):
+    def test_must_implement_one_execute(self):
+        with self.assertRaises(TypeError):
+            Neither()
+        self.assertEqual(BlockingOnly().execute_batch([b"a", b"b"]), (["ok", "ok"], None))
+
+    def test_backoff_is_not_inference_time(self):
+        asr = BusyOnce()
+        run_asr(asr, b"")
+        asyncio.run(run_asr_async(asr, b""))
+        self.assertAlmostEqual(asr.total_backoff_time.total_seconds(), 0.4, delta=0.05)
+        self.assertLess(asr.total_inf_time.total_seconds(), 0.2)
+
+    def test_short_batch_is_retried(self):
+        with self.assertWarns(UserWarning):
+            results = asyncio.run(run_asr_batch(ShortBatch(), [b"a", b"b", b"c"], ["a.wav", "b.wav", "c.wav"]))
+        self.assertEqual(results, ["a", "b", "c"])
+
+    def test_stream_latency_is_kept_per_call(self):
+        asr = Streams()
+        # the blocking run goes through run_sync on the background loop
+        run_asr(asr, b"")
+        asyncio.run(run_asr_async(asr, b""))
+        summary = asr.calls.summary(1)
+        self.assertEqual(summary["streamed_calls"], 2)
+        self.assertAlmostEqual(summary["first_partial_p50"], 0.01)
+        self.assertAlmostEqual(summary["final_p99"], 0.03)
+
+    def test_failed_batch_item_is_one_retried_call(self):
+        asr = FailsInBatch()
+        results = asyncio.run(run_asr_batch(asr, [b"a", b"b"], ["a.wav", "b.wav"]))
+        self.assertEqual(results, ["a", "b"])
+        summary = asr.calls.summary(1)
+        # the batch was b's first attempt and its share of the batch time is in b's call
+        self.assertEqual((summary["calls"], summary["retried_calls"], summary["attempts"], summary["failed_calls"]), (2, 1, 3, 0))
+        self.assertGreaterEqual(asr.calls.latency[1], 0.06)
+        self.assertAlmostEqual(asr.total_inf_time.total_seconds(), sum(asr.calls.latency), places=5)
+
+
+if __name__ == "__main__":
+    unittest.main()
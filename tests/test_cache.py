@@ -0,0 +1,58 @@
+import tempfile
+import unittest
+from speechloop.cache import TranscriptionCache
+from speechloop.model_runner import run_asr
+from tests.test_model_runner import FakeEngine
+
+
+class FakeASR:
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+
+    def config_fingerprint(self):
+        return self.config
+
+
+class TestTranscriptionCache(unittest.TestCase):
+    def test_hit_miss_and_config(self):
+        with tempfile.TemporaryDirectory() as d:
+            cache = TranscriptionCache(d)
+            vs, vs_new_model = FakeASR("vs", "a"), FakeASR("vs", "b")
+            self.assertIsNone(cache.get("hash1", vs))
+            cache.put("hash1", vs, "hello world", 0.5)
+            self.assertEqual(cache.get("hash1", vs), {"transcript": "hello world", "inf_time": 0.5})
+            # same audio and engine but a different config is a miss
+            self.assertIsNone(cache.get("hash1", vs_new_model))
+            cache.close()
+
+            # persisted on disk
+            cache = TranscriptionCache(d)
+            self.assertEqual(cache.get("hash1", vs)["transcript"], "hello world")
+            cache.close()
+
+    def test_lru_eviction(self):
+        with tempfile.TemporaryDirectory() as d:
+            cache = TranscriptionCache(d, max_size_mb=2000 / 1024 / 1024)
+            vs = FakeASR("vs", "a")
+            cache.put("keep", vs, "x", 0.1)
+            for i in range(40):
+                cache.get("keep", vs)
+                cache.put(f"hash{i}", vs, "y" * 10, 0.1)
+            self.assertLessEqual(cache._total_size(), cache.max_size_bytes)
+            # recently used rows survive, the oldest are gone
+            self.assertIsNotNone(cache.get("keep", vs))
+            self.assertIsNotNone(cache.get("hash39", vs))
+            self.assertIsNone(cache.get("hash0", vs))
+            cache.close()
+
+    def test_hits_are_not_inference_time(self):
+        with tempfile.TemporaryDirectory() as d:
+            cache = TranscriptionCache(d)
+            engine = FakeEngine("fk")
+            cache.put("hash1", engine, "from an earlier run", 0.5)
+            self.assertEqual(run_asr(engine, b"audio", "a.wav", cache=cache, audio_hash="hash1"), "from an earlier run")
+            self.assertEqual((engine.cache_hits, engine.cache_saved_time.total_seconds()), (1, 0.5))
+            self.assertEqual(engine.total_inf_time.total_seconds(), 0)
+            self.assertEqual(len(engine.calls), 0)
+            cache.close()
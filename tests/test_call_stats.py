@@ -0,0 +1,43 @@
+import os
+import pickle
+import unittest
+
+from speechloop.call_stats import CallStats, wav_duration
+
+
+class TestCallStats(unittest.TestCase):
+    def test_summary(self):
+        stats = CallStats()
+        for i in range(100):
+            stats.add((i + 1) / 100, attempts=2 if i == 0 else 1, duration=2.0, failed=i == 99)
+        summary = stats.summary(wall_seconds=10)
+        self.assertEqual((summary["calls"], summary["retried_calls"], summary["attempts"], summary["failed_calls"]), (100, 1, 101, 1))
+        self.assertAlmostEqual(summary["latency_p50"], 0.505)
+        self.assertAlmostEqual(summary["latency_p99"], 0.9901)
+        self.assertAlmostEqual(summary["rtf"], 50.5 / 200)
+        self.assertAlmostEqual(summary["files_per_second"], 10)
+        self.assertEqual(summary["streamed_calls"], 0)
+        self.assertNotIn("final_p50", summary)
+
+    def test_shard_merge(self):
+        stats = CallStats()
+        stats.add(0.1)
+        before = len(stats)
+        stats.add(0.2, duration=1.0, first_partial=0.05, final=0.15)
+        shard = pickle.loads(pickle.dumps(stats.since(before)))
+        merged = CallStats()
+        merged.extend(shard)
+        self.assertEqual(list(merged.latency), [0.2])
+        self.assertEqual((list(merged.first_partial), list(merged.final)), ([0.05], [0.15]))
+        # unknown durations are left out of the real time factor
+        stats.add(5.0)
+        self.assertAlmostEqual(stats.summary(1)["rtf"], 0.2)
+
+    def test_wav_duration(self):
+        with open(os.path.join(os.path.dirname(__file__), "valid_audio.wav"), "rb") as f:
+            self.assertAlmostEqual(wav_duration(f.read()), 1.0043125)
+        self.assertIsNone(wav_duration(b"not a wav"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,27 @@
+import os
+import tempfile
+import unittest
+from speechloop.checkpoint import Checkpoint
+
+
+class TestCheckpoint(unittest.TestCase):
+    def test_resume_skips_cut_off_line(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "run.jsonl")
+            ck = Checkpoint(path)
+            ck.record("a.wav", "vs", "hello", 0.5)
+            ck.record("a.wav", "sp", "hollow", 0.25)
+            ck.close()
+            # simulate a crash half way through writing a line
+            with open(path, "a") as f:
+                f.write('{"filename": "b.wav", "asr": "vs", "tra')
+
+            ck = Checkpoint(path)
+            self.assertEqual(ck.get("a.wav", "vs"), {"transcript": "hello", "inf_time": 0.5})
+            self.assertIsNone(ck.get("b.wav", "vs"))
+            self.assertTrue(ck.has_all("a.wav", ["vs", "sp"]))
+            self.assertFalse(ck.has_all("a.wav", ["vs", "cq"]))
+            ck.record("b.wav", "vs", "world", 1.0)
+            ck.close()
+
+            self.assertEqual(len(Checkpoint.load(path)), 3)
@@ -0,0 +1,127 @@
+import socket
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from speechloop.asr import container_utils
+from speechloop.asr.errors import ContainerNotReady
+
+
+class FakeContainer:
+    def __init__(self, image, ports=None):
+        self.image = SimpleNamespace(tags=[image])
+        self.ports = ports
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+class FakeDockerClient:
+    """Counts the calls made to docker, run starts a container of the image"""
+
+    def __init__(self, running=()):
+        self.running = [FakeContainer(image) for image in running]
+        self.lists = 0
+        self.runs = []
+        self.run_options = []
+        self.containers = self
+
+    def list(self):
+        self.lists += 1
+        return list(self.running)
+
+    def run(self, image, ports=None, **kwargs):
+        self.runs.append(image)
+        self.run_options.append(kwargs)
+        self.running.append(FakeContainer(image, {port: [{"HostPort": str(host)}] for port, host in (ports or {}).items()}))
+
+
+class Healthcheck(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200 if self.path == "/healthcheck" else 404)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestContainerUtils(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeDockerClient(running=["warm:latest"])
+        container_utils.set_docker_client(self.client)
+
+    def tearDown(self):
+        container_utils.set_docker_client(None)
+
+    def test_listing_is_cached(self):
+        threads = [threading.Thread(target=container_utils.launch_container, args=(image, {}), kwargs={"verbose": False}) for image in ["warm:latest", "cold:latest"] * 3]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(self.client.lists, 1)
+        # started once, later launches find it in the cached listing
+        container_utils.launch_container("cold:latest", {}, verbose=False)
+        self.assertEqual(self.client.runs, ["cold:latest"])
+        self.assertIn("cold:latest", container_utils.running_images())
+
+        container_utils.kill_container("warm:latest", verbose=False)
+        self.assertTrue(self.client.running[0].stopped)
+        self.assertNotIn("warm:latest", container_utils.running_images())
+
+    def test_replicas_on_each_port(self):
+        run_options = {"environment": {"COQUI_MODELS": str(container_utils.cpu_share(3))}}
+        container_utils.launch_replicas("cold:latest", "3200/tcp", [3200, 3201, 3202], [None] * 3, verbose=False, run_options=run_options)
+        self.assertEqual(self.client.runs, ["cold:latest"] * 3)
+        self.assertTrue(all(options["environment"] == run_options["environment"] for options in self.client.run_options))
+        self.assertEqual(container_utils.running_containers(refresh=True)["cold:latest"], {"3200", "3201", "3202"})
+        # a 4th replica starts one more, the others are found running
+        container_utils.launch_replicas("cold:latest", "3200/tcp", [3200, 3201, 3202, 3203], [None] * 4, verbose=False)
+        self.assertEqual(len(self.client.runs), 4)
+
+    def test_waits_for_ready_check(self):
+        ready_at = time.monotonic() + 0.3
+        start = time.monotonic()
+        container_utils.launch_container("cold:latest", {}, verbose=False, ready_check=lambda: time.monotonic() >= ready_at, timeout=5)
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        with self.assertRaises(ContainerNotReady):
+            container_utils.launch_container("warm:latest", {}, verbose=False, ready_check=lambda: False, timeout=0.3)
+
+    def test_http_ready(self):
+        server = ThreadingHTTPServer(("localhost", 0), Healthcheck)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_address[1]
+        try:
+            self.assertTrue(container_utils.http_ready(f"http://localhost:{port}/healthcheck")())
+            self.assertFalse(container_utils.http_ready(f"http://localhost:{port}/missing")())
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertFalse(container_utils.http_ready(f"http://localhost:{port}/healthcheck")())
+
+    def test_websocket_ready(self):
+        listener = socket.socket()
+        listener.bind(("localhost", 0))
+        listener.listen()
+        port = listener.getsockname()[1]
+
+        def accept(reply):
+            connection, _ = listener.accept()
+            connection.recv(1024)
+            connection.sendall(reply)
+            connection.close()
+
+        try:
+            for reply, expected in [(b"HTTP/1.1 101 Switching Protocols\r\n\r\n", True), (b"HTTP/1.1 404 Not Found\r\n\r\n", False)]:
+                thread = threading.Thread(target=accept, args=(reply,))
+                thread.start()
+                self.assertEqual(container_utils.websocket_ready(f"ws://localhost:{port}")(), expected)
+                thread.join()
+        finally:
+            listener.close()
+        self.assertFalse(container_utils.websocket_ready(f"ws://localhost:{port}")())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+from speechloop.file_utils import AudioBuffer, CSVHeaderMismatch, import_csvs, iter_csv_chunks
+
+
+class TestCSVImport(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.csv1 = self.write("a.csv", "filename,transcript\n" + "".join(f"a{i}.wav,hello\n" for i in range(5)))
+        self.csv2 = self.write("b.csv", "filename,transcript\n" + "".join(f"b{i}.wav,world\n" for i in range(3)))
+        self.bad = self.write("c.csv", "filename,text\nc.wav,oops\n")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.dir.name, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_chunks_match_import(self):
+        paths = f"{self.csv1},{self.csv2}"
+        chunks = list(iter_csv_chunks(paths, chunksize=2))
+        self.assertEqual([c.shape[0] for c in chunks], [2, 2, 1, 2, 1])
+        df = import_csvs(paths)
+        self.assertTrue(df.equals(pd.concat(chunks)))
+
+    def test_header_mismatch(self):
+        self.assertRaises(CSVHeaderMismatch, import_csvs, f"{self.csv1},{self.bad}")
+        # raised before any rows are yielded
+        self.assertRaises(CSVHeaderMismatch, next, iter_csv_chunks(f"{self.csv1},{self.bad}", 2))
+
+
+class TestAudioBuffer(unittest.TestCase):
+    def test_chunks_share_memory(self):
+        data = bytearray(b"0123456789")
+        audio = AudioBuffer(data)
+        chunks = list(audio.chunks(4))
+        self.assertEqual([bytes(c) for c in chunks], [b"0123", b"4567", b"89"])
+        # no copies: the chunks are views onto the original
+        data[0:1] = b"x"
+        self.assertEqual(bytes(chunks[0]), b"x123")
+        audio.seek(-2, os.SEEK_END)
+        self.assertEqual(bytes(audio.read()), b"89")
+        self.assertEqual(len(audio.read(4)), 0)
+
+    def test_from_file(self):
+        wav = os.path.join(os.path.dirname(__file__), "valid_audio.wav")
+        with open(wav, "rb") as f:
+            expected = f.read()
+        with AudioBuffer.from_file(wav) as audio:
+            self.assertEqual(len(audio), len(expected))
+            self.assertEqual(b"".join(audio.chunks(4096)), expected)
+
+    def test_close_with_slices_held(self):
+        wav = os.path.join(os.path.dirname(__file__), "valid_audio.wav")
+        audio = AudioBuffer.from_file(wav)
+        mapped = audio._mmap
+        chunk = audio.read(4)
+        audio.close()
+        self.assertEqual(bytes(chunk), b"RIFF")
+        self.assertFalse(mapped.closed)
+        chunk.release()
+        del chunk, mapped
+        # closed without slices is unmapped straight away
+        audio = AudioBuffer.from_file(wav)
+        mapped = audio._mmap
+        audio.read(4).release()
+        audio.close()
+        self.assertTrue(mapped.closed)
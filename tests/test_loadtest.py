@@ -0,0 +1,66 @@
+import asyncio
+import itertools
+import unittest
+
+from speechloop.asr.base_asr import ASR
+from speechloop.asr.errors import DEFAULT_ERROR
+from speechloop.loadtest import closed_loop, open_loop, parse_levels
+
+
+class FakeServer(ASR):
+    """Transcribes one file at a time in 10ms, so it saturates at 100 files/s. Audio of b"bad" is an error"""
+
+    def __init__(self):
+        super().__init__("fk", "cloud-api")
+        self.lock = None
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def execute_with_audio_async(self, audio):
+        self.lock = self.lock or asyncio.Lock()
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            async with self.lock:
+                await asyncio.sleep(0.01)
+        finally:
+            self.in_flight -= 1
+        return DEFAULT_ERROR if audio == b"bad" else "ok"
+
+
+class TestLoadtest(unittest.TestCase):
+    def test_closed_loop(self):
+        asr = FakeServer()
+        audios = itertools.cycle([(b"good", 1.0), (b"good", 1.0), (b"good", 1.0), (b"bad", 1.0)])
+        level = asyncio.run(closed_loop(asr, audios, concurrency=4, seconds=0.3, timeout=5))
+        self.assertEqual(asr.max_in_flight, 4)
+        self.assertEqual(level.errors, level.requests // 4)
+        # queued behind the 3 other files in flight
+        summary = level.summary("concurrency", 4, 0.3)
+        self.assertGreater(summary["latency_p50"], 0.03)
+        self.assertAlmostEqual(summary["error_rate"], 0.25, delta=0.05)
+
+    def test_open_loop_queues_past_saturation(self):
+        asr = FakeServer()
+        audios = itertools.cycle([(b"good", 1.0)])
+        under = asyncio.run(open_loop(asr, audios, qps=20, seconds=0.3, timeout=5)).summary("qps", 20, 0.3)
+        over = asyncio.run(open_loop(asr, audios, qps=300, seconds=0.3, timeout=5)).summary("qps", 300, 0.3)
+        self.assertEqual((under["requests"], over["requests"]), (6, 90))
+        self.assertLess(under["latency_p99"], 0.05)
+        # latency is from when each file was due, so the backlog shows up in it
+        self.assertGreater(over["latency_p99"], 0.3)
+
+    def test_timeouts_are_errors(self):
+        asr = FakeServer()
+        level = asyncio.run(closed_loop(asr, itertools.cycle([(b"good", 1.0)]), concurrency=3, seconds=0.05, timeout=0.015))
+        self.assertGreater(level.timeouts, 0)
+        self.assertEqual(level.errors, level.timeouts)
+
+    def test_parse_levels(self):
+        self.assertEqual(parse_levels("1, 2,4,"), [1, 2, 4])
+        with self.assertRaises(AssertionError):
+            parse_levels("0,1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import asyncio
+import os
+import random
+import tempfile
+import time
+import unittest
+import wave
+from unittest import mock
+
+import pandas as pd
+
+from speechloop import model_runner
+from speechloop.asr.base_asr import ASR
+from speechloop.asr.errors import DEFAULT_ERROR
+from speechloop.model_runner import RUNNERS, add_transcriptions
+from speechloop.rate_limit import RateLimiter
+
+
+class FakeEngine(ASR):
+    """
+    Transcribes a wav as its name and byte length after a random delay. The first call for each audio in fail_once comes
+    back as an error and audio in always_fail is never transcribed.
+    """
+
+    def __init__(self, name, max_delay=0.02, fail_once=(), always_fail=(), seed=0):
+        super().__init__(name, "cloud-api")
+        self.max_delay = max_delay
+        self.fail_once = set(fail_once)
+        self.always_fail = set(always_fail)
+        self.random = random.Random(seed)
+
+    async def execute_with_audio_async(self, audio):
+        await asyncio.sleep(self.random.uniform(0, self.max_delay))
+        if len(audio) in self.always_fail:
+            return DEFAULT_ERROR
+        if len(audio) in self.fail_once:
+            self.fail_once.discard(len(audio))
+            return DEFAULT_ERROR
+        return f"{self.name} {len(audio)}"
+
+
+def write_wavs(folder, n):
+    """n wavs of different lengths, returns their paths"""
+    paths = []
+    for i in range(n):
+        path = os.path.join(folder, f"{i:03d}.wav")
+        with wave.open(path, "wb") as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(16000)
+            wf.writeframes(b"\0\0" * 160 * (i + 1))
+        paths.append(path)
+    return paths
+
+
+def wav_size(i):
+    return 44 + 320 * (i + 1)
+
+
+class TestRunners(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        paths = write_wavs(self.folder.name, 12)
+        paths.insert(5, os.path.join(self.folder.name, "missing.wav"))
+        self.df = pd.DataFrame({"filename": paths, "transcript": ["x"] * len(paths)})
+        patcher = mock.patch.object(model_runner, "RETRY_DELAY", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.folder.cleanup)
+
+    def engines(self, seed):
+        return [
+            FakeEngine("aa", seed=seed, fail_once=[wav_size(2)]),
+            FakeEngine("bb", max_delay=0.005, seed=seed + 1, always_fail=[wav_size(7)]),
+            FakeEngine("cc", max_delay=0.04, seed=seed + 2),
+        ]
+
+    def test_runners_agree(self):
+        expected = add_transcriptions(self.df, self.engines(0), True, runner="sequential")
+        self.assertEqual(list(expected.columns), ["filename", "transcript", "aa", "bb", "cc"])
+        self.assertEqual(expected["aa"].iloc[0], f"aa {wav_size(0)}")
+        self.assertEqual(expected["bb"].iloc[8], DEFAULT_ERROR)
+        self.assertEqual(expected["cc"].iloc[5], "<Missing file error>")
+        for runner in RUNNERS:
+            for seed in [1, 2]:
+                engines = self.engines(seed)
+                out = add_transcriptions(self.df, engines, True, runner=runner, max_in_flight=4)
+                pd.testing.assert_frame_equal(out, expected)
+                # the file that failed once was retried
+                self.assertEqual(engines[0].calls.summary(1)["retried_calls"], 1)
+
+    def test_rate_limited_engine_does_not_hold_up_others(self):
+        for runner in ["threads", "async"]:
+            limited, free = FakeEngine("aa", max_delay=0), FakeEngine("bb", max_delay=0)
+            limited.rate_limiter = RateLimiter(rate=1.0)
+            finished = {}
+            for engine in [limited, free]:
+                engine.add_call = self.record_finish(engine, finished)
+            start = time.monotonic()
+            out = add_transcriptions(self.df.iloc[:4], [limited, free], True, runner=runner, max_in_flight=2)
+            self.assertEqual(out["bb"].iloc[3], f"bb {wav_size(3)}")
+            # 4 files at 1/s take the limited engine 3s, the other one is done long before
+            self.assertGreater(finished["aa"] - start, 2.5)
+            self.assertLess(finished["bb"] - start, 0.5)
+
+    @staticmethod
+    def record_finish(engine, finished):
+        add_call = engine.add_call
+
+        def wrapper(*args, **kwargs):
+            finished[engine.name] = time.monotonic()
+            add_call(*args, **kwargs)
+
+        return wrapper
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+from speechloop import model_runner
+from speechloop.asr import balancer
+from speechloop.asr.model_server import ModelServerASR
+from speechloop.model_runner import run_asr_async
+
+TRANSCRIPT = "the quick brown fox"
+
+
+class BusyServer:
+    """A model server that answers 503 with a Retry-After to the first busy requests and then transcribes"""
+
+    def __init__(self, busy, retry_after="0"):
+        self.busy = busy
+        self.retry_after = retry_after
+        self.requests = 0
+        self.runner = None
+        self.url = None
+
+    async def transcribe_raw(self, request):
+        await request.read()
+        self.requests += 1
+        if self.requests <= self.busy:
+            return web.Response(status=503, headers={"Retry-After": self.retry_after})
+        return web.json_response({"transcript": TRANSCRIPT})
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post("/transcribe_raw", self.transcribe_raw)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+
+def transcribe(server):
+    async def run():
+        async with server:
+            asr = ModelServerASR("ms", 0, endpoints=[server.url])
+            # external servers have no containers to stop
+            asr.launch_containers(0, "WORKERS")
+            try:
+                return asr, await run_asr_async(asr, b"audio")
+            finally:
+                await asr.http_session().close()
+
+    return asyncio.run(run())
+
+
+class TestModelServerPost(unittest.TestCase):
+    def test_busy_server_is_retried(self):
+        server = BusyServer(busy=2, retry_after="0.2")
+        asr, text = transcribe(server)
+        self.assertEqual(text, TRANSCRIPT)
+        self.assertEqual(server.requests, 3)
+        # waiting out the two 503s is back-off, not inference time, and the file was transcribed by one call
+        self.assertGreaterEqual(asr.total_backoff_time.total_seconds(), 0.4)
+        self.assertLess(asr.total_inf_time.total_seconds(), 0.2)
+        self.assertEqual(asr.calls.summary(1)["attempts"], 1)
+
+    def test_gives_up_after_max_busy_retries(self):
+        server = BusyServer(busy=100)
+        with mock.patch.object(balancer, "MAX_BUSY_RETRIES", 4), mock.patch.object(model_runner, "RETRY_DELAY", 0):
+            asr, text = transcribe(server)
+        self.assertEqual(text, asr.return_error())
+        # each of the MAX_RETRIES attempts gives up after MAX_BUSY_RETRIES requests
+        self.assertEqual(server.requests, model_runner.MAX_RETRIES * 4)
+        self.assertEqual(asr.calls.summary(1)["attempts"], model_runner.MAX_RETRIES)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+import time
+import unittest
+from speechloop.rate_limit import RateLimiter, RateLimitParseError, parse_rate_limit, parse_rate_limits
+
+
+class TestRateLimit(unittest.TestCase):
+    def test_parse_rate_limits(self):
+        self.assertEqual(parse_rate_limits("gg=5/s, az=20/s:4,vs=unlimited"), {"gg": "5/s", "az": "20/s:4", "vs": "unlimited"})
+        self.assertEqual(parse_rate_limits(""), {})
+        self.assertRaises(RateLimitParseError, parse_rate_limits, "gg")
+
+    def test_parse_rate_limit(self):
+        self.assertEqual(parse_rate_limit("unlimited").rate, None)
+        self.assertEqual(parse_rate_limit("5/s").rate, 5.0)
+        self.assertEqual(parse_rate_limit("120/m").rate, 2.0)
+        limiter = parse_rate_limit("20/s:4", share=3)
+        self.assertAlmostEqual(limiter.rate, 20 / 3)
+        self.assertEqual(limiter.max_concurrent, 2)
+        self.assertRaises(RateLimitParseError, parse_rate_limit, "fast")
+
+    def test_token_bucket_spacing(self):
+        limiter = RateLimiter(rate=50)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.acquire()
+            limiter.release()
+        # first token is free, the other 5 are spaced 1/50th of a second apart
+        self.assertGreaterEqual(time.monotonic() - start, 5 / 50 - 0.01)
+
+    def test_unlimited_never_waits(self):
+        limiter = RateLimiter()
+        self.assertEqual(sum(limiter.reserve() for _ in range(100)), 0.0)
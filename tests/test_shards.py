@@ -0,0 +1,61 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+import pandas as pd
+
+from speechloop import model_runner
+from speechloop.asr import registry
+from speechloop.core import sharded_process_frame, split_shards
+from tests.test_model_runner import FakeEngine, wav_size, write_wavs
+
+PROCESS_ARGS = dict(
+    shell_script_mode=True,
+    wav_delay=0.0,
+    rate_limits="",
+    runner="async",
+    max_in_flight=2,
+    pool_size=None,
+    batch_size=1,
+    enable_wer=False,
+    enable_text_normalization=False,
+    column_transcript="transcript",
+    normalization_suffix="_normalized",
+)
+
+
+class TestShards(unittest.TestCase):
+    def test_split_shards(self):
+        df = pd.DataFrame({"x": range(10)})
+        shards = split_shards(df, 4)
+        self.assertEqual([len(s) for s in shards], [2, 3, 3, 2])
+        self.assertEqual(pd.concat(shards)["x"].tolist(), list(range(10)))
+        self.assertEqual(len(split_shards(df.iloc[:3], 8)), 3)
+
+    def test_workers_merge_in_order(self):
+        with tempfile.TemporaryDirectory() as folder:
+            paths = write_wavs(folder, 12)
+            paths.insert(5, os.path.join(folder, "missing.wav"))
+            df = pd.DataFrame({"filename": paths, "transcript": ["x"] * len(paths)})
+            options = {"fk": {"name": "fk", "fail_once": [wav_size(2)], "always_fail": [wav_size(7)]}}
+            state_args = dict(checkpoint_path=None, cache_dir=None, cache_max_mb=0, asr_options=options, trace=False, trace_memory=False)
+            parent = FakeEngine("fk")
+            # the workers are forked so they see the fake engine and the retry delay
+            with mock.patch.dict(registry.ENGINES, fk=FakeEngine), mock.patch.object(model_runner, "RETRY_DELAY", 0):
+                with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("fork")) as pool:
+                    df_out = sharded_process_frame(df, pool, 2, ["fk"], [parent], PROCESS_ARGS, state_args)
+
+        self.assertEqual(df_out["filename"].tolist(), paths)
+        self.assertEqual(df_out["fk"].iloc[0], f"fk {wav_size(0)}")
+        self.assertEqual(df_out["fk"].iloc[5], "<Missing file error>")
+        # the stats of every shard are added to the parent's engine
+        summary = parent.calls.summary(1)
+        self.assertEqual((summary["calls"], summary["retried_calls"], summary["attempts"]), (12, 2, 15))
+        self.assertAlmostEqual(parent.total_inf_time.total_seconds(), sum(parent.calls.latency), places=5)
+
+
+if __name__ == "__main__":
+    unittest.main()
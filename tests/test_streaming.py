@@ -0,0 +1,127 @@
+import asyncio
+import json
+import unittest
+
+from aiohttp import WSMsgType, web
+
+from speechloop.asr.base_asr import ASR
+from speechloop.asr.streaming import STREAMING_MODES, WebsocketStreamer
+from speechloop.file_utils import AudioBuffer
+
+CHUNK_SIZE = 1000
+
+
+class StreamServer:
+    """
+    The vosk protocol like benchmarks/mock_servers.py: a partial for every binary chunk and "<chunks> chunks" for the
+    reset that ends a file. The socket is closed after close_after files on it.
+    """
+
+    def __init__(self, close_after=None):
+        self.close_after = close_after
+        self.connections = 0
+        self.files = 0
+        self.runner = None
+        self.uri = None
+
+    async def stream(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.connections += 1
+        chunks, files = 0, 0
+        async for msg in ws:
+            if msg.type == WSMsgType.BINARY:
+                chunks += 1
+                if chunks % 2 == 0:
+                    # the pipelined sender gets ahead of the replies, then they catch up with it
+                    await asyncio.sleep(0.002)
+                await ws.send_str(json.dumps({"partial": f"chunk {chunks}"}))
+            elif msg.type == WSMsgType.TEXT:
+                assert json.loads(msg.data) == {"reset": 1}
+                await ws.send_str(json.dumps({"text": f"{chunks} chunks"}))
+                chunks, files = 0, files + 1
+                self.files += 1
+                if self.close_after is not None and files == self.close_after:
+                    await ws.close()
+        return ws
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get("/", self.stream)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.uri = f"ws://127.0.0.1:{port}"
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+
+class StreamingEngine(ASR):
+    def __init__(self):
+        super().__init__("ws", "cloud-api")
+
+    async def execute_with_audio_async(self, audio):
+        raise NotImplementedError
+
+
+def audio(chunks):
+    """Audio that is sent as chunks chunks, the last one short"""
+    return AudioBuffer(b"\0" * (CHUNK_SIZE * chunks - CHUNK_SIZE // 2))
+
+
+class TestWebsocketStreamer(unittest.TestCase):
+    def run_files(self, server, mode, sizes, concurrent=False):
+        asr = StreamingEngine()
+
+        async def run():
+            async with server:
+                streamer = WebsocketStreamer(asr, server.uri, chunk_size=CHUNK_SIZE, streaming_mode=mode)
+                if concurrent:
+                    texts = await asyncio.gather(*[streamer.transcribe(audio(n)) for n in sizes])
+                else:
+                    texts = [await streamer.transcribe(audio(n)) for n in sizes]
+                await streamer.pool(server.uri).close()
+                return texts
+
+        texts = asyncio.run(run())
+        self.assertEqual(texts, [f"{n} chunks" for n in sizes])
+        self.assertEqual(asr.streamed_files, len(sizes))
+        self.assertEqual(server.files, len(sizes))
+        return asr
+
+    def test_files_reuse_one_socket(self):
+        for mode in ["lockstep", "pipelined"]:
+            server = StreamServer()
+            # the chunk count restarting for every file shows each reset was answered with that file's result
+            asr = self.run_files(server, mode, [3, 1, 5, 2])
+            self.assertEqual(server.connections, 1)
+            self.assertEqual(asr.connections_opened, 1)
+
+    def test_pipelined_replies_are_counted(self):
+        # a reply read too many or too few would be taken as the next file's result. Realtime sends slower than the
+        # replies come back so the receiver catches up with the sender before the reset
+        for mode, sizes in [("pipelined", [20, 1, 7, 1, 1, 12]), ("realtime", [3, 1, 2])]:
+            server = StreamServer()
+            self.run_files(server, mode, sizes)
+            self.assertEqual(server.connections, 1)
+
+    def test_reconnect_after_server_closes(self):
+        for mode in STREAMING_MODES[:2]:
+            server = StreamServer(close_after=2)
+            asr = self.run_files(server, mode, [2, 3, 4, 1, 2])
+            # the socket closed after files 2 and 4 is noticed by the next file, which goes on a new socket
+            self.assertEqual(server.connections, 3)
+            self.assertEqual(asr.connections_opened, 3)
+
+    def test_concurrent_files_get_their_own_sockets(self):
+        server = StreamServer()
+        self.run_files(server, "pipelined", [4, 2, 6], concurrent=True)
+        self.assertEqual(server.connections, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
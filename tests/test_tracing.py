@@ -0,0 +1,41 @@
+import json
+import os
+import tempfile
+import unittest
+
+from speechloop import tracing
+
+
+class TestTracing(unittest.TestCase):
+    def tearDown(self):
+        tracing.stop()
+
+    def test_off_by_default(self):
+        with tracing.span("validate"):
+            pass
+        self.assertFalse(tracing.enabled())
+        self.assertEqual(tracing.drain(), [])
+
+    def test_trace_file(self):
+        tracing.start(memory=True)
+        with tracing.span("validate", rows=3):
+            data = [bytes(1000) for _ in range(100)]
+        with tracing.span("vs", cat="engine", overlapping=True, file="a.wav"):
+            pass
+        self.assertEqual(list(tracing.traced(iter([1, 2]), "import csv")), [1, 2])
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "trace.json")
+            tracing.stop(path)
+            with open(path) as f:
+                events = json.load(f)["traceEvents"]
+
+        stages = [e for e in events if e["ph"] == "X"]
+        self.assertEqual([e["name"] for e in stages], ["validate", "import csv", "import csv", "import csv"])
+        self.assertEqual(stages[0]["args"]["rows"], 3)
+        self.assertGreater(stages[0]["args"]["peak_memory_mb"], 0.09)
+        self.assertEqual([e["ph"] for e in events if e.get("cat") == "engine"], ["b", "e"])
+        self.assertEqual(len(data), 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,13 @@
+import contextlib
+import io
+import os
+import tempfile
 import unittest
-from speechloop.validate import is_en_ascii, valid_text, validate_audio
+
+import pandas as pd
+
+from speechloop.audio_index import AudioIndex
+from speechloop.validate import is_en_ascii, valid_text, validate_audio, validate_manditory_data, validate_optional_csv_data
 
 
 class TestNonAscii(unittest.TestCase):
@@ -18,3 +26,35 @@ class TestNonAscii(unittest.TestCase):
         self.assertEqual(validate_audio("tests/valid_audio.wav", 16000, verbose=False), True)
         self.assertEqual(validate_audio("tests/valid_audio.wav", 8000, verbose=False), False)
         self.assertEqual(validate_audio("tests/invalid_audio_stereo.wav", 16000, verbose=False), False)
+
+
+class TestDatasetValidation(unittest.TestCase):
+    def test_reports_every_bad_row(self):
+        df = pd.DataFrame(
+            {
+                "filename": ["tests/valid_audio.wav", "tests/invalid_audio_stereo.wav", "tests/missing.wav"],
+                "transcript": ["the cat sat", "", "the öäü sat"],
+            }
+        )
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out), self.assertRaises(AssertionError):
+            validate_manditory_data(df, ["vs"], 16000)
+        self.assertIn("tests/invalid_audio_stereo.wav", out.getvalue())
+        self.assertIn("tests/missing.wav", out.getvalue())
+
+        with contextlib.redirect_stdout(out), self.assertRaises(AssertionError):
+            validate_optional_csv_data(df, True, "transcript", True)
+        self.assertIn("on row 1", out.getvalue())
+        self.assertIn("on row 2", out.getvalue())
+
+    def test_audio_index(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "audio_index.jsonl")
+            index = AudioIndex(path)
+            info = index.info("tests/valid_audio.wav")
+            self.assertEqual((info["sample_rate"], info["channels"]), (16000, 1))
+            self.assertGreater(info["duration"], 0)
+            index.save()
+
+            # a new run loads the saved entry
+            self.assertEqual(AudioIndex(path).entries[os.path.abspath("tests/valid_audio.wav")], info)
@@ -0,0 +1,72 @@
+import random
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from speechloop.asr.errors import DEFAULT_ERROR
+from speechloop.text import add_wer
+from speechloop import wer
+from speechloop.wer import WordInterner, align_counts
+
+
+def edit_distance(ref, hyp):
+    prev = list(range(len(hyp) + 1))
+    for i in range(1, len(ref) + 1):
+        cur = [i] + [0] * len(hyp)
+        for j in range(1, len(hyp) + 1):
+            cur[j] = min(prev[j - 1] + (ref[i - 1] != hyp[j - 1]), prev[j] + 1, cur[j - 1] + 1)
+        prev = cur
+    return prev[-1]
+
+
+class TestWER(unittest.TestCase):
+    def test_counts(self):
+        interner = WordInterner()
+        refs = interner.encode(["the cat sat on the mat", "hello world", "a b c", ""])
+        hyps = interner.encode(["the cat sat on mat", "hello there big world", "x b c", "extra"])
+        counts = align_counts(*refs, *hyps).tolist()
+        # hits, sub, del, ins
+        self.assertEqual(counts[0], [5, 0, 1, 0])
+        self.assertEqual(counts[1], [2, 0, 0, 2])
+        self.assertEqual(counts[2], [2, 1, 0, 0])
+        self.assertEqual(counts[3], [0, 0, 0, 1])
+
+    def test_matches_plain_edit_distance(self):
+        rng = random.Random(0)
+        words = ["a", "b", "c", "d"]
+        pairs = [([rng.choice(words) for _ in range(rng.randint(0, 12))], [rng.choice(words) for _ in range(rng.randint(0, 12))]) for _ in range(300)]
+        interner = WordInterner()
+        refs = interner.encode([" ".join(r) for r, _ in pairs])
+        hyps = interner.encode([" ".join(h) for _, h in pairs])
+        counts = align_counts(*refs, *hyps)
+        for (ref, hyp), (hits, sub, dele, ins) in zip(pairs, counts):
+            self.assertEqual(sub + dele + ins, edit_distance(ref, hyp))
+            self.assertEqual(hits + sub + dele, len(ref))
+            self.assertEqual(hits + sub + ins, len(hyp))
+
+    def test_pairs_over_the_cell_budget(self):
+        rng = random.Random(1)
+        words = ["a", "b", "c"]
+        pairs = [([rng.choice(words) for _ in range(n)], [rng.choice(words) for _ in range(m)]) for n, m in [(3, 4), (40, 25), (0, 30), (120, 90), (5, 0)]]
+        interner = WordInterner()
+        refs = interner.encode([" ".join(r) for r, _ in pairs])
+        hyps = interner.encode([" ".join(h) for _, h in pairs])
+        # the longest pairs are bigger than a batch is allowed to be, they are aligned on their own
+        with mock.patch.object(wer, "MAX_BATCH_CELLS", 50):
+            counts = align_counts(*refs, *hyps)
+        for (ref, hyp), (hits, sub, dele, ins) in zip(pairs, counts):
+            self.assertEqual(sub + dele + ins, edit_distance(ref, hyp))
+            self.assertEqual(hits + sub + dele, len(ref))
+
+    def test_add_wer(self):
+        df = pd.DataFrame({"transcript": ["hello world", "one two three four"], "vs": ["Hello", DEFAULT_ERROR]})
+        df = add_wer(df, ["vs_wer"], "transcript")
+        # errors are over the number of reference words
+        self.assertEqual(df["vs_wer"].tolist(), [0.5, 1.0])
+        self.assertEqual(df["vs_del"].tolist(), [1, 4])
+        self.assertEqual(df["vs_hits"].tolist(), [1, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()